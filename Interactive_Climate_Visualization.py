@@ -1,27 +1,119 @@
-import numpy as np
-import pandas as pd
-import textwrap
+import time
+_import_started = time.perf_counter()
+
+import json
+import os
 
 import ipywidgets as widgets
-from ipywidgets import interact, interact_manual
-import IPython.display
-from IPython.display import display, clear_output
-import plotly.graph_objects as go
+from IPython.display import display
+
+from instrumentation import enable_instrumentation, instrumentation_enabled, latency_panel_html, metrics
+from widget_scheduler import DebouncedScheduler
+
+## Nothing is displayed, read or tested on import. The notebook calls City_Temperature_Timeseries_Analysis and
+#     Global_Temperature_Anomalies_Analysis in the cells where the menus should appear, and static plots can be
+#     produced without any widget machinery with climviz.py. The menus are shown first: pandas, plotly, netCDF4,
+#     matplotlib and Basemap are only imported by the first update, or by the warm up started on the widget's worker
+#     thread as soon as the menus are shown, which also loads the station registry and the station archive.
+
+## Seconds from the import of this module to the first menus shown and the first plot of every widget
+startup_times = {}
+
+## Version of the saved widget state. Raise it whenever the location names change for a reason other than the
+#     station directory or inventory, e.g. a new default city name in station_registry.py
+WIDGET_STATE_VERSION = 1
+
+
+def record_startup(name):
+
+    """
+    Records the time from the import of this module to a startup milestone, the first time it is reached. The
+    milestones are also recorded in the instrumentation registry.
+    """
+
+    if name not in startup_times:
+        startup_times[name] = time.perf_counter() - _import_started
+        metrics.record(name, startup_times[name])
+    return
+
+
+def startup_report():
+
+    """
+    Returns the startup milestones reached so far (time to first widget and time to first plot of the city and
+    global widgets) in seconds since the import of this module.
+    """
+
+    return dict(startup_times)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def widget_location_names(source_dir=None, state_path=None):
+
+    """
+    Returns the "City, ST" names of the location menu. The names are kept in station_archive/widget_state.json
+    together with WIDGET_STATE_VERSION and the modification times of the station directory and the station
+    inventory, so later sessions fill the menu without building the station registry or importing NumPy.
+    """
+
+    if source_dir is None:
+        source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+    if state_path is None:
+        state_path = os.getcwd() + '/station_archive/widget_state.json'
+    key = [os.path.realpath(source_dir), _mtime(source_dir), _mtime(os.getcwd() + '/ghcnd-stations.txt'),
+           WIDGET_STATE_VERSION]
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('key') == key:
+            return state['locations']
+
+    from station_registry import load_station_registry
+    locations = load_station_registry(source_dir).location_names()
+    if os.path.isdir(os.path.dirname(state_path)):
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({'key': key, 'locations': locations}, f)
+        os.replace(state_path + '.tmp', state_path)
+    return locations
+
+
+def latency_panel(name):
+
+    """
+    Returns a small HTML widget listing the time (and memory, when traced) of every stage of the last widget update
+    of the given name, refreshed after every update. Turns the instrumentation on if it is off.
+    """
+
+    if not instrumentation_enabled():
+        enable_instrumentation()
+    panel = widgets.HTML(value=latency_panel_html(name))
 
-from analyze_city_climate_data import analyze_city_climate_data
+    def refresh(tree):
+        panel.value = latency_panel_html(name)
 
-def City_Temperature_Timeseries_Analysis():
+    metrics.add_listener(name, refresh)
+    return panel
+
+
+def City_Temperature_Timeseries_Analysis(show_latency=False, warm_up=True):
     
     """
-    Function call to produce the City Average Temperature Timeseries Visualization and Widgets.
+    Function call to produce the City Average Temperature Timeseries Visualization and Widgets. With show_latency, a
+    panel below the plot shows how long every stage of the last update took. With warm_up, the plotting libraries,
+    the plot, the station registry and the station archive are prepared in the background while the user is
+    choosing.
     
     """
     
-    ## Locations that have keys that can be called. These cities will be passed to the dropdown menu and are
-    #     the only ones that can be called at this time.
-    locations = ['Raleigh, NC', 'Albany, NY', 'Seattle, WA', 'Dallas, TX',
-                          'Salt Lake City, UT', 'Bismark, ND','Kansas City, MO', 
-                 'Flagstaff, AZ','Indianapolis, IN', 'Tallahassee, FL']
+    ## Locations that have keys that can be called. Every named station of the station registry is passed to the
+    #     dropdown menu.
+    locations = widget_location_names()
 
     ## "Annual" and monthls for each year for for the dropdown menu. Relates to the average being calculated for
     #     each year
@@ -59,7 +151,29 @@ def City_Temperature_Timeseries_Analysis():
         these out, the city timeseries visualization will be prompted.
     
         """
+        ## A single plot (a FigureWidget updated in place) and an output area for errors are displayed once below the
+        #     dropdown menus. The plot is built on the worker thread, by the warm up or the first update, and put in
+        #     its place below the menus then.
+        plot_area = widgets.Box()
+        figures = []
         output = widgets.Output()
+
+        def get_figure():
+            if not figures:
+                from analyze_city_climate_data import CityClimateFigureWidget
+                figures.append(CityClimateFigureWidget())
+                plot_area.children = (figures[0].fig,)
+            return figures[0]
+
+        ## The warm up loads what every selection needs (the plotting libraries, the plot, the station registry,
+        #     the station archive and its climatology table) but no station, since the location the user will pick
+        #     is not known yet
+        def prepare_first_plot():
+            get_figure()
+            from station_registry import load_station_registry
+            from climatology_table import load_climatology_table
+            load_station_registry()
+            load_climatology_table()
         
         ## Create dropdown menus
         dropdown_locations = widgets.Dropdown(options = sorted(locations), value=None, description='Cities:')
@@ -67,63 +181,51 @@ def City_Temperature_Timeseries_Analysis():
         dropdown_start_year = widgets.Dropdown(options = start_years, value=None, description='Start Year:')
         dropdown_end_year = widgets.Dropdown(options = end_years, value=None, description='End Year:')
 
-        ## Define the event handlers. These functions handle changes to the dropdown menu values. Every time there is
-        #     a change to one of the menus by the user, the analysis is rerun to produce an updated plot. The previous
-        #     plot is also cleared
-        
-        def dropdown_location_eventhandler(change):
-            """
-            Eventhandler for the location dropdown widget
-            """
-            display(input_widgets)
-            location_choice = change.new
-            analyze_city_climate_data(location_choice, dropdown_timescales.value, 
-                                      dropdown_start_year.value, dropdown_end_year.value)
-            IPython.display.clear_output(wait=True)            
+        ## The plot is updated on a worker thread once the menus stop changing, so scrolling through the years does
+        #     not update the plot per step and does not block the kernel. A selection that has already been changed
+        #     again is never shown, and errors are printed in the output area instead of being hidden. A new
+        #     location or timescale only swaps the plotted data, a new year range only moves the x axis.
+        def check_selection(location, timescale, start_year, end_year):
+            if None in (location, timescale, start_year, end_year):
+                return None
+            return location, timescale, start_year, end_year
 
-        def dropdown_timescale_eventhandler(change):
-            """
-            Eventhandler for the timescale dropdown widget
-            """
-            display(input_widgets)
-            timescale_choice = change.new
-            analyze_city_climate_data(dropdown_locations.value, timescale_choice, 
-                                      dropdown_start_year.value, dropdown_end_year.value)
-            IPython.display.clear_output(wait=True)
+        def show_plot(selection):
+            output.outputs = ()
+            if selection is not None:
+                get_figure().update(*selection)
+                record_startup('city time to first plot')
 
-        def dropdown_start_year_eventhandler(change):     
-            """
-            Event handler for the start year dropdown widget
-            """
-            display(input_widgets)
-            start_year_choice = change.new
-            analyze_city_climate_data(dropdown_locations.value, dropdown_timescales.value, 
-                                      start_year_choice, dropdown_end_year.value)
-            IPython.display.clear_output(wait=True)
+        def show_error(error, text):
+            output.outputs = ()
+            output.append_stderr(text)
+
+        scheduler = DebouncedScheduler(check_selection, show_plot, show_error, name='city plot update')
 
-        def dropdown_end_year_eventhandler(change):     
+        ## Define the event handler. Every time there is a change to one of the menus by the user, the current
+        #     selection of all menus is submitted to produce an updated plot, which replaces the previous one
+        def dropdown_eventhandler(change):
             """
-            Event handler for the end year dropdown widget
+            Eventhandler for the location, timescale, start year and end year dropdown widgets
             """
-            display(input_widgets)
-            end_year_choice = change.new
-            analyze_city_climate_data(dropdown_locations.value, dropdown_timescales.value, 
-                                      dropdown_start_year.value, end_year_choice)
-            IPython.display.clear_output(wait=True)
+            scheduler.submit(dropdown_locations.value, dropdown_timescales.value,
+                             dropdown_start_year.value, dropdown_end_year.value)
 
-        
-        ## Lines that observe the changes to the dropdown menus and runs any necessary functions above
-        dropdown_locations.observe(dropdown_location_eventhandler, names='value')
-        dropdown_timescales.observe(dropdown_timescale_eventhandler, names='value')
-        dropdown_start_year.observe(dropdown_start_year_eventhandler, names='value')
-        dropdown_end_year.observe(dropdown_end_year_eventhandler, names='value')
+        ## Lines that observe the changes to the dropdown menus and runs the event handler above
+        for dropdown in [dropdown_locations, dropdown_timescales, dropdown_start_year, dropdown_end_year]:
+            dropdown.observe(dropdown_eventhandler, names='value')
         
         ## Creating the widget objects that are shown on screen
         input_widgets = widgets.HBox([dropdown_locations, dropdown_timescales, dropdown_start_year, dropdown_end_year])
         
-        ## Displaying the widgets
-        display(input_widgets)
-        IPython.display.clear_output(wait=True) 
+        ## Displaying the widgets, the plot, the output area and the optional latency panel once
+        shown = [input_widgets, plot_area, output]
+        if show_latency:
+            shown.append(latency_panel('city plot update'))
+        display(widgets.VBox(shown))
+        record_startup('city time to first widget')
+        if warm_up and locations:
+            scheduler.warm_up(prepare_first_plot)
 
         return
     
@@ -136,25 +238,12 @@ def City_Temperature_Timeseries_Analysis():
 ## Testing for these functions are manually completed by which if the dropdown menus display the plots and update the plots
 #     accordingly then these functions are sufficient
 
-City_Temperature_Timeseries_Analysis()
-
-import numpy as np
-import pandas as pd
-import textwrap
-import nbimporter
-
-import ipywidgets as widgets
-from ipywidgets import interact, interact_manual
-import IPython.display
-from IPython.display import display, clear_output
-import plotly.graph_objects as go
-
-from analyze_global_temp_anomalies import analyze_global_temp_anomalies
-
-def Global_Temperature_Anomalies_Analysis():
+def Global_Temperature_Anomalies_Analysis(show_latency=False, warm_up=True):
     
     """
-    Function call to produce the Global Average Temperature Anomalies Visualization and Widgets.
+    Function call to produce the Global Average Temperature Anomalies Visualization and Widgets. With show_latency, a
+    panel below the map shows how long every stage of the last update took. With warm_up, the map (projection,
+    background, coastlines and colorbar) is built in the background while the user is choosing.
     
     """
     ## Details year range to be supplied to dropdown menu
@@ -186,45 +275,63 @@ def Global_Temperature_Anomalies_Analysis():
     
         """
         
+        ## The map is shown in a single image widget whose picture is replaced for every selection, and errors are
+        #     printed in an output area below it
+        map_image = widgets.Image(format='png')
         output = widgets.Output()
         
         ## Create dropdown menus
         dropdown_years = widgets.Dropdown(options = years, value=None, description='Year:')
         dropdown_months = widgets.Dropdown(options = months, value=None, description='Month:')
 
-        ## Define the event handlers. These functions handle changes to the dropdown menu values. Every time there is
-        #     a change to one of the menus by the user, the analysis is rerun to produce an updated map. The previous
-        #     map is also cleared
-        def dropdown_year_eventhandler(change):
-            """
-            Eventhandler for the years dropdown widget
-            """
-            clear_output()
-            display(input_widgets)
-            year_choice = change.new
-            analyze_global_temp_anomalies(year_choice, dropdown_months.value)
-            IPython.display.clear_output(wait=True) 
+        ## The map is rendered on a worker thread once the menus stop changing, so scrolling through the years does
+        #     not render a map per step and does not block the kernel. A map for a selection that has already been
+        #     changed again is never shown.
+        def render_map(year, month):
+            if year is None or month is None:
+                return None
+            from analyze_global_temp_anomalies import render_global_temp_anomalies
+            return render_global_temp_anomalies(year, month)
+
+        def prepare_map():
+            from anomaly_map_renderer import get_anomaly_map_renderer
+            get_anomaly_map_renderer(headless=True)
+
+        def show_map(png):
+            output.outputs = ()
+            if png is not None:
+                map_image.value = png
+                record_startup('global time to first plot')
+
+        def show_error(error, text):
+            output.outputs = ()
+            output.append_stderr(text)
+
+        scheduler = DebouncedScheduler(render_map, show_map, show_error, name='global map update')
 
-        def dropdown_month_eventhandler(change):
+        ## Define the event handler. Every time there is a change to one of the menus by the user, the current
+        #     selection of both menus is submitted to produce an updated map, which replaces the previous one
+        def dropdown_eventhandler(change):
             """
-            Eventhandler for the month dropdown widget
+            Eventhandler for the year and month dropdown widgets
             """
-            clear_output()
-            display(input_widgets)
-            month_choice = change.new
-            analyze_global_temp_anomalies(dropdown_years.value, month_choice)
-            IPython.display.clear_output(wait=True)  
-
-        ## Lines that observe the changes to the dropdown menus and runs any necessary functions above
-        dropdown_years.observe(dropdown_year_eventhandler, names='value')
-        dropdown_months.observe(dropdown_month_eventhandler, names='value')
+            scheduler.submit(dropdown_years.value, dropdown_months.value)
+
+        ## Lines that observe the changes to the dropdown menus and runs the event handler above
+        dropdown_years.observe(dropdown_eventhandler, names='value')
+        dropdown_months.observe(dropdown_eventhandler, names='value')
         
         ## Creates the widgets shown on screen
         input_widgets = widgets.HBox([dropdown_years, dropdown_months])
 
-        ## Displaying widgets
-        display(input_widgets)
-        IPython.display.clear_output(wait=True)
+        ## Displaying the widgets, the map, the output area and the optional latency panel once
+        shown = [input_widgets, map_image, output]
+        if show_latency:
+            shown.append(latency_panel('global map update'))
+        display(widgets.VBox(shown))
+        record_startup('global time to first widget')
+        if warm_up:
+            scheduler.warm_up(prepare_map)
 
         return
     
@@ -236,4 +343,48 @@ def Global_Temperature_Anomalies_Analysis():
 ## Testing for these functions are manually completed by which if the dropdown menus display the maps and update the maps
 #     accordingly then these functions are sufficient
 
-Global_Temperature_Anomalies_Analysis()
+
+## Testing functionality
+def test_cold_start(tmp_path, monkeypatch):
+
+    import subprocess
+    import sys
+
+    ## Importing the module reads nothing and loads none of the data or plotting libraries
+    code = ('import sys, Interactive_Climate_Visualization; '
+            'print(",".join(m for m in ["numpy", "pandas", "plotly", "matplotlib", "netCDF4"] if m in sys.modules))')
+    loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    assert loaded == ''
+
+    ## The location menu is filled from the saved widget state until the station directory changes
+    state_path = str(tmp_path) + '/widget_state.json'
+    locations = widget_location_names(state_path=state_path)
+    assert 'Raleigh, NC' in locations and os.path.exists(state_path)
+    with open(state_path) as f:
+        state = json.load(f)
+    state['locations'] = ['Saved, ST']
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    assert widget_location_names(state_path=state_path) == ['Saved, ST']
+    state['key'][1] = 0
+    with open(state_path, 'w') as f:
+        json.dump(state, f)
+    assert widget_location_names(state_path=state_path) == locations
+
+    ## The menus are shown before the plot exists, and the first selection is plotted after the warm up
+    shown = []
+    monkeypatch.setattr(sys.modules[__name__], 'display', shown.append)
+    City_Temperature_Timeseries_Analysis()
+    menus, plot_area, _ = shown[0].children
+    assert 'city time to first widget' in startup_report()
+    for dropdown, value in zip(menus.children, ['Raleigh, NC', 'Annual', 1950, 2000]):
+        dropdown.value = value
+    deadline = time.perf_counter() + 60
+    while 'city time to first plot' not in startup_times and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    report = startup_report()
+    assert report['city time to first widget'] < report['city time to first plot']
+    assert len(plot_area.children) == 1 and 'Raleigh, NC' in plot_area.children[0].layout.title.text
+
+    return
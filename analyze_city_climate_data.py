@@ -1,15 +1,17 @@
 import pandas as pd
 import plotly.graph_objects as go
 from load_city_climate_files import pull_location_file, parse_climate_data
+from climate_cache import get_city_series
+from instrumentation import instrumented, span
 
-def analyze_city_climate_data(location, timescale, start_year, end_year):
+def build_city_climate_figure(location, timescale, start_year, end_year, baseline=(1981, 2010), series=None,
+                              policy=None):
     
     """
-    This function plots the average temperature for a particular city within CONUS over the course of a start year
-    and an end year specified by the user. The average temperatures correspond either to the annual average (average across
-    an entire year) or the average temperature for one month for that year which is also specified by the user. The
-    time series plot generated is interactive for the user. This function MUST be ran by the user due to the nature of the
-    plotting software used for the dropdown widgets.
+    This function builds the plot of the average temperature for a particular city within CONUS over the course of a
+    start year and an end year specified by the user. The average temperatures correspond either to the annual average
+    (average across an entire year) or the average temperature for one month for that year which is also specified by
+    the user. The figure is returned without being shown, so it can be built away from the notebook's main thread.
     
     Inputs:
     location (string): structured "City, ST" in which the state is the two letter state abbreviation.
@@ -20,70 +22,41 @@ def analyze_city_climate_data(location, timescale, start_year, end_year):
     
     end_year (integer): the year that will mark the end of the time series
     
+    baseline (tuple): first and last year of the climatology shown as the reference line (1981-2010 by default)
+    
+    series (tuple): years, averages and climatology to plot, as returned by get_city_series. Looked up for the
+    location when not given.
+    
+    policy (QualityPolicy or string): quality policy whose rejected values are left out, e.g. "measured" to leave out
+    estimated values (see quality_policy.py). Every value is used by default.
+    
     Returns:
-    Time series plotly plot of the average temperature across a certain timescale for a location.
+    fig (go.Figure): time series plotly plot of the average temperature across a certain timescale for a location.
     
     """
     
-    ## Must have try and except block here to account for how this function reacts to inputs from a dropdown Jupyter
-    #     widget. An error is generated upon first generating the dropdown menu. The table automatically updates based
-    #     a change in the inputs, and if an input is not filled, an error will be generated. This is not something that
-    #     can be solved by another method as there is no "direct" source.
-    try:
-        
-        ## Start by pulling the dataframe for the location
-        used_file_path = pull_location_file(location)
-
-        df_city_data = parse_climate_data(used_file_path)
-        
-        
-        if timescale == 'Annual':
-            
-            ## Find average of all monthly averages to generate a new column
-            df_city_data['Average'] = df_city_data[['January','February','March','April','May','June','July','August',
-           'September','October','November','December']].mean(axis=1)
-            
-            ## Any rows or columns with missing data should not be calculated in with the averages (inaccurate average)
-            #     or illustrated in the plot
-            df_city_data = df_city_data.dropna()
-            
-            ## Averages to be plotted
-            plotted_data = df_city_data['Average']
-            
-            ## Slice dataframe to reflect average for the climateology of the location (Recent 30 year average)
-            df_average = df_city_data.loc[(df_city_data['Year'] >= 1981) & (df_city_data['Year'] <= 2010)]
-            
-            ## Climateology Average to be used
-            plotted_average = df_average['Average'].mean(axis=0)
-
-        ## Only use monthly averages
-        else:
-            
-            ## Any rows or columns with missing data should not be illustrated in the plot
-            df_city_data = df_city_data.dropna(subset=[timescale])
-            
-            ##Averages to be plotted
-            plotted_data = df_city_data[timescale]
-
-            ## Slice dataframe to reflect average for the climateology of the location (Recent 30 year average)
-            df_average = df_city_data.loc[(df_city_data['Year'] >= 1981) & (df_city_data['Year'] <= 2010)]
-        
-            ## 30-year average for that month being plotted
-            plotted_average = df_average[timescale].mean(axis=0)
-        
+    ## Pull the averages and the climatology for the location. Parsed stations and their derived averages are kept
+    #     in a shared cache, so changing only the year range does not reload or reparse the station file. Annual
+    #     averages are the average of all monthly averages, and any year with missing data is not calculated in
+    #     with the averages (inaccurate average) or illustrated in the plot.
+    if series is None:
+        series = get_city_series(location, timescale, baseline=baseline, policy=policy)
+    plotted_years, plotted_data, plotted_average = series
+    
+    with span('build figure'):
         ## Use plottly commands in order to create an interactive figure that can be easily updated
         fig = go.Figure()
 
         ## Plot the observational averages
-        fig.add_trace(go.Scatter(x=df_city_data['Year'],
+        fig.add_trace(go.Scatter(x=plotted_years,
                 y=plotted_data, mode='lines+markers',
                                 name = 'Average Temperature'))
 
         ## Plot the climateology average
         fig.add_hline(y=plotted_average, line_color="red",
-                      annotation_text = '1981-2010 Mean: ' + str(round((plotted_average),1)) + '°C',
+                      annotation_text = str(baseline[0]) + '-' + str(baseline[1]) + ' Mean: ' + str(round((plotted_average),1)) + '°C',
                      annotation_position='top left')
-        
+    
         ## Add figure title, axis labels, and adjusted user time range
         fig.update_layout(xaxis=dict(
             tickmode="array",
@@ -94,16 +67,166 @@ def analyze_city_climate_data(location, timescale, start_year, end_year):
             title = location + ' ' + timescale + ' Average Temperature', 
             title_x=0.5,
             font=dict(size=14))
-        
+    
         ## Add gridlines
         fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
         fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
 
+    return fig
+
+class CityClimateFigureWidget:
+    
+    """
+    Persistent version of the city time series plot as a plotly FigureWidget. The trace, the climatology line, the
+    layout and the gridlines are created once. A change of location, timescale or baseline only swaps the x/y arrays
+    of the scatter, the climatology line and its annotation and the title, and a change of the year range only
+    updates the x axis range, all inside one batch_update so the frontend receives a single small update message
+    instead of the whole figure.
+    
+    """
+    
+    def __init__(self):
+        
+        ## Use plottly commands in order to create an interactive figure that can be updated in place
+        self.fig = go.FigureWidget()
+        
+        ## The observational averages and the climateology average start out empty and are filled by update
+        self.fig.add_trace(go.Scatter(x=[], y=[], mode='lines+markers', name = 'Average Temperature'))
+        self.fig.add_hline(y=0, line_color="red", annotation_text = '', annotation_position='top left')
+        
+        ## Add axis labels and gridlines
+        self.fig.update_layout(xaxis=dict(tickmode="array"),
+            xaxis_title="Year",
+            yaxis_title="Temperature °C",
+            showlegend=False,
+            title_x=0.5,
+            font=dict(size=14))
+        self.fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
+        self.fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
+        
+        self.series_key = None
+        self.year_range = None
+        self.shown = False
+    
+    @instrumented('update figure widget')
+    def update(self, location, timescale, start_year, end_year, baseline=(1981, 2010), policy=None):
+        
+        """
+        Shows the averages of a location and timescale over a range of years, only changing what differs from the
+        current plot.
+        
+        Inputs:
+        location (string): structured "City, ST" in which the state is the two letter state abbreviation.
+        
+        timescale (string): Either "Annual" or one of the months of the year.
+        
+        start_year (integer), end_year (integer): the years that mark the start and the end of the time series
+        
+        baseline (tuple): first and last year of the climatology shown as the reference line (1981-2010 by default)
+        
+        policy (QualityPolicy or string): quality policy whose rejected values are left out (see quality_policy.py)
+        
+        """
+        
+        series_key = (location, timescale, tuple(baseline), policy)
+        series = None
+        if series_key != self.series_key:
+            series = get_city_series(location, timescale, baseline=baseline, policy=policy)
+        
+        with span('batch update'), self.fig.batch_update():
+            if series is not None:
+                plotted_years, plotted_data, plotted_average = series
+                self.fig.data[0].x = plotted_years
+                self.fig.data[0].y = plotted_data
+                self.fig.layout.shapes[0].update(y0=plotted_average, y1=plotted_average)
+                self.fig.layout.annotations[0].update(
+                    y=plotted_average,
+                    text=str(baseline[0]) + '-' + str(baseline[1]) + ' Mean: ' + str(round((plotted_average),1)) + '°C')
+                self.fig.layout.title.text = location + ' ' + timescale + ' Average Temperature'
+                self.series_key = series_key
+            if (start_year, end_year) != self.year_range:
+                self.fig.layout.xaxis.range = [start_year, end_year]
+                self.year_range = (start_year, end_year)
+        return
+    
+    def show(self):
+        
+        """
+        Displays the figure widget. It is only displayed the first time, later updates change it in place.
+        """
+        
+        if not self.shown:
+            from IPython.display import display
+            display(self.fig)
+            self.shown = True
+        return
+
+
+## One figure widget is shared by all calls in figure widget mode
+_figure_widget = None
+
+def get_city_climate_figure_widget():
+    
+    """
+    Returns the shared city time series figure widget, creating it on first use.
+    """
+    
+    global _figure_widget
+    if _figure_widget is None:
+        _figure_widget = CityClimateFigureWidget()
+    return _figure_widget
+
+@instrumented('analyze_city_climate_data')
+def analyze_city_climate_data(location, timescale, start_year, end_year, baseline=(1981, 2010),
+                              figure_widget=False, policy=None):
+    
+    """
+    This function plots the average temperature for a particular city within CONUS over the course of a start year
+    and an end year specified by the user. The average temperatures correspond either to the annual average (average across
+    an entire year) or the average temperature for one month for that year which is also specified by the user. The
+    time series plot generated is interactive for the user. This function MUST be ran by the user due to the nature of the
+    plotting software used for the dropdown widgets.
+    
+    Inputs:
+    location (string): structured "City, ST" in which the state is the two letter state abbreviation.
+    
+    timescale (string): Either "Annual" or one of the months of the year.
+    
+    start_year (integer): the year that will mark the start of the time series
+    
+    end_year (integer): the year that will mark the end of the time series
+    
+    baseline (tuple): first and last year of the climatology shown as the reference line (1981-2010 by default)
+    
+    figure_widget (boolean): update a single persistent FigureWidget in place instead of showing a new figure for
+    every call.
+    
+    policy (QualityPolicy or string): quality policy whose rejected values are left out of the averages and the
+    climatology, e.g. "measured" to leave out values estimated from neighbouring stations (see quality_policy.py).
+    Every value is used by default.
+    
+    Returns:
+    Time series plotly plot of the average temperature across a certain timescale for a location.
+    
+    """
+    
+    ## The dropdown menus start out empty, and nothing can be plotted until every field is filled out. Any other
+    #     failure is a real error and is raised to the user.
+    if None in (location, timescale, start_year, end_year):
+        return
+    
+    if figure_widget:
+        widget = get_city_climate_figure_widget()
+        widget.update(location, timescale, start_year, end_year, baseline, policy)
+        with span('show'):
+            widget.show()
+        return
+    
+    fig = build_city_climate_figure(location, timescale, start_year, end_year, baseline, policy=policy)
+    with span('show'):
         fig.show()
     
-    ## Except block for when dropdown initially fails before fields are filled out
-    except Exception:
-        pass
+    return
     
 ## Test that the averages calculated closely match the actual averages (referenced NCDC website)
 def testing_averages():
@@ -146,8 +269,36 @@ def testing_averages():
     
     
     return
+
+
+## Test that the figure widget updated in place shows the same plot as a freshly built figure
+def test_city_climate_figure_widget():
     
-testing_averages()
+    widget = CityClimateFigureWidget()
+    widget.update('Dallas, TX', 'January', 1950, 2000)
+    widget.update('Raleigh, NC', 'Annual', 1950, 2000)
+    trace = widget.fig.data[0]
+    widget.update('Raleigh, NC', 'Annual', 1900, 2021)
+    
+    ## A year range change keeps the same data and only moves the axis
+    assert widget.fig.data[0] is trace and widget.year_range == (1900, 2021)
+    
+    fig = build_city_climate_figure('Raleigh, NC', 'Annual', 1900, 2021)
+    assert list(widget.fig.data[0].x) == list(fig.data[0].x)
+    assert list(widget.fig.data[0].y) == list(fig.data[0].y)
+    assert widget.fig.layout.shapes[0].y0 == fig.layout.shapes[0].y0
+    assert widget.fig.layout.annotations[0].text == fig.layout.annotations[0].text
+    assert widget.fig.layout.title.text == fig.layout.title.text
+    assert tuple(widget.fig.layout.xaxis.range) == tuple(fig.layout.xaxis.range)
+    
+    ## Switching the quality policy replots the series without the estimated years
+    n_years = len(trace.x)
+    widget.update('Raleigh, NC', 'Annual', 1900, 2021, policy='measured')
+    fig = build_city_climate_figure('Raleigh, NC', 'Annual', 1900, 2021, policy='measured')
+    assert list(widget.fig.data[0].x) == list(fig.data[0].x) and len(fig.data[0].x) < n_years
+    
+    return
+
 
 ## Function passes all tests
 
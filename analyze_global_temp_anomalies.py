@@ -1,16 +1,8 @@
-import glob
-import os
-import numpy as np
+from anomaly_map_renderer import get_anomaly_map_renderer
+from instrumentation import instrumented, span
 
-from netCDF4 import Dataset
-from netCDF4 import date2index
-from datetime import datetime
-
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
-import plotly.graph_objects as go
-
-def analyze_global_temp_anomalies(year, month):
+@instrumented('analyze_global_temp_anomalies')
+def analyze_global_temp_anomalies(year, month, region=None, step=1):
     
     """
     This function plots the average temperature anomalies (deg C) based upon observational averages versus the 1951-1980
@@ -24,75 +16,59 @@ def analyze_global_temp_anomalies(year, month):
     
     month (string): the month pertaining to the average temperature anomalies desired for said month
     
+    region (string or tuple): name of a region of anomaly_dataset.REGIONS (e.g. "CONUS") or a (lon_min, lat_min,
+    lon_max, lat_max) bounding box to map instead of the whole globe. Only the zones of the region are read and drawn.
+    
+    step (integer): level of detail, the size of the blocks of zones averaged together for overview maps
+    
     Returns:
     Global Temperature Anomalies Map illustrating the temperature difference from average for that month of the year.
     
     """
     
-    ## Must have try and except block here to account for how this function reacts to inputs from a dropdown Jupyter
-    #     widget. An error is generated upon first generating the dropdown menu. The table automatically updates based
-    #     a change in the inputs, and if an input is not filled, an error will be generated. This is not something that
-    #     can be solved by another method as there is no "direct" source.
-    try:
-        
-        ## Locate and pull the file being called
-        filepath = glob.glob(os.getcwd() + '/gistemp1200_GHCNv4_ERSSTv5.nc') 
-
-        ## Extract file from list
-        used_filepath = filepath[0]
-
-        ## Read the .nc file
-        global_data = Dataset(used_filepath)
-
-        ## Organize a dictionary encoding month to a number, this is for the datetime notation
-        month_dic = {'January': 1, 'February': 2,
-                          'March': 3, 'April': 4, 'May': 5,
-                          'June': 6, 'July': 7,
-                          'August': 8, 'September': 9, 'October': 10,
-                          'November': 11, 'December': 12}
-        
-        ## Pull the datetimes for all of the zones that will be sliced.
-        #     Datetime is organized by year, moth, and day. "Day" is always == 15
-        timeindex = date2index(datetime(year, month_dic[month], 15),
-                           global_data.variables['time'])
-        
-        ## Gathering lat and lons
-        lat = global_data.variables['lat'][:]
-        lon = global_data.variables['lon'][:]
-        ## Create a meshgrid so that the borders of the 2x2 deg zones can be create
-        lon, lat = np.meshgrid(lon, lat)
-        
-        ## Slice the temperature anomalies based upon the time index provided
-        temp_anomaly = global_data.variables['tempanomaly'][timeindex]
-        
-        ## Create figure
-        fig = plt.figure(figsize=(18, 10))
-
-        ## Create the basemap projection that will hold the data
-        m = Basemap(projection='cyl', resolution='c', 
-                lat_0=0, lon_0=0,)
-        m.bluemarble(scale=0.5)
-        ## Map the anomalies based upon zone
-        m.pcolormesh(lon, lat, temp_anomaly,
-                 latlon=True, cmap='RdBu_r')
-        
-        plt.clim(-8, 8) # Colorbar limits
-        m.drawcoastlines(color='lightgray')
-        
-        plt.title(month + ' ' + str(year) + ' Temperature Anomaly', fontsize = 16)
-        
-        ## Create colorbar and bold title
-        cb = plt.colorbar()
-        cb.set_label(label='Temperature Anomaly (°C)', weight='bold')
-
-        plt.show()
-        
-    ## Except block for when dropdown initially fails before fields are filled out
-    except Exception:
-        pass
+    ## The dropdown menus start out empty, and nothing can be plotted until both fields are filled out. Any other
+    #     failure is a real error and is raised to the user.
+    if year is None or month is None:
+        return
+    
+    ## The map (projection, bluemarble background, coastlines, colorbar and anomaly mesh) is built once from the
+    #     anomaly file, which is also opened once and kept open. Each call only reads the slice of the requested
+    #     year and month and swaps it into the existing mesh together with the title.
+    with span('get renderer'):
+        renderer = get_anomaly_map_renderer(region=region, step=step)
+    renderer.render(year, month)
+    with span('show'):
+        renderer.show()
 
     return
 
+@instrumented('render_global_temp_anomalies')
+def render_global_temp_anomalies(year, month, region=None, step=1):
+    
+    """
+    Renders the global temperature anomalies map of a year and month on the shared headless map and returns it as a
+    PNG image, for display in an image widget. Safe to call away from the notebook's main thread as long as only one
+    thread renders at a time.
+    
+    Inputs:
+    year (integer): the year of the average temperature anomalies to be pulled
+    
+    month (string): the month pertaining to the average temperature anomalies desired for said month
+    
+    region (string or tuple), step (integer): region and level of detail of the map, see
+    analyze_global_temp_anomalies
+    
+    Returns:
+    (bytes) - the map as a PNG image.
+    
+    """
+    
+    with span('get renderer'):
+        renderer = get_anomaly_map_renderer(headless=True, region=region, step=step)
+    renderer.render(year, month)
+    
+    return renderer.png_bytes()
+
 ## Manual test performed to match regional anomalies to actual anomalies. I matched what visually appeared on the map
 #     when loaded to the approximations shown by some of the City Timeseries plots on the NCDC.gov/cag/ website. These
 #     tests are meant to represent that this data has been checked for relative accuracy. All looks good
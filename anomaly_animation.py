@@ -0,0 +1,176 @@
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from anomaly_dataset import open_anomaly_dataset
+from anomaly_map_renderer import AnomalyMapRenderer, MONTH_NAMES
+
+
+def _encode_png(rgba, path):
+
+    """
+    Worker task: encodes the pixels of one frame as PNG. No metadata is written, so equal frames give equal files.
+    """
+
+    from PIL import Image
+
+    Image.fromarray(rgba).save(path + '.tmp', format='png')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def render_anomaly_frames(start_year, end_year, output_dir, dataset=None, workers=None, chunk_months=24,
+                          animation=None, background=True, figsize=(18, 10), frame_duration=200, region=None, step=1):
+
+    """
+    Renders the temperature anomalies map of every month between two years to PNG frames, and optionally joins them
+    into a GIF or MP4 animation. The anomalies are streamed from the netCDF file chunk_months time steps at a time,
+    a single headless map (projection, background, coastlines and colorbar) is reused for every frame, and the PNG
+    encoding of the frames is spread over a pool of worker processes while the next frames are drawn.
+
+    Inputs:
+    start_year (integer), end_year (integer): first and last year to render.
+
+    output_dir (string): directory the frames frame_YYYY_MM.png are written to.
+
+    dataset (AnomalyDataset): dataset the anomalies are read from. Defaults to the shared anomaly file.
+
+    workers (integer): number of encoding processes. Defaults to the number of CPUs.
+
+    chunk_months (integer): number of time steps read from the file at once.
+
+    animation (string): path of a .gif or .mp4 file to write from the frames. MP4 output requires ffmpeg.
+
+    background (boolean): whether to draw the bluemarble background.
+
+    figsize (tuple): figure size in inches.
+
+    frame_duration (integer): time each frame is shown in the animation, in milliseconds.
+
+    region (string or tuple): region shown, see AnomalyMapRenderer. The whole globe by default.
+
+    step (integer): level of detail, the size of the blocks of zones averaged together.
+
+    Returns:
+    (dict) - the frame paths, the number of frames, the elapsed seconds and the frames per second.
+
+    """
+
+    if dataset is None:
+        dataset = open_anomaly_dataset()
+    if workers is None:
+        workers = os.cpu_count()
+    months = dataset.months(start_year, end_year)
+    if not months:
+        raise ValueError('No anomalies between ' + str(start_year) + ' and ' + str(end_year) + ' in ' + dataset.path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    renderer = AnomalyMapRenderer(dataset, headless=True, background=background, figsize=figsize, region=region,
+                                  step=step)
+    frame_paths = []
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for chunk_start in range(0, len(months), chunk_months):
+            chunk = months[chunk_start:chunk_start + chunk_months]
+
+            ## Months of a year range are consecutive time steps, so a chunk is one contiguous read
+            t_first, t_last = chunk[0][0], chunk[-1][0]
+            block = dataset.read_block(t_first, t_last + 1, region, step)
+
+            for t, year, month in chunk:
+                renderer.set_field(block[t - t_first], MONTH_NAMES[month] + ' ' + str(year) + ' Temperature Anomaly'
+                                   + renderer.region_label())
+                path = output_dir + '/frame_%04d_%02d.png' % (year, month)
+                pending.append(executor.submit(_encode_png, renderer.to_rgba(), path))
+                frame_paths.append(path)
+
+                ## Bound the number of frames waiting to be encoded so memory use stays flat
+                while len(pending) > 2 * workers:
+                    pending.pop(0).result()
+        for future in pending:
+            future.result()
+    elapsed = time.perf_counter() - start_time
+    renderer.close()
+
+    if animation is not None:
+        write_animation(frame_paths, animation, frame_duration)
+
+    return {'frames': frame_paths, 'count': len(frame_paths), 'seconds': elapsed,
+            'fps': len(frame_paths) / elapsed if elapsed > 0 else np.inf}
+
+
+def write_animation(frame_paths, animation, frame_duration=200):
+
+    """
+    Joins rendered frames into an animation. GIFs are written with Pillow, MP4s with ffmpeg.
+
+    Inputs:
+    frame_paths (list): PNG frames in display order.
+
+    animation (string): path of the .gif or .mp4 file.
+
+    frame_duration (integer): time each frame is shown, in milliseconds.
+
+    """
+
+    if not frame_paths:
+        raise ValueError('No frames to join into ' + animation)
+    if animation.endswith('.gif'):
+        from PIL import Image
+        frames = [Image.open(path).convert('RGB') for path in frame_paths]
+        frames[0].save(animation, save_all=True, append_images=frames[1:], duration=frame_duration, loop=0)
+    elif animation.endswith('.mp4'):
+        if shutil.which('ffmpeg') is None:
+            raise RuntimeError('Writing an MP4 animation requires ffmpeg')
+        frame_list = animation + '.frames.txt'
+        with open(frame_list, 'w') as f:
+            for path in frame_paths:
+                f.write("file '" + os.path.abspath(path) + "'\nduration " + str(frame_duration / 1000) + '\n')
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', frame_list,
+                        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', animation], check=True)
+        os.remove(frame_list)
+    else:
+        raise ValueError('Animations must be .gif or .mp4 files: ' + animation)
+    return
+
+
+## Testing functionality
+def test_render_anomaly_frames(tmp_path):
+
+    import pytest
+    from anomaly_dataset import AnomalyDataset, write_synthetic_gistemp
+
+    path = write_synthetic_gistemp(str(tmp_path) + '/gistemp_synthetic.nc', 2000, 2001)
+    with AnomalyDataset(path) as dataset:
+        first = render_anomaly_frames(2001, 2001, str(tmp_path) + '/first', dataset, workers=2, chunk_months=5,
+                                      animation=str(tmp_path) + '/first.gif', background=False, figsize=(4, 3))
+        second = render_anomaly_frames(2001, 2001, str(tmp_path) + '/second', dataset, workers=1, chunk_months=12,
+                                       background=False, figsize=(4, 3))
+
+    ## Frames are the same whatever the chunking and number of workers, and every frame differs from the next
+    assert first['count'] == 12 and os.path.basename(first['frames'][0]) == 'frame_2001_01.png'
+    contents = [open(frame, 'rb').read() for frame in first['frames']]
+    assert contents == [open(frame, 'rb').read() for frame in second['frames']]
+    assert len(set(contents)) == 12
+    assert os.path.getsize(str(tmp_path) + '/first.gif') > 0
+
+    ## A year range without anomalies is an error rather than an empty animation
+    with AnomalyDataset(path) as dataset, pytest.raises(ValueError, match='between 1990 and 1995'):
+        render_anomaly_frames(1990, 1995, str(tmp_path) + '/empty', dataset, animation=str(tmp_path) + '/empty.gif')
+    assert not os.path.exists(str(tmp_path) + '/empty.gif')
+
+    return
+
+
+## Running this file renders a year range: python anomaly_animation.py start_year end_year output_dir [animation]
+if __name__ == '__main__':
+    import sys
+    result = render_anomaly_frames(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3],
+                                   animation=sys.argv[4] if len(sys.argv) > 4 else None)
+    print('Rendered %d frames in %.1f s (%.1f frames/s)' % (result['count'], result['seconds'], result['fps']))
@@ -0,0 +1,666 @@
+import os
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+## Organize a dictionary encoding month to a number, this is for the datetime notation
+MONTH_NUMBERS = {'January': 1, 'February': 2, 'March': 3, 'April': 4, 'May': 5, 'June': 6, 'July': 7,
+                 'August': 8, 'September': 9, 'October': 10, 'November': 11, 'December': 12}
+
+## Named regions as (lon_min, lat_min, lon_max, lat_max) bounding boxes in degrees
+REGIONS = {'Global': (-180, -90, 180, 90), 'CONUS': (-125, 24, -66, 50), 'Alaska': (-170, 51, -129, 72),
+           'North America': (-170, 15, -50, 75), 'Europe': (-25, 34, 45, 72), 'Arctic': (-180, 60, 180, 90),
+           'Tropics': (-180, -24, 180, 24)}
+
+## Months, coordinates and anomalies read from a Zarr cube by read_anomaly_zarr
+AnomalyCube = namedtuple('AnomalyCube', ['years', 'months', 'lat', 'lon', 'anomalies'])
+
+## Zones read at once by region_mean_series, so that large regions are read a bounded block of months at a time
+SERIES_READ_ZONES = 2 ** 22
+
+
+def region_bounds(region):
+
+    """
+    Returns the (lon_min, lat_min, lon_max, lat_max) bounding box of a region given by name or as a bounding box,
+    either a sequence or a string such as "-125,24,-66,50". Bounding boxes crossing the dateline are not supported.
+    """
+
+    if region is None:
+        region = 'Global'
+    if isinstance(region, str) and ',' in region:
+        region = region.split(',')
+    if isinstance(region, str):
+        try:
+            return REGIONS[region]
+        except KeyError:
+            raise KeyError('Unknown region ' + region + ', use one of ' + ', '.join(REGIONS)) from None
+    try:
+        lon_min, lat_min, lon_max, lat_max = (float(value) for value in region)
+    except ValueError:
+        raise ValueError('Bounding boxes are (lon_min, lat_min, lon_max, lat_max) in degrees') from None
+    if not (lon_min < lon_max and lat_min < lat_max):
+        raise ValueError('Bounding boxes are (lon_min, lat_min, lon_max, lat_max) with min < max')
+    return lon_min, lat_min, lon_max, lat_max
+
+
+def grid_slices(lat, lon, region):
+
+    """
+    Converts a region into the index slices of the zones of a lat/lon grid overlapping it, see
+    AnomalyDataset.region_slices.
+    """
+
+    lon_min, lat_min, lon_max, lat_max = region_bounds(region)
+    slices = []
+    for centers, low, high in [(lat, lat_min, lat_max), (lon, lon_min, lon_max)]:
+        centers = np.asarray(centers, dtype=float)
+        half = np.abs(np.diff(centers)).min() / 2 if len(centers) > 1 else 180
+        inside = np.nonzero((centers - half < high) & (centers + half > low))[0]
+        if len(inside) == 0:
+            raise ValueError('The region ' + str(region) + ' does not overlap the grid')
+        slices.append(slice(int(inside[0]), int(inside[-1]) + 1))
+    return slices[0], slices[1]
+
+
+def block_mean(field, step):
+
+    """
+    Downsamples the last two axes of a field by averaging blocks of step x step zones, ignoring masked zones, for
+    overview maps. Blocks at the edges may hold fewer zones, and blocks without any data are masked.
+    """
+
+    if step == 1:
+        return field
+    data = np.ma.filled(np.ma.asarray(field, dtype=float), np.nan)
+    rows, columns = data.shape[-2:]
+    padding = [(0, 0)] * (data.ndim - 2) + [(0, -rows % step), (0, -columns % step)]
+    data = np.pad(data, padding, constant_values=np.nan)
+    blocks = data.reshape(data.shape[:-2] + (data.shape[-2] // step, step, data.shape[-1] // step, step))
+    valid = ~np.isnan(blocks)
+    count = valid.sum(axis=(-3, -1))
+    total = np.where(valid, blocks, 0).sum(axis=(-3, -1))
+    return np.ma.masked_array(total / np.maximum(count, 1), mask=count == 0)
+
+
+def block_centers(centers, step):
+
+    """
+    Returns the mean coordinate of every block of step consecutive zone centres, see block_mean.
+    """
+
+    centers = np.asarray(centers, dtype=float)
+    return np.array([centers[i:i + step].mean() for i in range(0, len(centers), step)])
+
+
+class AnomalyDataset:
+
+    """
+    Long lived handle on the GISTEMP temperature anomaly file. The file is opened once, the latitude/longitude grids
+    and a (year, month) to time index dictionary are built once, and only the requested tempanomaly[t] slices are
+    read, with the most recently used slices kept in memory. Regional reads only read the zones of the region, and
+    the monthly series of a point or region are read across all months at once.
+
+    """
+
+    def __init__(self, path, slice_cache_size=24, series_cache_size=256):
+
+        from netCDF4 import Dataset, num2date
+
+        self.path = path
+        self.dataset = Dataset(path)
+        self.slice_cache_size = slice_cache_size
+        self.series_cache_size = series_cache_size
+        self.slices = OrderedDict()
+        self.regions = OrderedDict()
+        self.series = OrderedDict()
+
+        ## Gathering lat and lons once, with a meshgrid so that the borders of the 2x2 deg zones can be created
+        self.lat = self.dataset.variables['lat'][:]
+        self.lon = self.dataset.variables['lon'][:]
+        self.lon_grid, self.lat_grid = np.meshgrid(self.lon, self.lat)
+
+        ## Every time step is dated on the 15th of its month, so the year and month identify a slice
+        time = self.dataset.variables['time']
+        dates = num2date(time[:], time.units, getattr(time, 'calendar', 'standard'))
+        self.time_index = {(date.year, date.month): t for t, date in enumerate(dates)}
+
+        ## Row (year) and column (month) of every time step in the Year x Month layout of the series
+        self.time_years = np.array([date.year for date in dates], dtype=np.int64)
+        self.time_months = np.array([date.month for date in dates], dtype=np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def index(self, year, month):
+
+        """
+        Returns the time index of a year and month. The month is either its name or its number.
+        """
+
+        if isinstance(month, str):
+            month = MONTH_NUMBERS[month]
+        try:
+            return self.time_index[(int(year), int(month))]
+        except KeyError:
+            raise KeyError('No anomalies for ' + str(year) + '-' + str(month) + ' in ' + self.path) from None
+
+    def read_slice(self, year, month):
+
+        """
+        Reads the temperature anomalies of one month. Only that time step is read from the file and recently read
+        slices are served from memory.
+
+        Inputs:
+        year (integer): the year of the average temperature anomalies to be pulled
+
+        month (string or integer): the month pertaining to the average temperature anomalies
+
+        Returns:
+        (masked array) - anomalies in degrees C on the (lat, lon) grid, masked where there is no data.
+
+        """
+
+        t = self.index(year, month)
+        if t in self.slices:
+            self.slices.move_to_end(t)
+            return self.slices[t]
+
+        anomaly = self.dataset.variables['tempanomaly'][t]
+        self.slices[t] = anomaly
+        if len(self.slices) > self.slice_cache_size:
+            self.slices.popitem(last=False)
+        return anomaly
+
+    def region_slices(self, region):
+
+        """
+        Converts a region into the index slices of the zones overlapping it.
+
+        Inputs:
+        region (string or tuple): name of a region of REGIONS or a (lon_min, lat_min, lon_max, lat_max) bounding box.
+        None for the whole globe.
+
+        Returns:
+        lat_slice (slice), lon_slice (slice) - the rows and columns of the region on the grid.
+
+        """
+
+        try:
+            return grid_slices(self.lat, self.lon, region)
+        except ValueError as error:
+            raise ValueError(str(error) + ' of ' + self.path) from None
+
+    def region_grid(self, region=None, step=1):
+
+        """
+        Returns the latitudes and longitudes of the zones (or of the blocks of zones for step > 1) of a region.
+        """
+
+        lat_slice, lon_slice = self.region_slices(region)
+        return block_centers(self.lat[lat_slice], step), block_centers(self.lon[lon_slice], step)
+
+    def read_region(self, year, month, region=None, step=1):
+
+        """
+        Reads the temperature anomalies of one month within a region, optionally downsampled. Only the zones of the
+        region are read from the netCDF variable, unless the whole slice of the month is already in memory, and the
+        region of every month is kept in memory like the slices. The zones of the file are stored in chunks, so how
+        much of a slice is decompressed depends on the chunking of the file, but the copies, downsampling and
+        drawing only touch the region.
+
+        Inputs:
+        year (integer), month (string or integer): the month read.
+
+        region (string or tuple): name of a region of REGIONS or a (lon_min, lat_min, lon_max, lat_max) bounding box.
+        None for the whole globe.
+
+        step (integer): level of detail, the size of the blocks of zones averaged together (see block_mean).
+
+        Returns:
+        (masked array) - anomalies in degrees C on the grid given by region_grid, masked where there is no data.
+
+        """
+
+        if region is None and step == 1:
+            return self.read_slice(year, month)
+        t = self.index(year, month)
+        lat_slice, lon_slice = self.region_slices(region)
+        key = (t, lat_slice.start, lat_slice.stop, lon_slice.start, lon_slice.stop, step)
+        if key in self.regions:
+            self.regions.move_to_end(key)
+            return self.regions[key]
+
+        if t in self.slices:
+            field = self.slices[t][lat_slice, lon_slice]
+        else:
+            field = self.dataset.variables['tempanomaly'][t, lat_slice, lon_slice]
+        field = block_mean(field, step)
+        self.regions[key] = field
+        if len(self.regions) > self.slice_cache_size:
+            self.regions.popitem(last=False)
+        return field
+
+    def zone_index(self, lat, lon):
+
+        """
+        Returns the (lat index, lon index) of the zone holding a point given in degrees.
+        """
+
+        indexes = []
+        for centers, value in [(self.lat, lat), (self.lon, lon)]:
+            centers = np.asarray(centers, dtype=float)
+            half = np.abs(np.diff(centers)).min() / 2 if len(centers) > 1 else 180
+            i = int(np.abs(centers - value).argmin())
+            if not abs(centers[i] - value) <= half:
+                raise ValueError('The point (' + str(lat) + ', ' + str(lon) + ') is outside the grid of ' + self.path)
+            indexes.append(i)
+        return indexes[0], indexes[1]
+
+    def cache_series(self, key, monthly):
+        self.series[key] = monthly
+        if len(self.series) > self.series_cache_size:
+            self.series.popitem(last=False)
+        return monthly
+
+    def series_frame(self, monthly):
+
+        """
+        Lays out one value per time step as a DataFrame with a Year column and a column per month, the layout of
+        parse_climate_data without the station ID. Months missing from the file or without data are NaN.
+        """
+
+        import pandas as pd
+        from climate_records import MONTHS
+
+        first_year = self.time_years.min()
+        table = np.full((self.time_years.max() - first_year + 1, 12), np.nan)
+        table[self.time_years - first_year, self.time_months - 1] = np.ma.filled(monthly.astype(float), np.nan)
+        data = {'Year': np.arange(first_year, first_year + len(table), dtype=np.int64)}
+        data.update(zip(MONTHS, table.T))
+        return pd.DataFrame(data)
+
+    def point_series(self, lat, lon):
+
+        """
+        Reads the temperature anomalies of the zone holding a point for every month of the file, in a single strided
+        read of the tempanomaly[:, j, i] column. Series are kept in memory per zone.
+
+        Inputs:
+        lat (float), lon (float): the point in degrees, e.g. a station's coordinates.
+
+        Returns:
+        (df) - A DataFrame with the year and the anomaly (degrees C) of every month, NaN where there is no data.
+
+        """
+
+        j, i = self.zone_index(lat, lon)
+        key = ('point', j, i)
+        if key in self.series:
+            self.series.move_to_end(key)
+            return self.series_frame(self.series[key])
+        return self.series_frame(self.cache_series(key, self.dataset.variables['tempanomaly'][:, j, i]))
+
+    def region_mean_series(self, region, area_weighted=True):
+
+        """
+        Averages the temperature anomalies of a region for every month of the file. The box of zones is read across
+        all months in a single read for regions of up to SERIES_READ_ZONES zone values, and in blocks of months for
+        larger ones. Series are kept in memory per region.
+
+        Inputs:
+        region (string or tuple): name of a region of REGIONS or a (lon_min, lat_min, lon_max, lat_max) bounding box.
+
+        area_weighted (boolean): weight every zone by the cosine of its latitude, proportional to its area. A plain
+        mean of the zones otherwise.
+
+        Returns:
+        (df) - A DataFrame with the year and the mean anomaly (degrees C) of every month, NaN where no zone of the
+        region has data.
+
+        """
+
+        lat_slice, lon_slice = self.region_slices(region)
+        key = ('region', lat_slice.start, lat_slice.stop, lon_slice.start, lon_slice.stop, bool(area_weighted))
+        if key in self.series:
+            self.series.move_to_end(key)
+            return self.series_frame(self.series[key])
+
+        lat = np.asarray(self.lat[lat_slice], dtype=float)
+        weights = np.cos(np.radians(lat)) if area_weighted else np.ones(len(lat))
+        weights = np.repeat(weights[:, None], lon_slice.stop - lon_slice.start, axis=1)
+
+        variable = self.dataset.variables['tempanomaly']
+        steps = variable.shape[0]
+        months_per_read = max(1, SERIES_READ_ZONES // weights.size)
+        total = np.zeros(steps)
+        weight = np.zeros(steps)
+        for start in range(0, steps, months_per_read):
+            block = variable[start:start + months_per_read, lat_slice, lon_slice]
+            valid = ~np.ma.getmaskarray(block)
+            total[start:start + len(block)] = (np.ma.filled(block.astype(float), 0) * weights).sum(axis=(1, 2))
+            weight[start:start + len(block)] = (valid * weights).sum(axis=(1, 2))
+        monthly = np.ma.masked_array(total / np.maximum(weight, 1e-12), mask=weight == 0)
+        return self.series_frame(self.cache_series(key, monthly))
+
+    def months(self, start_year, end_year):
+
+        """
+        Returns the (time index, year, month) of every month available between two years, in time order.
+        """
+
+        return sorted((t, year, month) for (year, month), t in self.time_index.items()
+                      if start_year <= year <= end_year)
+
+    def read_block(self, t_start, t_stop, region=None, step=1):
+
+        """
+        Reads the anomalies of consecutive time steps t_start..t_stop-1 in a single read, for streaming many months,
+        optionally limited to a region and downsampled as in read_region.
+
+        Returns:
+        (masked array) - anomalies of shape (time steps, lat, lon).
+
+        """
+
+        if region is None:
+            block = self.dataset.variables['tempanomaly'][t_start:t_stop]
+        else:
+            lat_slice, lon_slice = self.region_slices(region)
+            block = self.dataset.variables['tempanomaly'][t_start:t_stop, lat_slice, lon_slice]
+        return block_mean(block, step)
+
+    def close(self):
+        self.slices.clear()
+        self.regions.clear()
+        self.series.clear()
+        if self.dataset.isopen():
+            self.dataset.close()
+        return
+
+
+## The anomaly file is opened once and shared by every call
+_open_datasets = {}
+
+def open_anomaly_dataset(path=None):
+
+    """
+    Returns the shared handle on an anomaly file, opening it on first use.
+
+    Inputs:
+    path (string): path of the netCDF file. Defaults to gistemp1200_GHCNv4_ERSSTv5.nc in the working directory.
+
+    Returns:
+    (AnomalyDataset) - the opened dataset.
+
+    """
+
+    if path is None:
+        path = os.getcwd() + '/gistemp1200_GHCNv4_ERSSTv5.nc'
+    if path not in _open_datasets:
+        _open_datasets[path] = AnomalyDataset(path)
+    return _open_datasets[path]
+
+
+def close_anomaly_datasets():
+
+    """
+    Closes every shared anomaly file handle.
+    """
+
+    for dataset in _open_datasets.values():
+        dataset.close()
+    _open_datasets.clear()
+    return
+
+
+def export_anomaly_zarr(path, dataset=None, chunks=(12, 45, 90)):
+
+    """
+    Writes the anomaly cube of a netCDF file as a chunked Zarr group, for readers that only fetch the chunks of the
+    months and zones they ask for (see read_anomaly_zarr). The anomalies are kept as the int16 hundredths of a
+    degree of the GISTEMP file, and the year and month of every time step are stored next to them. The cube is
+    copied one block of time chunks at a time.
+
+    Inputs:
+    path (string): directory of the Zarr group. An existing group at that path is replaced.
+
+    dataset (AnomalyDataset): dataset exported. Defaults to the shared anomaly file.
+
+    chunks (tuple): chunk shape along time, lat and lon. By default a chunk holds a year of a quarter of the globe.
+
+    Returns:
+    path (string): the written directory.
+
+    """
+
+    import shutil
+    import zarr
+
+    if dataset is None:
+        dataset = open_anomaly_dataset()
+    variable = dataset.dataset.variables['tempanomaly']
+    scale = float(getattr(variable, 'scale_factor', 1.0))
+    fill = int(getattr(variable, '_FillValue', 32767))
+
+    if os.path.exists(path + '.tmp'):
+        shutil.rmtree(path + '.tmp')
+    group = zarr.open_group(path + '.tmp', mode='w')
+    group.attrs.update({'source': os.path.basename(dataset.path), 'units': 'degrees C'})
+    group.create_array('year', data=dataset.time_years.astype(np.int16))
+    group.create_array('month', data=dataset.time_months.astype(np.int8))
+    group.create_array('lat', data=np.asarray(dataset.lat, dtype=np.float32))
+    group.create_array('lon', data=np.asarray(dataset.lon, dtype=np.float32))
+    anomalies = group.create_array('tempanomaly', shape=variable.shape, chunks=chunks, dtype=np.int16,
+                                   fill_value=fill, attributes={'scale_factor': scale},
+                                   dimension_names=['time', 'lat', 'lon'])
+    for start in range(0, variable.shape[0], chunks[0]):
+        block = variable[start:start + chunks[0]]
+        anomalies[start:start + len(block)] = np.ma.filled(np.round(block / scale), fill).astype(np.int16)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_anomaly_zarr(path, start_year=None, end_year=None, months=None, region=None):
+
+    """
+    Reads the anomalies of some months and a region from a Zarr cube written by export_anomaly_zarr. The months and
+    zones are selected before reading, so only the chunks holding them are fetched and decompressed.
+
+    Inputs:
+    path (string): directory of the Zarr group.
+
+    start_year (integer), end_year (integer): first and last year kept. Default to the whole record.
+
+    months (list): month names or numbers kept. Defaults to all twelve.
+
+    region (string or tuple): name of a region of REGIONS or a (lon_min, lat_min, lon_max, lat_max) bounding box.
+    None for the whole globe.
+
+    Returns:
+    (AnomalyCube) - year and month of every time step kept, the lat and lon of the zones, and the anomalies in
+    degrees C as a masked array of shape (time steps, lat, lon).
+
+    """
+
+    import zarr
+
+    group = zarr.open_group(path, mode='r')
+    years, month_numbers = group['year'][:], group['month'][:]
+    keep = np.ones(len(years), dtype=bool)
+    if start_year is not None:
+        keep &= years >= start_year
+    if end_year is not None:
+        keep &= years <= end_year
+    if months is not None:
+        keep &= np.isin(month_numbers, [MONTH_NUMBERS[month] if isinstance(month, str) else int(month)
+                                        for month in months])
+    steps = np.nonzero(keep)[0]
+
+    lat, lon = group['lat'][:], group['lon'][:]
+    lat_slice, lon_slice = grid_slices(lat, lon, region)
+    anomalies = group['tempanomaly']
+    if len(steps) and steps[-1] - steps[0] + 1 == len(steps):
+        raw = anomalies[steps[0]:steps[-1] + 1, lat_slice, lon_slice]
+    else:
+        raw = anomalies.oindex[steps, lat_slice, lon_slice]
+    values = np.ma.masked_array(raw * anomalies.attrs.get('scale_factor', 1.0), mask=raw == anomalies.fill_value)
+    return AnomalyCube(years[steps], month_numbers[steps], lat[lat_slice], lon[lon_slice], values)
+
+
+def write_synthetic_gistemp(path, start_year=1880, end_year=2021, seed=0):
+
+    """
+    Writes a small netCDF file with the same schema as gistemp1200_GHCNv4_ERSSTv5.nc (2x2 degree lat/lon zones,
+    monthly time steps on the 15th in days since 1800-01-01, and int16 tempanomaly scaled by 0.01 with a fill value)
+    filled with a reproducible warming pattern. The real file is not shipped with the repository, so this is what
+    tests and benchmarks run against.
+
+    Inputs:
+    path (string): where the file is written.
+
+    start_year (integer), end_year (integer): first and last year of monthly time steps.
+
+    seed (integer): seed of the random noise and of the zones left without data.
+
+    Returns:
+    path (string): the written file.
+
+    """
+
+    from datetime import datetime
+    from netCDF4 import Dataset, date2num
+
+    rng = np.random.default_rng(seed)
+    lat = np.arange(-89, 90, 2, dtype=np.float32)
+    lon = np.arange(-179, 180, 2, dtype=np.float32)
+    dates = [datetime(year, month, 15) for year in range(start_year, end_year + 1) for month in range(1, 13)]
+
+    with Dataset(path, 'w') as nc:
+        nc.title = 'Synthetic GISTEMP Surface Temperature Analysis'
+        nc.createDimension('lat', len(lat))
+        nc.createDimension('lon', len(lon))
+        nc.createDimension('time', None)
+        nc.createDimension('nv', 2)
+
+        nc.createVariable('lat', 'f4', ('lat',))[:] = lat
+        nc.createVariable('lon', 'f4', ('lon',))[:] = lon
+        nc.variables['lat'].units = 'degrees_north'
+        nc.variables['lon'].units = 'degrees_east'
+
+        time = nc.createVariable('time', 'i4', ('time',))
+        time.units = 'days since 1800-01-01 00:00:00'
+        time.calendar = 'standard'
+        time[:] = date2num(dates, time.units, time.calendar)
+        time_bnds = nc.createVariable('time_bnds', 'i4', ('time', 'nv'))
+        time_bnds[:] = np.column_stack([time[:] - 14, time[:] + 14])
+
+        tempanomaly = nc.createVariable('tempanomaly', 'i2', ('time', 'lat', 'lon'), fill_value=32767,
+                                        chunksizes=(1, len(lat), len(lon)))
+        tempanomaly.scale_factor = 0.01
+        tempanomaly.units = 'K'
+        tempanomaly.long_name = 'Surface temperature anomaly'
+
+        ## Warming grows with time and towards the poles, and some zones are left empty like unobserved regions
+        no_data = rng.random((len(lat), len(lon))) < 0.05
+        polar = 1 + np.abs(lat[:, None] / 90) * np.ones(len(lon))
+        for t, date in enumerate(dates):
+            trend = (date.year - 1950) / 50
+            field = trend * polar + rng.normal(0, 0.5, (len(lat), len(lon)))
+            tempanomaly[t] = np.ma.masked_array(np.round(field, 2), mask=no_data)
+
+    return path
+
+
+## Testing functionality
+def test_anomaly_dataset(tmp_path, monkeypatch):
+
+    import sys
+    import pandas as pd
+    from netCDF4 import Dataset, date2index
+    from datetime import datetime
+
+    path = write_synthetic_gistemp(str(tmp_path) + '/gistemp_synthetic.nc', 2000, 2002)
+    with AnomalyDataset(path, slice_cache_size=2) as dataset:
+        assert dataset.lat_grid.shape == (90, 180)
+        assert dataset.index(2001, 'March') == 14
+
+        ## The time index dictionary agrees with date2index, which the original function used
+        with Dataset(path) as nc:
+            expected = nc.variables['tempanomaly'][date2index(datetime(2002, 7, 15), nc.variables['time'])]
+        np.testing.assert_array_equal(dataset.read_slice(2002, 'July'), expected)
+        assert dataset.read_slice(2002, 7) is dataset.read_slice(2002, 'July')
+
+        ## Only slice_cache_size slices are kept
+        dataset.read_slice(2000, 1)
+        dataset.read_slice(2000, 2)
+        assert list(dataset.slices) == [0, 1]
+
+        ## A region only reads its own zones, and agrees with the same zones of the whole slice
+        lat_slice, lon_slice = dataset.region_slices('CONUS')
+        conus = dataset.read_region(2002, 'July', 'CONUS')
+        lat, lon = dataset.region_grid('CONUS')
+        assert conus.shape == (len(lat), len(lon)) == (13, 30)
+        assert (lat.min(), lat.max(), lon.min(), lon.max()) == (25, 49, -125, -67)
+        dataset.slices.clear()
+        np.testing.assert_array_equal(dataset.read_region(2001, 1, (-125, 24, -66, 50)),
+                                      dataset.read_slice(2001, 1)[lat_slice, lon_slice])
+        assert dataset.read_region(2002, 'July', 'CONUS') is conus
+        assert dataset.region_slices('-125,24,-66,50') == (lat_slice, lon_slice)
+
+        ## Block means skip masked zones and mask blocks without data
+        field = np.ma.masked_array(np.arange(12.0).reshape(3, 4), mask=[[1, 0, 0, 0], [0, 0, 0, 0], [1, 1, 0, 0]])
+        blocks = block_mean(field, 2)
+        assert blocks.shape == (2, 2) and blocks[0, 0] == (1 + 4 + 5) / 3 and blocks[1, 0] is np.ma.masked
+        overview = dataset.read_region(2002, 'July', step=3)
+        assert overview.shape == (30, 60) and len(dataset.region_grid(step=3)[0]) == 30
+        t = dataset.index(2002, 7)
+        np.testing.assert_array_equal(dataset.read_block(t, t + 1, 'CONUS')[0], conus)
+        np.testing.assert_array_equal(dataset.read_block(t, t + 1, step=3)[0], overview)
+
+        ## A point series holds the zone's value of every month in the Year x Month layout
+        raleigh = dataset.point_series(35.8, -78.6)
+        assert list(raleigh.columns[:2]) == ['Year', 'January'] and raleigh['Year'].tolist() == [2000, 2001, 2002]
+        j, i = dataset.zone_index(35.8, -78.6)
+        assert (dataset.lat[j], dataset.lon[i]) == (35, -79)
+        assert np.isclose(raleigh.loc[2, 'July'], np.ma.filled(dataset.read_slice(2002, 7)[j, i], np.nan),
+                          equal_nan=True)
+        assert ('point', j, i) in dataset.series
+
+        ## Area weighted means agree with a month averaged by hand, and the series is read once
+        conus_mean = dataset.region_mean_series('CONUS')
+        field = dataset.read_region(2001, 1, 'CONUS')
+        weights = np.cos(np.radians(lat))[:, None] * ~np.ma.getmaskarray(field)
+        assert np.isclose(conus_mean.loc[1, 'January'], (np.ma.filled(field, 0) * weights).sum() / weights.sum())
+        plain = dataset.region_mean_series('CONUS', area_weighted=False)
+        assert np.isclose(plain.loc[1, 'January'], field.mean())
+        assert len(dataset.series) == 3
+        dataset.region_mean_series('CONUS')
+        assert len(dataset.series) == 3
+
+        ## Large regions are read a block of months at a time with the same result
+        whole = dataset.region_mean_series('Global')
+        dataset.series.clear()
+        monkeypatch.setattr(sys.modules[__name__], 'SERIES_READ_ZONES', 5 * 90 * 180)
+        pd.testing.assert_frame_equal(dataset.region_mean_series('Global'), whole)
+
+        ## The Zarr cube gives back the same anomalies for any selection of months and zones
+        zarr_path = export_anomaly_zarr(str(tmp_path) + '/anomalies.zarr', dataset, chunks=(12, 30, 60))
+        cube = read_anomaly_zarr(zarr_path, 2001, 2002, ['July'], 'CONUS')
+        assert cube.years.tolist() == [2001, 2002] and cube.months.tolist() == [7, 7]
+        assert cube.anomalies.shape == (2, 13, 30) and cube.lat[0] == 25
+        np.testing.assert_allclose(cube.anomalies[1].filled(np.nan), conus.filled(np.nan), atol=1e-6)
+        assert np.array_equal(cube.anomalies.mask[1], np.ma.getmaskarray(conus))
+        whole = read_anomaly_zarr(zarr_path)
+        assert whole.anomalies.shape == (36, 90, 180)
+        np.testing.assert_allclose(whole.anomalies.filled(np.nan), dataset.read_block(0, 36).filled(np.nan),
+                                   atol=1e-6)
+
+    assert not dataset.dataset.isopen()
+    return
@@ -0,0 +1,293 @@
+import io
+
+import numpy as np
+
+from anomaly_dataset import MONTH_NUMBERS, open_anomaly_dataset, region_bounds
+from instrumentation import span
+
+MONTH_NAMES = {number: name for name, number in MONTH_NUMBERS.items()}
+
+
+class AnomalyMapRenderer:
+
+    """
+    Persistent global temperature anomalies map. The Basemap projection, the bluemarble background, the coastlines,
+    the colorbar and the anomaly mesh are built once. Showing another month only swaps the data of the existing
+    pcolormesh and the title: the static part of the figure is kept as a saved background and only the mesh,
+    coastlines and title are redrawn on top of it (matplotlib blitting).
+
+    A renderer can also show a region (e.g. CONUS) or an overview at a lower level of detail. The map is then limited
+    to the region and the mesh only holds the zones (or blocks of zones) of the region, so reading and drawing a
+    month scales with the area of the region.
+
+    """
+
+    def __init__(self, dataset=None, headless=False, background=True, figsize=(18, 10), region=None, step=1):
+
+        """
+        Inputs:
+        dataset (AnomalyDataset): dataset the anomalies are read from. Defaults to the shared anomaly file.
+
+        headless (boolean): draw on an Agg canvas that is never shown, for batch rendering without a display.
+
+        background (boolean): whether to draw the bluemarble background.
+
+        figsize (tuple): figure size in inches.
+
+        region (string or tuple): name of a region of anomaly_dataset.REGIONS or a (lon_min, lat_min, lon_max,
+        lat_max) bounding box. The whole globe by default.
+
+        step (integer): level of detail, the size of the blocks of zones averaged together.
+
+        """
+
+        from mpl_toolkits.basemap import Basemap
+
+        self.dataset = dataset if dataset is not None else open_anomaly_dataset()
+        self.headless = headless
+        self.region = region
+        self.step = step
+
+        ## Create figure
+        if headless:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.fig = Figure(figsize=figsize)
+            FigureCanvasAgg(self.fig)
+        else:
+            import matplotlib.pyplot as plt
+            self.fig = plt.figure(figsize=figsize)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+
+        ## Create the basemap projection that will hold the data
+        if region is None:
+            self.m = Basemap(projection='cyl', resolution='c', lat_0=0, lon_0=0, ax=self.ax)
+        else:
+            lon_min, lat_min, lon_max, lat_max = region_bounds(region)
+            self.m = Basemap(projection='cyl', resolution='c', llcrnrlon=lon_min, llcrnrlat=lat_min,
+                             urcrnrlon=lon_max, urcrnrlat=lat_max, ax=self.ax)
+        if background:
+            self.m.bluemarble(scale=0.5, ax=self.ax)
+
+        ## Map the anomalies based upon zone. The mesh starts out empty and is filled by render.
+        if region is None and step == 1:
+            lon_grid, lat_grid = self.dataset.lon_grid, self.dataset.lat_grid
+        else:
+            lat, lon = self.dataset.region_grid(region, step)
+            lon_grid, lat_grid = np.meshgrid(lon, lat)
+        empty = np.ma.masked_all(lat_grid.shape)
+        self.mesh = self.m.pcolormesh(lon_grid, lat_grid, empty,
+                                      latlon=True, cmap='RdBu_r', ax=self.ax)
+        self.mesh.set_clim(-8, 8) # Colorbar limits
+        self.coastlines = self.m.drawcoastlines(color='lightgray', ax=self.ax)
+        self.title = self.ax.set_title('', fontsize=16)
+
+        ## Create colorbar and bold title
+        cb = self.fig.colorbar(self.mesh, ax=self.ax)
+        cb.set_label(label='Temperature Anomaly (°C)', weight='bold')
+
+        ## The artists that change between months are animated, so they are left out of the saved background
+        self.animated = [self.mesh, self.coastlines, self.title]
+        for artist in self.animated:
+            artist.set_animated(True)
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.fig.canvas.draw()
+
+    def _on_draw(self, event):
+
+        """
+        Saves the static part of the figure after every full draw (first draw, resizes) and redraws the changing
+        artists on top of it.
+        """
+
+        canvas = self.fig.canvas
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self):
+        for artist in self.animated:
+            self.fig.draw_artist(artist)
+
+    def set_field(self, field, title):
+
+        """
+        Replaces the anomalies shown by the mesh and the title, redrawing only those on top of the saved background.
+
+        Inputs:
+        field (masked array): anomalies on the (lat, lon) grid of the renderer's region and level of detail.
+
+        title (string): new figure title.
+
+        """
+
+        canvas = self.fig.canvas
+        self.mesh.set_array(field)
+        self.title.set_text(title)
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.fig.bbox)
+        if not self.headless:
+            canvas.flush_events()
+        return
+
+    def render(self, year, month):
+
+        """
+        Shows the temperature anomalies of a year and month.
+
+        Inputs:
+        year (integer): the year of the average temperature anomalies to be pulled
+
+        month (string or integer): the month pertaining to the average temperature anomalies desired for said month
+
+        """
+
+        month_name = MONTH_NAMES[month] if isinstance(month, (int, np.integer)) else month
+        with span('read slice'):
+            field = self.dataset.read_region(year, month, self.region, self.step)
+        with span('draw map'):
+            self.set_field(field, month_name + ' ' + str(year) + ' Temperature Anomaly' + self.region_label())
+        return
+
+    def region_label(self):
+        return ', ' + self.region if isinstance(self.region, str) else ''
+
+    def render_difference(self, year, month, reference, label='Station minus GISTEMP'):
+
+        """
+        Shows the anomalies of the renderer's dataset minus those of a reference dataset on the same grid, e.g. the
+        station anomalies gridded by station_gridding.py minus GISTEMP. Zones without data in either are left empty.
+
+        Inputs:
+        year (integer), month (string or integer): the month shown.
+
+        reference (AnomalyDataset): dataset subtracted from the renderer's dataset.
+
+        label (string): description of the difference used in the title.
+
+        """
+
+        if reference.lat_grid.shape != self.dataset.lat_grid.shape:
+            raise ValueError('The reference dataset ' + reference.path + ' is not on the grid of ' + self.dataset.path)
+        month_name = MONTH_NAMES[month] if isinstance(month, (int, np.integer)) else month
+        field = (self.dataset.read_region(year, month, self.region, self.step)
+                 - reference.read_region(year, month, self.region, self.step))
+        self.set_field(field, month_name + ' ' + str(year) + ' Temperature Anomaly' + self.region_label() + ', '
+                       + label)
+        return
+
+    def to_rgba(self):
+
+        """
+        Returns a copy of the current canvas pixels as an (height, width, 4) uint8 array.
+        """
+
+        return np.asarray(self.fig.canvas.buffer_rgba()).copy()
+
+    def png_bytes(self):
+
+        """
+        Encodes the current canvas as PNG. The pixels are taken from the canvas as they are, so the animated artists
+        are included and the figure is not drawn again. No metadata is written, so equal maps give equal bytes.
+        """
+
+        from PIL import Image
+
+        with span('png encode'):
+            buffer = io.BytesIO()
+            Image.fromarray(self.to_rgba()).save(buffer, format='png')
+            return buffer.getvalue()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.png_bytes())
+        return
+
+    def show(self):
+
+        """
+        Displays the map. Headless maps are displayed as a PNG image of the current pixels, since a full redraw would
+        leave out the animated artists.
+        """
+
+        if self.headless:
+            from IPython.display import Image, display
+            display(Image(data=self.png_bytes(), format='png'))
+        else:
+            self.fig.show()
+        return
+
+    def close(self):
+        if not self.headless:
+            import matplotlib.pyplot as plt
+            plt.close(self.fig)
+        return
+
+
+## One renderer per anomaly dataset is shared by all widget callbacks
+_renderers = {}
+
+def get_anomaly_map_renderer(dataset=None, headless=None, region=None, step=1):
+
+    """
+    Returns the shared renderer of an anomaly dataset, region and level of detail, building the map on first use.
+    Unless told otherwise the renderer is headless with non interactive backends (Agg, the notebook inline backend),
+    where the map is shown as an image anyway.
+    """
+
+    if dataset is None:
+        dataset = open_anomaly_dataset()
+    if headless is None:
+        import matplotlib
+        backend = matplotlib.get_backend().lower()
+        headless = 'inline' in backend or backend == 'agg'
+    if region is not None and not isinstance(region, str):
+        region = tuple(float(value) for value in region)
+    key = (dataset.path, headless, region, step)
+    if key not in _renderers:
+        _renderers[key] = AnomalyMapRenderer(dataset, headless=headless, region=region, step=step)
+    return _renderers[key]
+
+
+## Testing functionality
+def test_anomaly_map_renderer(tmp_path):
+
+    from anomaly_dataset import AnomalyDataset, write_synthetic_gistemp
+
+    path = write_synthetic_gistemp(str(tmp_path) + '/gistemp_synthetic.nc', 2000, 2001)
+    with AnomalyDataset(path) as dataset:
+        renderer = AnomalyMapRenderer(dataset, headless=True, background=False, figsize=(6, 4))
+        mesh = renderer.mesh
+
+        renderer.render(2000, 'January')
+        january = renderer.to_rgba()
+        renderer.render(2001, 7)
+
+        ## The same mesh is reused and only its data and the title change
+        assert renderer.mesh is mesh
+        assert renderer.title.get_text() == 'July 2001 Temperature Anomaly'
+        np.testing.assert_array_equal(renderer.mesh.get_array(), dataset.read_slice(2001, 7))
+        assert not np.array_equal(renderer.to_rgba(), january)
+
+        ## Rendering the same month again gives identical pixels
+        renderer.render(2000, 'January')
+        np.testing.assert_array_equal(renderer.to_rgba(), january)
+        assert renderer.png_bytes()[:8] == b'\x89PNG\r\n\x1a\n'
+
+        ## A dataset minus itself is zero wherever it has data
+        renderer.render_difference(2001, 7, dataset, 'Difference')
+        assert np.ma.allequal(renderer.mesh.get_array(), 0)
+        assert renderer.title.get_text() == 'July 2001 Temperature Anomaly, Difference'
+
+        ## A regional map only holds the zones of the region, and an overview the block means
+        conus = AnomalyMapRenderer(dataset, headless=True, background=False, figsize=(6, 4), region='CONUS')
+        conus.render(2001, 7)
+        assert conus.title.get_text() == 'July 2001 Temperature Anomaly, CONUS'
+        np.testing.assert_array_equal(conus.mesh.get_array(), dataset.read_region(2001, 7, 'CONUS'))
+        assert conus.mesh.get_array().size == 13 * 30
+        overview = AnomalyMapRenderer(dataset, headless=True, background=False, figsize=(6, 4), step=2)
+        overview.render(2001, 7)
+        assert overview.mesh.get_array().shape == (45, 90)
+
+    return
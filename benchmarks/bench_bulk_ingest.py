@@ -0,0 +1,28 @@
+## Wall clock time of the parallel bulk ingest at 1, 2, 4 and N workers.
+#     Run from the repository root: python benchmarks/bench_bulk_ingest.py [N]
+#     N defaults to the number of CPUs. Every run writes to a fresh temporary directory so no chunk is resumed.
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bulk_ingest import bulk_ingest
+
+
+if __name__ == '__main__':
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    worker_counts = sorted({1, 2, 4, max_workers})
+
+    print('CPUs available: ' + str(os.cpu_count()))
+    baseline = None
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            bulk_ingest(output_dir=output_dir, workers=workers, progress=False)
+            elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print('%3d workers: %7.2f s  speedup %.2fx  efficiency %3.0f%%'
+              % (workers, elapsed, baseline / elapsed, 100 * baseline / elapsed / workers))
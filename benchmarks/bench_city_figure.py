@@ -0,0 +1,72 @@
+## Latency benchmark of the city time series plot: building and serializing a new figure for every change (what
+#     fig.show sends to the notebook) against updating the persistent FigureWidget in place.
+#     Run from the repository root: python benchmarks/bench_city_figure.py [repeats]
+#     The in place update size is the size of the update messages the widget sends to the frontend.
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import plotly.io as pio
+
+from analyze_city_climate_data import CityClimateFigureWidget, build_city_climate_figure
+from climate_cache import get_city_series
+
+## Alternating selections, so every step changes either the series or only the year range
+SELECTIONS = [('Dallas, TX', 'January', 1890, 2021), ('Raleigh, NC', 'Annual', 1890, 2021),
+              ('Raleigh, NC', 'Annual', 1950, 2000), ('Albany, NY', 'June', 1950, 2000)]
+
+
+def time_rebuild(repeats):
+
+    """
+    Returns the mean time in seconds and the mean JSON size in bytes of building and serializing a new figure.
+    """
+
+    start = time.perf_counter()
+    size = 0
+    for _ in range(repeats):
+        for selection in SELECTIONS:
+            size += len(pio.to_json(build_city_climate_figure(*selection), validate=False))
+    steps = repeats * len(SELECTIONS)
+    return (time.perf_counter() - start) / steps, size / steps
+
+
+def time_update(repeats):
+
+    """
+    Returns the mean time in seconds and the mean message size in bytes of updating the figure widget in place.
+    """
+
+    widget = CityClimateFigureWidget()
+    sizes = []
+
+    ## Every update message assigned to the synced traits is what travels to the frontend
+    def record_message(change):
+        if change.new is not None:
+            sizes.append(len(pio.json.to_json_plotly(change.new)))
+    widget.fig.observe(record_message, names=['_py2js_update', '_py2js_relayout', '_py2js_restyle'])
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for selection in SELECTIONS:
+            widget.update(*selection)
+    steps = repeats * len(SELECTIONS)
+    return (time.perf_counter() - start) / steps, sum(sizes) / steps
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 25
+
+    ## Warm the station cache so both sides only measure the figure work
+    for location, timescale, _, _ in SELECTIONS:
+        get_city_series(location, timescale)
+
+    rebuild_time, rebuild_size = time_rebuild(repeats)
+    update_time, update_size = time_update(repeats)
+    print('Per change (' + str(repeats * len(SELECTIONS)) + ' changes)')
+    print('  rebuild + serialize: %8.2f ms  %8.0f bytes' % (rebuild_time * 1000, rebuild_size))
+    print('  FigureWidget update: %8.2f ms  %8.0f bytes  (%.0fx faster, %.0fx smaller)'
+          % (update_time * 1000, update_size, rebuild_time / update_time, rebuild_size / update_size))
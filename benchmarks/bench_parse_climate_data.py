@@ -0,0 +1,47 @@
+## Benchmark of the vectorized parsing engine against the original read_fwf + regex parser.
+#     Run from the repository root: python benchmarks/bench_parse_climate_data.py [sample_size]
+#     The read_fwf engine is timed on a sample of files and extrapolated to the full directory, as parsing all 22,009
+#     files that way takes over half an hour.
+import glob
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_city_climate_files import parse_climate_data
+
+
+def time_per_file(filepaths, engine):
+
+    """
+    Returns the mean wall clock time in seconds needed to parse one of the given files with an engine.
+    """
+
+    start = time.perf_counter()
+    for filepath in filepaths:
+        parse_climate_data(filepath, use_archive=False, engine=engine)
+    return (time.perf_counter() - start) / len(filepaths)
+
+
+if __name__ == '__main__':
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    filepaths = sorted(glob.glob(os.getcwd() + '/CONUS_city_climate_stats/*.FLs.52j.tavg'))
+    random.seed(0)
+    sample = random.sample(filepaths, min(sample_size, len(filepaths)))
+
+    fwf_time = time_per_file(sample, 'fwf')
+    numpy_time = time_per_file(sample, 'numpy')
+    print('Per file (' + str(len(sample)) + ' file sample)')
+    print('  read_fwf + regex: %8.3f ms' % (fwf_time * 1000))
+    print('  vectorized:       %8.3f ms  (%.0fx faster)' % (numpy_time * 1000, fwf_time / numpy_time))
+
+    start = time.perf_counter()
+    for filepath in filepaths:
+        parse_climate_data(filepath, use_archive=False, engine='numpy')
+    all_numpy_time = time.perf_counter() - start
+    print('All ' + str(len(filepaths)) + ' files')
+    print('  read_fwf + regex: %8.1f s   (extrapolated)' % (fwf_time * len(filepaths)))
+    print('  vectorized:       %8.1f s   (%.0fx faster)' % (all_numpy_time, fwf_time * len(filepaths) / all_numpy_time))
@@ -0,0 +1,120 @@
+## Load test of the HTTP service in climate_service.py: starts the service in its own process and sends a mix of
+#     station series, climatology, anomaly map and tile requests over concurrent keep-alive connections, then reports
+#     the p50/p99 latency of every kind of request and the throughput.
+#     Run from the repository root: python benchmarks/bench_service.py [--requests 2000] [--concurrency 32]
+#     Without the GISTEMP file in the working directory a synthetic anomaly file is served instead.
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from climate_records import TIMESCALES
+
+LOCATIONS = ['Raleigh, NC', 'Dallas, TX', 'Albany, NY', 'Kansas City, MO', 'Tallahassee, FL']
+
+
+def request_mix(n, seed=0):
+
+    """
+    Returns n (kind, target) requests: mostly station series and tiles, as a dashboard would send them, with a few
+    climatology lookups and whole maps. Tiles and months repeat, as they do when several users pan the same map.
+    """
+
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(n):
+        draw = rng.random()
+        if draw < 0.4:
+            location = urllib.parse.quote(rng.choice(LOCATIONS))
+            requests.append(('series', '/stations/' + location + '/series?timescale=' + rng.choice(TIMESCALES)))
+        elif draw < 0.5:
+            location = urllib.parse.quote(rng.choice(LOCATIONS))
+            requests.append(('climatology', '/stations/' + location + '/climatology?timescale='
+                             + rng.choice(TIMESCALES)))
+        elif draw < 0.95:
+            z = rng.randint(0, 3)
+            requests.append(('tile', '/anomalies/%d/%d/%d/%d/%d.png' % (rng.randint(2000, 2003), rng.randint(1, 12),
+                                                                        z, rng.randrange(2 ** z), rng.randrange(2 ** z))))
+        else:
+            requests.append(('map', '/anomalies/%d/%d.png' % (rng.randint(2000, 2003), rng.randint(1, 12))))
+    return requests
+
+
+async def client(port, queue, latencies):
+
+    """
+    Sends requests from the queue one after the other over a single keep-alive connection.
+    """
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    while not queue.empty():
+        kind, target = queue.get_nowait()
+        start = time.perf_counter()
+        writer.write(('GET ' + target + ' HTTP/1.1\r\nHost: localhost\r\n\r\n').encode())
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        await reader.readexactly(length)
+        status = int(head.split(b' ', 2)[1])
+        latencies.setdefault(kind if status == 200 else kind + ' (' + str(status) + ')', []).append(
+            time.perf_counter() - start)
+    writer.close()
+    return
+
+
+async def load_test(port, requests, concurrency):
+    queue = asyncio.Queue()
+    for item in requests:
+        queue.put_nowait(item)
+    latencies = {}
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, queue, latencies) for _ in range(concurrency)])
+    return latencies, time.perf_counter() - start
+
+
+def report(latencies, seconds):
+    print('%-14s %8s %10s %10s %10s' % ('request', 'count', 'p50 ms', 'p99 ms', 'max ms'))
+    for kind, values in sorted(latencies.items()) + [('all', sum(latencies.values(), []))]:
+        values = np.array(values) * 1000
+        print('%-14s %8d %10.2f %10.2f %10.2f' % (kind, len(values), np.percentile(values, 50),
+                                                   np.percentile(values, 99), values.max()))
+    total = sum(len(values) for values in latencies.values())
+    print('%d requests in %.2f s: %.0f requests/s' % (total, seconds, total / seconds))
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--anomalies', help='netCDF anomaly file (default: the GISTEMP file or a synthetic one)')
+    args = parser.parse_args()
+
+    anomalies = args.anomalies
+    if anomalies is None and not os.path.exists(os.getcwd() + '/gistemp1200_GHCNv4_ERSSTv5.nc'):
+        from anomaly_dataset import write_synthetic_gistemp
+        anomalies = write_synthetic_gistemp(tempfile.mkdtemp() + '/gistemp_synthetic.nc')
+
+    command = [sys.executable, 'climate_service.py', '--port', '0'] + (['--anomalies', anomalies] if anomalies else [])
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().strip().rsplit(':', 1)[1])
+        requests = request_mix(args.requests)
+
+        ## The first pass fills the service's caches, the second measures the steady state
+        for name in ['cold', 'warm']:
+            print('\n' + name + ' (' + str(args.concurrency) + ' connections)')
+            report(*asyncio.run(load_test(port, requests, args.concurrency)))
+    finally:
+        server.terminate()
+        server.wait()
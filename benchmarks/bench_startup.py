@@ -0,0 +1,129 @@
+## Startup benchmark: the wall clock time of "python climviz.py --help" against its budget, the import time of
+#     every module of the project measured with python -X importtime in a fresh interpreter, and the notebook cold
+#     start: time to first widget and time to first plot of the widgets, with and without the background warm up.
+#     Run from the repository root: python benchmarks/bench_startup.py [repeats] [think seconds]
+#     Exits with status 1 when the command line tool starts slower than climviz.STARTUP_BUDGET_SECONDS or imports one
+#     of climviz.HEAVY_MODULES at startup.
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from climviz import HEAVY_MODULES, STARTUP_BUDGET_SECONDS
+
+MODULES = ['climviz', 'climate_records', 'station_archive', 'load_city_climate_files', 'climate_cache',
+           'city_report', 'station_export', 'analyze_city_climate_data', 'anomaly_map_renderer',
+           'Interactive_Climate_Visualization']
+
+
+def time_command(command, repeats):
+
+    """
+    Returns the median wall clock time in seconds of running a command.
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+## Cold start of a notebook widget in a fresh interpreter: the menus are shown, the user takes think seconds to
+#     choose, and the time from the selection to the plot is measured. display is replaced by a list so the widgets
+#     can be driven without a notebook frontend.
+COLD_START = '''
+import json, sys, time
+import Interactive_Climate_Visualization as icv
+shown = []
+icv.display = shown.append
+widget, selection, warm_up, think = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3] == '1', float(sys.argv[4])
+getattr(icv, widget)(warm_up=warm_up)
+time.sleep(think)
+selected = time.perf_counter()
+for dropdown, value in zip(shown[0].children[0].children, selection):
+    dropdown.value = value
+name = ('city' if 'City' in widget else 'global') + ' time to first plot'
+deadline = time.time() + 120
+while name not in icv.startup_times and time.time() < deadline:
+    time.sleep(0.01)
+report = icv.startup_report()
+report['selection to plot'] = time.perf_counter() - selected
+print(json.dumps(report))
+'''
+
+WIDGETS = {'City_Temperature_Timeseries_Analysis': ['Raleigh, NC', 'Annual', 1950, 2000],
+           'Global_Temperature_Anomalies_Analysis': [1979, 'November']}
+
+
+def cold_start(widget, warm_up, think):
+
+    """
+    Returns the startup milestones of a widget in a fresh interpreter, see COLD_START.
+    """
+
+    stdout = subprocess.run([sys.executable, '-c', COLD_START, widget, json.dumps(WIDGETS[widget]),
+                             '1' if warm_up else '0', str(think)], capture_output=True, text=True, check=True).stdout
+    return json.loads(stdout.strip().splitlines()[-1])
+
+
+def import_time(module):
+
+    """
+    Returns the cumulative import time in seconds of a module in a fresh interpreter, as reported by -X importtime.
+    """
+
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module], capture_output=True,
+                            text=True, check=True).stderr
+    for line in stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    return float('nan')
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    think = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+
+    bare = time_command([sys.executable, '-c', 'pass'], repeats)
+    startup = time_command([sys.executable, 'climviz.py', '--help'], repeats)
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, climviz; print(",".join(m for m in '
+                             'climviz.HEAVY_MODULES if m in sys.modules))'],
+                            capture_output=True, text=True, check=True).stdout.strip()
+
+    print('Startup (median of %d runs)' % repeats)
+    print('  python -c pass:          %8.1f ms' % (bare * 1000))
+    print('  python climviz.py --help: %7.1f ms  (budget %.0f ms)' % (startup * 1000, STARTUP_BUDGET_SECONDS * 1000))
+    print('  heavy modules at startup: ' + (loaded or 'none'))
+    print('Import time (cumulative, fresh interpreter)')
+    for module in MODULES:
+        try:
+            print('  %-36s %8.1f ms' % (module, import_time(module) * 1000))
+        except subprocess.CalledProcessError:
+            print('  %-36s %8s' % (module, 'failed'))
+
+    print('Notebook cold start (user choosing for %.1f s)' % think)
+    for widget in WIDGETS:
+        if 'Global' in widget and not os.path.exists(os.getcwd() + '/gistemp1200_GHCNv4_ERSSTv5.nc'):
+            print('  ' + widget + ': skipped, gistemp1200_GHCNv4_ERSSTv5.nc is not available')
+            continue
+        name = 'city' if 'City' in widget else 'global'
+        for warm_up in [True, False]:
+            try:
+                report = cold_start(widget, warm_up, think)
+            except subprocess.CalledProcessError as error:
+                print('  %s: failed\n%s' % (widget, error.stderr))
+                continue
+            print('  %-8s warm up %-3s  first widget %7.1f ms  first plot %7.1f ms  selection to plot %7.1f ms'
+                  % (name, 'on' if warm_up else 'off', report[name + ' time to first widget'] * 1000,
+                     report.get(name + ' time to first plot', float('nan')) * 1000,
+                     report['selection to plot'] * 1000))
+
+    sys.exit(0 if startup < STARTUP_BUDGET_SECONDS and not loaded else 1)
@@ -0,0 +1,37 @@
+## Memory benchmark of the compact station layout: loads the whole station archive into a StationSeriesTable and
+#     compares its size against the same records as parse_climate_data DataFrames, plus the time taken to load the
+#     table, to expand the flags and to convert a station to degrees C.
+#     Run from the repository root after building the archive: python benchmarks/bench_station_memory.py
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from station_series import load_station_series, memory_report
+
+
+if __name__ == '__main__':
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = load_station_series()
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('Loaded %d stations in %.2f s: %.1f MB resident, %.1f MB peak while encoding the flags'
+          % (len(table), seconds, current / 2**20, peak / 2**20))
+    print('Flag table: %d combinations' % len(table.flag_table))
+
+    series = table['USC00317074']
+    for name, function in [('celsius', lambda: series.celsius), ('flags', lambda: series.flags),
+                           ('raw_frame', series.raw_frame), ('to_frame', series.to_frame)]:
+        start = time.perf_counter()
+        for _ in range(1000):
+            function()
+        print('%-10s %8.1f us' % (name, (time.perf_counter() - start) * 1000))
+
+    print()
+    print(memory_report(table).to_string(float_format='%.2f'))
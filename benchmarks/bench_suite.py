@@ -0,0 +1,264 @@
+## pytest-benchmark suite of the parse, lookup, aggregate and render paths. Fixtures are in conftest.py.
+#     Run from the repository root: python -m pytest benchmarks/bench_suite.py
+#     The results (timings and extra_info.peak_memory_bytes) are saved as JSON under benchmarks/.benchmarks, see
+#     benchmarks/pytest.ini for comparing runs across commits.
+import numpy as np
+import pytest
+
+from climate_records import MONTHS
+
+LOCATION = 'Raleigh, NC'
+
+
+## Parsing
+@pytest.mark.benchmark(group='parse one file')
+@pytest.mark.parametrize('engine', ['numpy', 'fwf'])
+def test_parse_one_file(measure, engine):
+
+    from load_city_climate_files import parse_climate_data, pull_location_file
+
+    df = measure(parse_climate_data, pull_location_file(LOCATION), use_archive=False, engine=engine)
+    assert len(df) == 131
+
+
+@pytest.mark.benchmark(group='parse one file')
+def test_parse_one_file_from_archive(measure, station_archive):
+
+    from load_city_climate_files import parse_climate_data, pull_location_file
+
+    df = measure(parse_climate_data, pull_location_file(LOCATION))
+    assert len(df) == 131
+
+
+@pytest.mark.benchmark(group='parse all files')
+def test_parse_all_files(measure, station_files):
+
+    from load_city_climate_files import parse_climate_data
+
+    def parse_all():
+        return sum(len(parse_climate_data(filepath, use_archive=False)) for filepath in station_files)
+
+    assert measure(parse_all, rounds=3) > 0
+
+
+@pytest.mark.benchmark(group='parse all files')
+def test_read_all_stations_from_archive(measure, station_archive):
+
+    from station_export import station_table
+
+    df = measure(station_table, station_archive, rounds=3)
+    assert len(df) == len(station_archive.years)
+
+
+## Lookups
+@pytest.mark.benchmark(group='lookup')
+@pytest.mark.parametrize('location', ['Kansas City, MO', 'USC00088756'])
+def test_pull_location_file(measure, station_files, location):
+
+    from load_city_climate_files import pull_location_file
+
+    assert measure(pull_location_file, location).endswith('.FLs.52j.tavg')
+
+
+@pytest.mark.benchmark(group='lookup')
+def test_build_station_registry(measure, station_files):
+
+    from station_registry import StationRegistry
+
+    assert len(measure(StationRegistry.build, rounds=5)) == len(station_files)
+
+
+## Aggregation: annual means and climatologies
+@pytest.mark.benchmark(group='aggregate')
+@pytest.mark.parametrize('timescale', ['Annual', 'July'])
+def test_compute_timescale_series(measure, timescale):
+
+    from climate_cache import compute_timescale_series
+    from load_city_climate_files import parse_climate_data, pull_location_file
+
+    df_city_data = parse_climate_data(pull_location_file(LOCATION), use_archive=False)
+    years, values, climatology = measure(compute_timescale_series, df_city_data, timescale)
+    assert len(years) == len(values) and not np.isnan(climatology)
+
+
+@pytest.mark.benchmark(group='aggregate')
+def test_get_city_series_cached(measure, station_archive):
+
+    from climate_cache import get_city_series
+
+    years, values, climatology = measure(get_city_series, LOCATION, 'Annual')
+    assert not np.isnan(climatology)
+
+
+@pytest.mark.benchmark(group='aggregate')
+def test_compute_all_station_normals(measure, station_archive):
+
+    from climatology_table import compute_station_normals
+
+    mean, std, count = measure(compute_station_normals, station_archive, (1981, 2010), rounds=3)
+    assert mean.shape == (len(station_archive.station_ids), len(MONTHS) + 1)
+
+
+## Anomaly slice reads
+@pytest.mark.benchmark(group='anomaly reads')
+def test_read_slice_uncached(measure, gistemp_path):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path, slice_cache_size=0) as dataset:
+        assert measure(dataset.read_slice, 1979, 'November').shape == (90, 180)
+
+
+@pytest.mark.benchmark(group='anomaly reads')
+def test_read_slice_cached(measure, gistemp_path):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path) as dataset:
+        assert measure(dataset.read_slice, 1979, 'November').shape == (90, 180)
+
+
+@pytest.mark.benchmark(group='anomaly reads')
+@pytest.mark.parametrize('region, step', [(None, 3), ('CONUS', 1), ('Europe', 1)])
+def test_read_region_uncached(measure, gistemp_path, region, step):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path, slice_cache_size=0) as dataset:
+        lat, lon = dataset.region_grid(region, step)
+        assert measure(dataset.read_region, 1979, 'November', region, step).shape == (len(lat), len(lon))
+
+
+@pytest.mark.benchmark(group='anomaly series')
+def test_point_series(measure, gistemp_path):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path, series_cache_size=0) as dataset:
+        assert len(measure(dataset.point_series, 35.8, -78.6)) == len(set(dataset.time_years))
+
+
+@pytest.mark.benchmark(group='anomaly series')
+@pytest.mark.parametrize('region', ['CONUS', 'Global'])
+def test_region_mean_series(measure, gistemp_path, region):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path, series_cache_size=0) as dataset:
+        assert len(measure(dataset.region_mean_series, region, rounds=5)) == len(set(dataset.time_years))
+
+
+@pytest.mark.benchmark(group='anomaly reads')
+def test_read_block_year(measure, gistemp_path):
+
+    from anomaly_dataset import AnomalyDataset
+
+    with AnomalyDataset(gistemp_path) as dataset:
+        t = dataset.index(2003, 1)
+        assert measure(dataset.read_block, t, t + 12).shape == (12, 90, 180)
+
+
+## Columnar exports: the query of one network, month and year range with the filters pushed down to the files,
+#     against reading everything and filtering in pandas
+@pytest.mark.benchmark(group='parquet query')
+def test_parquet_filtered_query(measure, station_parquet):
+
+    from station_export import read_station_parquet
+
+    df = measure(read_station_parquet, station_parquet, networks=['USW'], start_year=1950, end_year=2021,
+                 months=['July'])
+    assert set(df['Station Climate ID'].str[:3]) == {'USW'}
+
+
+@pytest.mark.benchmark(group='parquet query')
+def test_parquet_full_scan(measure, station_parquet):
+
+    from station_export import read_station_parquet
+
+    def scan():
+        df = read_station_parquet(station_parquet)
+        keep = df['Station Climate ID'].str.startswith('USW') & df['Year'].between(1950, 2021)
+        return df.loc[keep, ['Station Climate ID', 'Year', 'July']]
+
+    assert len(measure(scan, rounds=5)) > 0
+
+
+@pytest.mark.benchmark(group='zarr query')
+def test_zarr_filtered_query(measure, anomaly_zarr):
+
+    from anomaly_dataset import read_anomaly_zarr
+
+    cube = measure(read_anomaly_zarr, anomaly_zarr, 1950, 2021, ['July'], 'CONUS')
+    assert cube.anomalies.shape == (72, 13, 30)
+
+
+@pytest.mark.benchmark(group='zarr query')
+def test_zarr_full_scan(measure, anomaly_zarr):
+
+    from anomaly_dataset import read_anomaly_zarr, grid_slices
+
+    def scan():
+        cube = read_anomaly_zarr(anomaly_zarr)
+        lat_slice, lon_slice = grid_slices(cube.lat, cube.lon, 'CONUS')
+        keep = (cube.years >= 1950) & (cube.years <= 2021) & (cube.months == 7)
+        return cube.anomalies[keep][:, lat_slice, lon_slice]
+
+    assert measure(scan, rounds=5).shape == (72, 13, 30)
+
+
+## Figure construction
+@pytest.mark.benchmark(group='figures')
+def test_build_city_climate_figure(measure, station_archive):
+
+    from analyze_city_climate_data import build_city_climate_figure
+
+    fig = measure(build_city_climate_figure, LOCATION, 'Annual', 1890, 2021)
+    assert len(fig.data) == 1
+
+
+@pytest.mark.benchmark(group='figures')
+def test_update_city_figure_widget(measure, station_archive):
+
+    from analyze_city_climate_data import CityClimateFigureWidget
+
+    widget = CityClimateFigureWidget()
+    selections = iter([('Dallas, TX', 'January'), (LOCATION, 'Annual')] * 100000)
+
+    ## Every call switches the plotted series, which is the most expensive kind of update
+    def update():
+        widget.update(*next(selections), 1890, 2021)
+
+    measure(update)
+
+
+@pytest.mark.benchmark(group='figures')
+def test_render_city_png(measure, station_archive, tmp_path):
+
+    from city_report import CityPlotRenderer, station_series
+
+    renderer = CityPlotRenderer()
+    series = station_series('USC00317074', 'Annual')
+
+    def render():
+        renderer.draw(*series, LOCATION + ' Annual Average Temperature', 1890, 2021)
+        return renderer.save(str(tmp_path) + '/city.png')
+
+    measure(render, rounds=20)
+
+
+@pytest.mark.benchmark(group='figures')
+@pytest.mark.parametrize('region, step', [(None, 1), (None, 3), ('CONUS', 1)])
+def test_render_anomaly_map(measure, gistemp_path, region, step):
+
+    from anomaly_dataset import AnomalyDataset
+    from anomaly_map_renderer import AnomalyMapRenderer
+
+    with AnomalyDataset(gistemp_path) as dataset:
+        renderer = AnomalyMapRenderer(dataset, headless=True, background=False, region=region, step=step)
+
+        def render():
+            renderer.render(1979, 'November')
+            return renderer.png_bytes()
+
+        assert measure(render, rounds=20)[:4] == b'\x89PNG'
+        renderer.close()
@@ -0,0 +1,102 @@
+## Fixtures of the pytest-benchmark suite in bench_suite.py. Station fixtures come from the real
+#     CONUS_city_climate_stats files, the anomaly fixtures from a synthetic file with the GISTEMP schema.
+import glob
+import os
+import sys
+import tracemalloc
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def station_files():
+
+    """
+    Paths of every station file of the city climate directory.
+    """
+
+    filepaths = sorted(glob.glob(os.getcwd() + '/CONUS_city_climate_stats/*.FLs.52j.tavg'))
+    if not filepaths:
+        pytest.skip('CONUS_city_climate_stats is not available')
+    return filepaths
+
+
+@pytest.fixture(scope='session')
+def station_archive():
+
+    """
+    The station archive of the working directory, built when it does not exist yet.
+    """
+
+    from station_archive import build_station_archive, load_station_archive
+
+    archive = load_station_archive()
+    if archive is None:
+        build_station_archive()
+        archive = load_station_archive()
+    return archive
+
+
+@pytest.fixture(scope='session')
+def gistemp_path(tmp_path_factory):
+
+    """
+    A synthetic anomaly file with the GISTEMP schema covering 1880-2021.
+    """
+
+    from anomaly_dataset import write_synthetic_gistemp
+
+    return write_synthetic_gistemp(str(tmp_path_factory.mktemp('gistemp')) + '/gistemp_synthetic.nc')
+
+
+@pytest.fixture(scope='session')
+def station_parquet(station_archive, tmp_path_factory):
+
+    """
+    The whole station archive exported as a partitioned Parquet dataset.
+    """
+
+    from station_export import export_station_parquet
+
+    return export_station_parquet(str(tmp_path_factory.mktemp('parquet')) + '/stations.parquet', station_archive)
+
+
+@pytest.fixture(scope='session')
+def anomaly_zarr(gistemp_path, tmp_path_factory):
+
+    """
+    The synthetic anomaly file exported as a chunked Zarr group.
+    """
+
+    from anomaly_dataset import AnomalyDataset, export_anomaly_zarr
+
+    with AnomalyDataset(gistemp_path) as dataset:
+        return export_anomaly_zarr(str(tmp_path_factory.mktemp('zarr')) + '/anomalies.zarr', dataset)
+
+
+@pytest.fixture
+def measure(benchmark):
+
+    """
+    Benchmarks a function and records the peak Python heap allocation of one extra call in the saved JSON
+    (extra_info.peak_memory_bytes). NumPy reports its buffers to tracemalloc, so array allocations are included. The
+    untimed call also warms caches, so the timed rounds measure the steady state.
+
+    Pass rounds=N to time a slow function a fixed number of times instead of letting pytest-benchmark calibrate.
+    """
+
+    def run(function, *args, rounds=None, **kwargs):
+        tracemalloc.start()
+        try:
+            function(*args, **kwargs)
+            benchmark.extra_info['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        if rounds is not None:
+            return benchmark.pedantic(function, args, kwargs, rounds=rounds, iterations=1)
+        return benchmark(function, *args, **kwargs)
+
+    return run
@@ -0,0 +1,205 @@
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from climate_records import MISSING_VALUE, decode_station_records, read_record_bytes
+
+
+def _long_format_table(station_ids, years, values, flags):
+
+    """
+    Turns decoded station records into a long format Arrow table with one row per station, year and month. Missing
+    values are left out.
+    """
+
+    import pyarrow as pa
+
+    n_records = len(years)
+    present = values.ravel() != MISSING_VALUE
+
+    ## Stations and flag combinations repeat a lot, so they are dictionary encoded from their unique values instead
+    #     of converting every row to a string
+    stations, station_codes = np.unique(station_ids, return_inverse=True)
+    flag_combinations, flag_codes = np.unique(flags.reshape(-1, 3).copy().view('S3').ravel(), return_inverse=True)
+
+    return pa.table({
+        'station': pa.DictionaryArray.from_arrays(np.repeat(station_codes.astype(np.int32), 12)[present],
+                                                  stations.astype(str)),
+        'year': pa.array(np.repeat(years, 12)[present]),
+        'month': pa.array(np.tile(np.arange(1, 13, dtype=np.int8), n_records)[present]),
+        'value': pa.array((values.ravel()[present] / 100).astype(np.float32)),
+        'flag': pa.DictionaryArray.from_arrays(flag_codes.astype(np.int32)[present],
+                                               np.char.strip(flag_combinations).astype(str))})
+
+
+def _ingest_chunk(filepaths, output_path):
+
+    """
+    Worker task: decodes a chunk of station files and writes them as one Arrow IPC file. Only the row count travels
+    back to the parent process, the table itself is never pickled.
+    """
+
+    import pyarrow as pa
+
+    buffer = b''.join(read_record_bytes(filepath) for filepath in filepaths)
+    table = _long_format_table(*decode_station_records(buffer))
+    with pa.OSFile(output_path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(output_path + '.tmp', output_path)
+    return table.num_rows
+
+
+def bulk_ingest(source_dir=None, output_dir=None, workers=None, chunk_size=256, progress=True):
+
+    """
+    Parses every .FLs.52j.tavg file of the city climate directory into a long format table (station, year, month,
+    value, flag) using a pool of worker processes. Files are handed out in chunks and every chunk is written by its
+    worker straight to an Arrow IPC file in output_dir. Chunks already written by an earlier, interrupted run are
+    skipped as long as their station files are unchanged, so running the ingest again resumes where it stopped and
+    only redoes the chunks of added, removed or modified files.
+
+    Inputs:
+    source_dir (string): directory holding the station files. Defaults to CONUS_city_climate_stats in the working
+    directory.
+
+    output_dir (string): directory the chunk files are written to. Defaults to station_long in the working directory.
+
+    workers (integer): number of worker processes. Defaults to the number of CPUs.
+
+    chunk_size (integer): number of station files per chunk.
+
+    progress (boolean): whether to print the progress to stderr.
+
+    Returns:
+    output_dir (string): the directory holding the chunk files, which can be opened with load_long_table.
+
+    """
+
+    if source_dir is None:
+        source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+    if output_dir is None:
+        output_dir = os.getcwd() + '/station_long'
+    if workers is None:
+        workers = os.cpu_count()
+
+    filepaths = sorted(glob.glob(source_dir + '/*.FLs.52j.tavg'))
+    chunks = [filepaths[start:start + chunk_size] for start in range(0, len(filepaths), chunk_size)]
+    os.makedirs(output_dir, exist_ok=True)
+
+    ## The name, size and modification time of every file of every chunk are recorded, so a resumed run only reuses
+    #     chunks that still hold the same, unchanged files. The files of chunks that have to be written again (and of
+    #     chunks beyond the new chunk count) are removed before the new manifest is saved, so a run interrupted from
+    #     here on never reuses them either.
+    manifest_path = output_dir + '/manifest.json'
+    manifest = {'source_dir': os.path.realpath(source_dir),
+                'chunks': [[[os.path.basename(filepath), os.stat(filepath).st_size, os.stat(filepath).st_mtime_ns]
+                            for filepath in chunk] for chunk in chunks]}
+    recorded = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous.get('source_dir') == manifest['source_dir']:
+            recorded = previous.get('chunks', [])
+
+    output_paths = [output_dir + '/chunk_%05d.arrow' % i for i in range(len(chunks))]
+    pending = [i for i, output_path in enumerate(output_paths)
+               if i >= len(recorded) or recorded[i] != manifest['chunks'][i] or not os.path.exists(output_path)]
+    for i in pending:
+        if os.path.exists(output_paths[i]):
+            os.remove(output_paths[i])
+    for old_chunk in glob.glob(output_dir + '/chunk_*.arrow'):
+        if old_chunk not in output_paths:
+            os.remove(old_chunk)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    done = len(chunks) - len(pending)
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_ingest_chunk, chunks[i], output_paths[i]) for i in pending]
+        for future in as_completed(futures):
+            future.result()
+            done += 1
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                sys.stderr.write('\rIngested %d/%d chunks (%.1f s)' % (done, len(chunks), elapsed))
+    if progress:
+        sys.stderr.write('\n')
+
+    return output_dir
+
+
+def load_long_table(output_dir=None):
+
+    """
+    Opens the chunk files written by bulk_ingest as a single Arrow table. The IPC files are memory mapped, so the
+    table does not need to be copied into memory.
+
+    Returns:
+    (pyarrow.Table) - the long format table of all stations.
+
+    """
+
+    import pyarrow as pa
+
+    if output_dir is None:
+        output_dir = os.getcwd() + '/station_long'
+    tables = []
+    for chunk_path in sorted(glob.glob(output_dir + '/chunk_*.arrow')):
+        with pa.memory_map(chunk_path) as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+    return pa.concat_tables(tables, promote_options='permissive')
+
+
+## Testing functionality
+def test_bulk_ingest(tmp_path):
+
+    import shutil
+    from load_city_climate_files import pull_location_file, parse_climate_data
+
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+
+    output_dir = bulk_ingest(source_dir, str(tmp_path) + '/long', workers=2, chunk_size=2, progress=False)
+    table = load_long_table(output_dir).to_pandas()
+
+    ## Every present monthly value of the parsed dataframe appears exactly once in the long table
+    df_city_data = parse_climate_data(source_dir + '/USC00317074.FLs.52j.tavg', use_archive=False)
+    raleigh = table[table['station'] == 'USC00317074']
+    assert len(raleigh) == df_city_data.iloc[:, 2:].notna().sum().sum()
+    january = raleigh[(raleigh['year'] == df_city_data.loc[128, 'Year']) & (raleigh['month'] == 1)]
+    assert abs(january['value'].iloc[0] - 8.30) < 1e-5
+
+    ## A second run finds every chunk written and does no work
+    chunk_mtimes = [os.stat(path).st_mtime_ns for path in sorted(glob.glob(output_dir + '/chunk_*.arrow'))]
+    bulk_ingest(source_dir, output_dir, workers=2, chunk_size=2, progress=False)
+    assert chunk_mtimes == [os.stat(path).st_mtime_ns for path in sorted(glob.glob(output_dir + '/chunk_*.arrow'))]
+
+    ## Chunks whose files changed are written again and chunks beyond the new chunk count are removed
+    os.remove(source_dir + '/USC00300047.FLs.52j.tavg')
+    bulk_ingest(source_dir, output_dir, workers=2, chunk_size=2, progress=False)
+    assert len(glob.glob(output_dir + '/chunk_*.arrow')) == 1
+    assert set(load_long_table(output_dir).to_pandas()['station']) == {'USC00317074', 'USC00412243'}
+
+    ## Only the chunk holding the new station is written, the unchanged chunk is reused
+    chunk_mtime = os.stat(output_dir + '/chunk_00000.arrow').st_mtime_ns
+    shutil.copy(pull_location_file('Seattle, WA'), source_dir)
+    bulk_ingest(source_dir, output_dir, workers=2, chunk_size=2, progress=False)
+    assert os.stat(output_dir + '/chunk_00000.arrow').st_mtime_ns == chunk_mtime
+    assert set(load_long_table(output_dir).to_pandas()['station']) == {'USC00317074', 'USC00412243', 'USC00457478'}
+
+    return
+
+
+## Running this file ingests the whole directory: python bulk_ingest.py [workers]
+if __name__ == '__main__':
+    print(bulk_ingest(workers=int(sys.argv[1]) if len(sys.argv) > 1 else None))
@@ -0,0 +1,235 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from climate_cache import get_city_series, timescale_series
+from climate_records import scale_values
+from climatology_table import load_climatology_table
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+REPORT_FORMATS = ('png', 'html')
+
+
+class CityPlotRenderer:
+
+    """
+    Headless matplotlib version of the city time series plot for batch rendering. The figure, the line of averages,
+    the climatology line, its label and the title are created once, and every station only swaps their data before
+    the figure is saved, so no notebook, widget or plotly machinery is needed to produce a PNG.
+
+    """
+
+    def __init__(self, figsize=(11, 5), dpi=100):
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+
+        ## Styled like the plotly plot: markers on a line, a red climatology line labelled at the top left, gray grid
+        self.line, = self.ax.plot([], [], marker='o', markersize=3, linewidth=1.5)
+        self.average = self.ax.axhline(0, color='red')
+        self.label = self.ax.text(0.01, 0, '', color='red', transform=self.ax.get_yaxis_transform(),
+                                  va='bottom', ha='left')
+        self.title = self.ax.set_title('', fontsize=14)
+        self.ax.set_xlabel('Year')
+        self.ax.set_ylabel('Temperature °C')
+        self.ax.grid(True, color='gray', linewidth=0.5)
+
+    def draw(self, years, values, climatology, title, start_year, end_year, baseline=(1981, 2010)):
+
+        """
+        Shows the averages of one station between two years against its climatology.
+        """
+
+        self.line.set_data(years, values)
+        self.average.set_ydata([climatology, climatology])
+        self.label.set_y(climatology)
+        self.label.set_text(str(baseline[0]) + '-' + str(baseline[1]) + ' Mean: ' + str(round(climatology, 1)) + '°C')
+        self.title.set_text(title)
+
+        ## The y axis follows the averages inside the shown years
+        self.ax.set_xlim(start_year, end_year)
+        shown = values[(years >= start_year) & (years <= end_year)]
+        if len(shown):
+            low, high = min(shown.min(), climatology), max(shown.max(), climatology)
+            margin = max(0.05 * (high - low), 0.5)
+            self.ax.set_ylim(low - margin, high + margin)
+        return
+
+    def save(self, path):
+
+        """
+        Writes the current plot as a PNG image, replacing the file atomically.
+        """
+
+        self.fig.savefig(path + '.tmp', format='png', pil_kwargs={'compress_level': 1})
+        os.replace(path + '.tmp', path)
+        return path
+
+
+def station_series(station_id, timescale, baseline=(1981, 2010), archive=None):
+
+    """
+    Returns the same years, averages and climatology as get_city_series for one station. Stations with an up to date
+    copy in the station archive are read straight from the memory mapped arrays without building a dataframe or
+    filling the shared cache, which keeps rendering thousands of stations cheap; any other station goes through
+    get_city_series.
+
+    Inputs:
+    station_id (string): 11 character station ID.
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    baseline (tuple): first and last year of the climatology period.
+
+    archive (StationArchive): the opened station archive. Defaults to the station archive of the working directory.
+
+    Returns:
+    years (ndarray), values (ndarray), climatology (float) - see compute_timescale_series.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+    if archive is None or not archive.is_fresh(station_id):
+        return get_city_series(station_id, timescale, baseline=baseline)
+
+    years, raw_values, _ = archive.station_rows(station_id)
+    years, values, _ = timescale_series(np.asarray(years), scale_values(np.asarray(raw_values)), timescale, baseline)
+    climatology = load_climatology_table(baseline, archive).lookup(station_id, timescale)[0]
+    return years, values, climatology
+
+
+def _render_chunk(station_ids, titles, output_dir, formats, timescale, start_year, end_year, baseline):
+
+    """
+    Renders the plots of a chunk of stations in a worker process with one persistent renderer.
+    """
+
+    from analyze_city_climate_data import build_city_climate_figure
+
+    archive = load_station_archive()
+    renderer = CityPlotRenderer() if 'png' in formats else None
+    paths = []
+    for station_id, title in zip(station_ids, titles):
+        series = station_series(station_id, timescale, baseline, archive)
+        stem = output_dir + '/' + station_id + '_' + timescale
+        if renderer is not None:
+            renderer.draw(*series, title + ' ' + timescale + ' Average Temperature', start_year, end_year, baseline)
+            paths.append(renderer.save(stem + '.png'))
+        if 'html' in formats:
+            ## Every page loads the plotly.js bundle written once next to them instead of embedding its own copy
+            fig = build_city_climate_figure(title, timescale, start_year, end_year, baseline, series=series)
+            fig.write_html(stem + '.html', include_plotlyjs='directory', full_html=True)
+            paths.append(stem + '.html')
+    return paths
+
+
+def render_city_reports(locations=None, output_dir=None, formats=('png',), timescale='Annual', start_year=1890,
+                        end_year=2021, baseline=(1981, 2010), workers=None, chunk_size=64):
+
+    """
+    Renders the static city time series plot of many stations, as PNG images, standalone HTML pages or both. The
+    stations are split into chunks that are rendered by a pool of worker processes, each reusing one headless
+    figure for all the stations of its chunks and reading the station series straight from the archive.
+
+    Inputs:
+    locations (list): station IDs or "City, ST" locations. Defaults to every station of the registry.
+
+    output_dir (string): directory the plots STATIONID_TIMESCALE.png/.html are written to. Defaults to city_reports in
+    the working directory.
+
+    formats (tuple): any of "png" and "html".
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    start_year (integer), end_year (integer): the years that mark the start and the end of the time series
+
+    baseline (tuple): first and last year of the climatology shown as the reference line.
+
+    workers (integer): number of rendering processes. Defaults to the number of CPUs.
+
+    chunk_size (integer): number of stations handed to a worker at once.
+
+    Returns:
+    (dict) - the written paths, the number of stations, the elapsed seconds and the stations per second.
+
+    """
+
+    unknown = set(formats) - set(REPORT_FORMATS)
+    if unknown:
+        raise ValueError('Unknown report formats: ' + ', '.join(sorted(unknown)))
+    if output_dir is None:
+        output_dir = os.getcwd() + '/city_reports'
+    if workers is None:
+        workers = os.cpu_count()
+    os.makedirs(output_dir, exist_ok=True)
+
+    registry = load_station_registry()
+    if locations is None:
+        station_ids = sorted(registry.stations)
+    else:
+        station_ids = [registry.resolve(location) for location in locations]
+
+    ## Plots are titled with the "City, ST" name of a station when it has one
+    names = {station_id: location for location, station_id in registry.locations.items()}
+    titles = [names.get(station_id, station_id) for station_id in station_ids]
+
+    if 'html' in formats:
+        from plotly.offline import get_plotlyjs
+        with open(output_dir + '/plotly.min.js', 'w', encoding='utf-8') as f:
+            f.write(get_plotlyjs())
+
+    ## The archive and the climatology table are opened before the workers are forked, so they share them
+    archive = load_station_archive()
+    if archive is not None:
+        load_climatology_table(baseline, archive)
+
+    start_time = time.perf_counter()
+    paths = []
+    chunks = [(station_ids[i:i + chunk_size], titles[i:i + chunk_size]) for i in range(0, len(station_ids), chunk_size)]
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk_ids, chunk_titles in chunks:
+            paths += _render_chunk(chunk_ids, chunk_titles, output_dir, formats, timescale, start_year, end_year,
+                                   baseline)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_render_chunk, chunk_ids, chunk_titles, output_dir, formats, timescale,
+                                       start_year, end_year, baseline)
+                       for chunk_ids, chunk_titles in chunks]
+            for future in futures:
+                paths += future.result()
+    elapsed = time.perf_counter() - start_time
+
+    return {'paths': paths, 'count': len(station_ids), 'seconds': elapsed,
+            'per_second': len(station_ids) / elapsed if elapsed > 0 else np.inf}
+
+
+## Testing functionality
+def test_render_city_reports(tmp_path):
+
+    locations = ['Raleigh, NC', 'Dallas, TX', 'Albany, NY']
+    result = render_city_reports(locations, str(tmp_path), formats=('png', 'html'), timescale='July',
+                                 workers=2, chunk_size=2)
+    assert result['count'] == 3
+    assert len(result['paths']) == 6
+    assert all(os.path.getsize(path) > 0 for path in result['paths'])
+    assert os.path.exists(str(tmp_path) + '/plotly.min.js')
+
+    ## The pages load the shared plotly.js bundle rather than embedding it
+    assert os.path.getsize(str(tmp_path) + '/USC00317074_July.html') < 100000
+
+    ## The series read from the archive match the ones plotted in the notebook
+    for location in locations:
+        station_id = load_station_registry().resolve(location)
+        expected = get_city_series(location, 'July')
+        for actual, wanted in zip(station_series(station_id, 'July'), expected):
+            np.testing.assert_allclose(actual, wanted)
+
+    return
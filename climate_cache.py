@@ -0,0 +1,272 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from climate_records import MONTHS, TIMESCALES, frame_flag_codes
+from climatology_table import load_climatology_table
+from instrumentation import instrumented, span
+from load_city_climate_files import parse_climate_data
+from quality_policy import get_policy
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+
+def compute_timescale_series(df_city_data, timescale, baseline=(1981, 2010)):
+
+    """
+    Computes the series plotted for a timescale together with its climatology from a parsed station dataframe.
+    Annual averages are the mean of the twelve monthly averages and only use years without any missing month, monthly
+    series drop the years missing that month.
+
+    Inputs:
+    df_city_data (df): dataframe produced by parse_climate_data. It is not modified.
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    baseline (tuple): first and last year of the climatology period.
+
+    Returns:
+    years (ndarray): years with a valid average.
+
+    values (ndarray): average temperature of each of those years.
+
+    climatology (float): mean of the averages over the baseline period.
+
+    """
+
+    return timescale_series(df_city_data['Year'].to_numpy(), df_city_data[MONTHS].to_numpy(), timescale, baseline)
+
+
+def timescale_series(years, monthly, timescale, baseline=(1981, 2010)):
+
+    """
+    Array version of compute_timescale_series, for callers that already hold the years and the monthly averages in
+    degrees C (NaN where missing) of shape (years, 12), e.g. rows read straight from the station archive.
+    """
+
+    if timescale == 'Annual':
+        valid = ~np.isnan(monthly).any(axis=1)
+        values = monthly[valid].mean(axis=1)
+    else:
+        column = monthly[:, MONTHS.index(timescale)]
+        valid = ~np.isnan(column)
+        values = column[valid]
+    years = years[valid]
+
+    in_baseline = (years >= baseline[0]) & (years <= baseline[1])
+    climatology = values[in_baseline].mean() if in_baseline.any() else np.nan
+    return years, values, climatology
+
+
+class StationEntry:
+
+    """
+    Cached contents for one station: the parsed dataframe, the flag codes of its values and the derived series and
+    climatology for every timescale, also kept per quality policy once asked for.
+    """
+
+    __slots__ = ['frame', 'series', 'flag_codes', 'flag_table', 'policies', 'baseline', 'nbytes']
+
+    def __init__(self, frame, baseline, df_flags):
+        self.frame = frame
+        self.baseline = baseline
+        self.series = {timescale: compute_timescale_series(frame, timescale, baseline) for timescale in TIMESCALES}
+        self.flag_codes, self.flag_table = frame_flag_codes(df_flags)
+        self.policies = {}
+        self.nbytes = int(frame.memory_usage(deep=True).sum()) + self.flag_codes.nbytes + series_nbytes(self.series)
+
+    def policy_series(self, policy):
+
+        """
+        Returns the series and climatology of every timescale with the values rejected by a quality policy treated
+        as missing. The policy is applied as a mask on the kept flag codes, so the station is not parsed again.
+        """
+
+        series = self.policies.get(policy)
+        if series is None:
+            years = self.frame['Year'].to_numpy()
+            keep = policy.mask(self.flag_codes, self.flag_table, years)
+            monthly = np.where(keep, self.frame[MONTHS].to_numpy(), np.nan)
+            series = self.policies[policy] = {timescale: timescale_series(years, monthly, timescale, self.baseline)
+                                              for timescale in TIMESCALES}
+            self.nbytes += series_nbytes(series)
+        return series
+
+
+def series_nbytes(series):
+    return sum(years.nbytes + values.nbytes for years, values, _ in series.values())
+
+
+class ClimateCache:
+
+    """
+    Bounded least recently used cache of parsed station dataframes and their derived series, shared by the widget
+    callbacks. Entries are keyed by station ID and the source file's modification time, so an edited file is
+    reparsed automatically, and the least recently used stations are evicted once the total size of the cached
+    entries exceeds max_bytes.
+
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, baseline=(1981, 2010)):
+
+        self.max_bytes = max_bytes
+        self.baseline = baseline
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, station_id, filepath):
+
+        """
+        Returns the cached entry of a station, parsing the station file on a miss.
+
+        Inputs:
+        station_id (string): 11 character station ID.
+
+        filepath (string): path of the station file.
+
+        Returns:
+        (StationEntry) - the parsed dataframe and derived series of the station.
+
+        """
+
+        key = (station_id, os.stat(filepath).st_mtime_ns)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        self.invalidate(station_id)
+        df_city_data, df_flags = parse_climate_data(filepath, return_flags=True)
+        with span('derive series'):
+            entry = StationEntry(df_city_data, self.baseline, df_flags)
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+
+        ## The newest entry is always kept, even when it is larger than the whole budget on its own
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        return entry
+
+    def policy_series(self, station_id, filepath, policy):
+
+        """
+        Returns the series of every timescale of a station under a quality policy (see StationEntry.policy_series),
+        keeping them in the station's entry.
+        """
+
+        entry = self.get(station_id, filepath)
+        nbytes = entry.nbytes
+        series = entry.policy_series(policy)
+        self.nbytes += entry.nbytes - nbytes
+        return series
+
+    def invalidate(self, station_id=None):
+
+        """
+        Drops the cached entries of one station, or of every station when no station ID is given.
+        """
+
+        for key in [key for key in self.entries if station_id is None or key[0] == station_id]:
+            self.nbytes -= self.entries.pop(key).nbytes
+        return
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+## Cache shared by all widget callbacks
+climate_cache = ClimateCache()
+
+@instrumented('get_city_series')
+def get_city_series(location, timescale, cache=None, baseline=(1981, 2010), policy=None):
+
+    """
+    Returns the plotted series and climatology of a location and timescale, going through the shared cache so that
+    repeated requests for the same station do not read or parse its file again. When the station archive holds an up
+    to date copy of the station, the climatology is looked up in the precomputed climatology table of the baseline.
+
+    Inputs:
+    location (string): structured "City, ST" in which the state is the two letter state abbreviation, or a station ID.
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    cache (ClimateCache): cache to use. Defaults to the shared cache.
+
+    baseline (tuple): first and last year of the climatology period.
+
+    policy (QualityPolicy or string): quality policy whose rejected values are left out of the series and the
+    climatology (see quality_policy.py). Every value is used by default.
+
+    Returns:
+    years (ndarray), values (ndarray), climatology (float) - see compute_timescale_series.
+
+    """
+
+    if cache is None:
+        cache = climate_cache
+    policy = get_policy(policy)
+    with span('registry lookup'):
+        registry = load_station_registry()
+        station_id = registry.resolve(location)
+        filepath = registry.filepath(station_id)
+    with span('station cache'):
+        if policy is None:
+            years, values, climatology = cache.get(station_id, filepath).series[timescale]
+        else:
+            years, values, climatology = cache.policy_series(station_id, filepath, policy)[timescale]
+
+    with span('climatology lookup'):
+        archive = load_station_archive()
+        if policy is None and archive is not None and archive.is_fresh(station_id, filepath):
+            climatology = load_climatology_table(baseline, archive).lookup(station_id, timescale)[0]
+        elif tuple(baseline) != tuple(cache.baseline):
+            in_baseline = (years >= baseline[0]) & (years <= baseline[1])
+            climatology = values[in_baseline].mean() if in_baseline.any() else np.nan
+    return years, values, climatology
+
+
+## Testing functionality
+def test_climate_cache():
+
+    import pandas as pd
+    from load_city_climate_files import pull_location_file
+
+    cache = ClimateCache(max_bytes=10**9)
+    years, values, climatology = get_city_series('Dallas, TX', 'January', cache)
+    get_city_series('Dallas, TX', 'Annual', cache)
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 1
+
+    ## Derived values match the dataframe computation of analyze_city_climate_data
+    df_city_data = parse_climate_data(pull_location_file('Dallas, TX')).dropna(subset=['January'])
+    df_average = df_city_data.loc[(df_city_data['Year'] >= 1981) & (df_city_data['Year'] <= 2010)]
+    assert np.array_equal(years, df_city_data['Year'].to_numpy())
+    assert abs(climatology - df_average['January'].mean(axis=0)) < 1e-9
+
+    ## A budget that fits a single station evicts the least recently used one
+    cache.max_bytes = cache.nbytes
+    get_city_series('Raleigh, NC', 'June', cache)
+    assert cache.stats()['evictions'] == 1 and cache.stats()['entries'] == 1
+
+    ## A quality policy reuses the cached station and only adds its series to the entry
+    misses, nbytes = cache.stats()['misses'], cache.nbytes
+    years_measured, values_measured, climatology_measured = get_city_series('Raleigh, NC', 'June', cache,
+                                                                            policy='measured')
+    assert cache.stats()['misses'] == misses and cache.nbytes > nbytes
+    df_measured = parse_climate_data(pull_location_file('Raleigh, NC'), policy='measured').dropna(subset=['June'])
+    assert np.array_equal(years_measured, df_measured['Year'].to_numpy())
+    assert np.allclose(values_measured, df_measured['June'].to_numpy())
+    assert len(years_measured) < len(get_city_series('Raleigh, NC', 'June', cache)[0])
+
+    cache.invalidate()
+    assert cache.stats()['entries'] == 0 and cache.nbytes == 0
+
+    return
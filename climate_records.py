@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+
+## Every line of a .FLs.52j.tavg file is a fixed width record: an 11 character station ID, a 5 character year and twelve
+#     9 character monthly fields terminated by a newline. Each monthly field holds the value (hundredths of a degree C)
+#     right aligned in its first 6 characters followed by three single character flags.
+RECORD_LENGTH = 125
+VALUE_WIDTH = 6
+FLAG_WIDTH = 3
+MISSING_VALUE = -9999
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+          'September', 'October', 'November', 'December']
+
+TIMESCALES = ['Annual'] + MONTHS
+
+
+def read_record_bytes(used_filename):
+
+    """
+    Reads the raw bytes of a station file, making sure the last record is newline terminated like all others.
+    """
+
+    with open(used_filename, 'rb') as f:
+        content = f.read()
+    if content and not content.endswith(b'\n'):
+        content += b'\n'
+    return content
+
+
+def decode_station_records(buffer):
+
+    """
+    Decodes a buffer holding one or more fixed width station records in a single NumPy pass. The buffer is viewed as
+    a (records, 125) byte array, so the station ID, year, value digits and flag characters are all sliced out of the
+    same array without any intermediate strings.
+
+    Inputs:
+    buffer (bytes): the raw contents of one or more .FLs.52j.tavg files, each line terminated by a newline.
+
+    Returns:
+    station_ids (ndarray): 11 byte station IDs for every record.
+
+    years (ndarray): int16 year of every record.
+
+    values (ndarray): int16 array of shape (records, 12) with the monthly values in hundredths of a degree C. Missing
+    values keep the -9999 encoding of the source files.
+
+    flags (ndarray): uint8 array of shape (records, 12, 3) holding the flag characters of every monthly value.
+
+    """
+
+    records = np.frombuffer(buffer, dtype=np.uint8)
+    if len(records) % RECORD_LENGTH != 0:
+        raise ValueError('Buffer is not made of ' + str(RECORD_LENGTH) + ' byte station records')
+    records = records.reshape(-1, RECORD_LENGTH)
+    if not np.all(records[:, -1] == ord('\n')):
+        raise ValueError('Station records are not newline terminated')
+
+    station_ids = records[:, :11].copy().view('S11').ravel()
+
+    ## Year digits occupy the last four characters of the 5 character year field
+    year_digits = records[:, 12:16].astype(np.int16) - ord('0')
+    years = year_digits @ np.array([1000, 100, 10, 1], dtype=np.int16)
+
+    ## Split every monthly field into its value characters and its flag characters
+    fields = records[:, 16:16 + 12 * 9].reshape(-1, 12, 9)
+    value_chars = fields[:, :, :VALUE_WIDTH]
+    flags = np.ascontiguousarray(fields[:, :, VALUE_WIDTH:VALUE_WIDTH + FLAG_WIDTH])
+
+    ## Values are right aligned, so each character position has a fixed place value. Blanks and the minus sign count
+    #     as zero digits and the sign is applied afterwards.
+    is_digit = (value_chars >= ord('0')) & (value_chars <= ord('9'))
+    digits = np.where(is_digit, value_chars.astype(np.int32) - ord('0'), 0)
+    place_values = 10 ** np.arange(VALUE_WIDTH - 1, -1, -1, dtype=np.int32)
+    magnitudes = digits @ place_values
+    negative = np.any(value_chars == ord('-'), axis=2)
+    values = np.where(negative, -magnitudes, magnitudes).astype(np.int16)
+
+    return station_ids, years, values, flags
+
+
+## 64 bit FNV-1a constants, used to fingerprint records
+FNV_OFFSET = np.uint64(14695981039346656037)
+FNV_PRIME = np.uint64(1099511628211)
+
+
+def record_hashes(buffer):
+
+    """
+    Computes a 64 bit fingerprint of every fixed width record of a buffer in one NumPy pass, so that records can be
+    compared between two versions of a station file without decoding them. Every record (station ID and year
+    included) is padded to 128 bytes and its sixteen 8 byte words are folded together FNV-1a style.
+
+    Inputs:
+    buffer (bytes): the raw contents of one or more .FLs.52j.tavg files, each line terminated by a newline.
+
+    Returns:
+    (ndarray) - uint64 fingerprint of every record.
+
+    """
+
+    records = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, RECORD_LENGTH)
+    padded = np.zeros((len(records), 128), dtype=np.uint8)
+    padded[:, :RECORD_LENGTH] = records
+    words = padded.view('<u8')
+
+    hashes = np.full(len(records), FNV_OFFSET, dtype=np.uint64)
+    for column in range(words.shape[1]):
+        hashes = (hashes ^ words[:, column]) * FNV_PRIME
+    return hashes
+
+
+def encode_flags(flags, table=None):
+
+    """
+    Dictionary encodes the three flag characters of every monthly value into a single uint8 code. The station files
+    only use a handful of distinct flag combinations (16 across all 22,009 stations), so one byte indexing a table of
+    the combinations replaces three bytes per value. The flag alphabets themselves (14 measurement, 12 quality and 10
+    source flags) do not fit in 8 bits as separate bit fields.
+
+    Inputs:
+    flags (ndarray): uint8 flag characters of shape (..., 3), as returned by decode_station_records.
+
+    table (ndarray): existing (combinations, 3) table to extend, so codes stay comparable between calls.
+
+    Returns:
+    codes (ndarray): uint8 code of every value, of the shape of flags without its last axis.
+
+    table (ndarray): uint8 array of shape (combinations, 3); row c holds the flag characters of code c.
+
+    """
+
+    flags = np.asarray(flags, dtype=np.uint8)
+    packed = ((flags[..., 0].astype(np.uint32) << 16) | (flags[..., 1].astype(np.uint32) << 8)
+              | flags[..., 2].astype(np.uint32))
+    known = np.zeros(0, dtype=np.uint32) if table is None else (
+        (table[:, 0].astype(np.uint32) << 16) | (table[:, 1].astype(np.uint32) << 8) | table[:, 2].astype(np.uint32))
+
+    ## New combinations are appended after the known ones, so existing codes keep their meaning
+    unique = np.unique(packed)
+    combinations = np.concatenate([known, unique[~np.isin(unique, known)]])
+    if len(combinations) > 256:
+        raise ValueError(str(len(combinations)) + ' flag combinations do not fit in a uint8 code')
+    order = np.argsort(combinations, kind='stable')
+    codes = order[np.searchsorted(combinations[order], packed)].astype(np.uint8)
+
+    table = np.stack([(combinations >> 16) & 0xFF, (combinations >> 8) & 0xFF, combinations & 0xFF],
+                     axis=1).astype(np.uint8)
+    return codes, table
+
+
+def decode_flags(codes, table):
+
+    """
+    Expands uint8 flag codes back into the three flag characters of every value (see encode_flags).
+    """
+
+    return table[codes]
+
+
+def flag_categories(table):
+
+    """
+    Returns the flag characters of every code of a flag table as 3 character strings, e.g. "E  " or " Q3".
+    """
+
+    return [bytes(row).decode('ascii') for row in table]
+
+
+def flags_to_frame(years, flag_codes, flag_table):
+
+    """
+    Builds a DataFrame of the flags of every monthly value, laid out like the values of parse_climate_data: the year
+    and one categorical column per month whose categories are the flag combinations of the table.
+
+    Inputs:
+    years (ndarray): year of every record.
+
+    flag_codes (ndarray): uint8 flag codes of shape (records, 12), see encode_flags.
+
+    flag_table (ndarray): the table of the codes.
+
+    Returns:
+    (df) - A DataFrame containing the year and the twelve monthly flags as categoricals.
+
+    """
+
+    categories = pd.Index(flag_categories(flag_table), dtype=object)
+    data = {'Year': np.asarray(years).astype(np.int64)}
+    for column, month in enumerate(MONTHS):
+        data[month] = pd.Categorical.from_codes(flag_codes[:, column].astype(np.int16), categories)
+    return pd.DataFrame(data)
+
+
+def frame_flag_codes(df_flags):
+
+    """
+    Returns the uint8 flag codes of shape (records, 12) and the flag table behind a frame built by flags_to_frame.
+    """
+
+    categories = df_flags[MONTHS[0]].cat.categories
+    flag_table = np.frombuffer(''.join(categories).encode('ascii'), dtype=np.uint8).reshape(-1, FLAG_WIDTH)
+    flag_codes = np.column_stack([df_flags[month].cat.codes.to_numpy() for month in MONTHS]).astype(np.uint8)
+    return flag_codes, flag_table
+
+
+def scale_values(values):
+
+    """
+    Converts raw values in hundredths of a degree C to float degrees C with missing values as NaN.
+    """
+
+    scaled = values / 100
+    scaled[values == MISSING_VALUE] = np.nan
+    return scaled
+
+
+def records_to_frame(station_id, years, values):
+
+    """
+    Builds the DataFrame layout produced by parse_climate_data from decoded station records.
+
+    Inputs:
+    station_id (string): 11 character station ID.
+
+    years (ndarray): year of every record.
+
+    values (ndarray): raw monthly values of shape (records, 12) in hundredths of a degree C.
+
+    Returns:
+    (df) - A DataFrame containing the station ID, year and the twelve monthly averages in degrees C.
+
+    """
+
+    ## Columns are handed to pandas as they are, which is much cheaper than inserting them one at a time
+    scaled = scale_values(np.ascontiguousarray(values.T))
+    data = {'Station Climate ID': np.full(len(years), station_id, dtype=object), 'Year': years.astype(np.int64)}
+    data.update(zip(MONTHS, scaled))
+    return pd.DataFrame(data, copy=False)
@@ -0,0 +1,604 @@
+## Local HTTP service in front of the station archive and the anomaly file, for dashboards that cannot embed the
+#     Jupyter widgets: python climate_service.py [--host 127.0.0.1] [--port 8050] [--anomalies path.nc]
+#     GET /stations/<location>/series?timescale=Annual&baseline=1981-2010&policy=measured&start_year=&end_year=
+#     GET /stations/<location>/climatology?timescale=Annual&baseline=1981-2010
+#     GET /anomalies/<year>/<month>.png?region=CONUS&step=1 the global (or a named region's) anomaly map
+#     GET /anomalies/<year>/<month>/<z>/<x>/<y>.png        256 pixel Web Mercator (XYZ) tiles of the anomalies
+#     GET /health, GET /metrics
+#     Locations are station IDs or URL encoded "City, ST" names, months are names or numbers.
+import asyncio
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from anomaly_dataset import MONTH_NUMBERS, REGIONS, open_anomaly_dataset
+from climate_records import TIMESCALES
+from instrumentation import metrics, span
+
+TILE_SIZE = 256
+MAX_TILE_ZOOM = 8
+TILE_LIMITS = (-8, 8)
+MAX_MAP_STEP = 8
+
+## Anomaly months older than this many months before the last month of the file are served as immutable. Recent
+#     months, and everything read from the station archive, are revalidated with their ETag after an hour.
+REVISED_MONTHS = 12
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=3600'
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Resource:
+
+    """
+    A response the service knows how to produce: its ETag and caching headers are known up front from the request
+    and the version of the data behind it, so conditional and repeated requests are answered without computing the
+    body.
+    """
+
+    __slots__ = ('etag', 'cache_control', 'content_type', 'executor', 'compute')
+
+    def __init__(self, etag, cache_control, content_type, executor, compute):
+        self.etag = etag
+        self.cache_control = cache_control
+        self.content_type = content_type
+        self.executor = executor
+        self.compute = compute
+
+
+def tile_bounds(z, x, y):
+
+    """
+    Returns the (lon_min, lat_min, lon_max, lat_max) bounding box of an XYZ tile in degrees.
+    """
+
+    n = 2 ** z
+    lat_max, lat_min = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.array([y, y + 1]) / n))))
+    return x / n * 360 - 180, float(lat_min), (x + 1) / n * 360 - 180, float(lat_max)
+
+
+def tile_pixel_cells(z, x, y, lat, lon):
+
+    """
+    Finds the anomaly grid cell under every pixel of an XYZ tile.
+
+    Inputs:
+    z (integer), x (integer), y (integer): zoom level and tile column and row of the Web Mercator tile.
+
+    lat (ndarray), lon (ndarray): cell centres of the anomaly grid.
+
+    Returns:
+    rows (ndarray): grid row of every pixel row of the tile.
+
+    columns (ndarray): grid column of every pixel column of the tile.
+
+    """
+
+    from station_gridding import cell_edges
+
+    n = 2 ** z
+    pixels = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    pixel_lon = (x + pixels) / n * 360 - 180
+    pixel_lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + pixels) / n))))
+
+    ## Both axes are searched in ascending order, whatever the order of the file
+    lat_order, lon_order = np.argsort(lat), np.argsort(lon)
+    rows = np.searchsorted(cell_edges(np.asarray(lat)[lat_order]), pixel_lat) - 1
+    columns = np.searchsorted(cell_edges(np.asarray(lon)[lon_order]), pixel_lon) - 1
+    rows = lat_order[np.clip(rows, 0, len(lat) - 1)]
+    columns = lon_order[np.clip(columns, 0, len(lon) - 1)]
+    return rows, columns
+
+
+## Colour table of the map renderer's colormap and limits, built on first use
+_tile_colors = []
+
+def render_tile(field, rows, columns, limits=TILE_LIMITS):
+
+    """
+    Colours the anomalies under the pixels of a tile with the RdBu_r colormap of the anomaly map and encodes them as
+    a PNG. Zones without data are transparent.
+
+    Inputs:
+    field (masked array): anomalies on the (lat, lon) grid.
+
+    rows (ndarray), columns (ndarray): grid cells of the tile pixels, see tile_pixel_cells.
+
+    limits (tuple): anomalies mapped to the two ends of the colormap.
+
+    Returns:
+    (bytes) - the tile as a PNG image.
+
+    """
+
+    from PIL import Image
+
+    if not _tile_colors:
+        import matplotlib
+        _tile_colors.append((matplotlib.colormaps['RdBu_r'](np.linspace(0, 1, 256)) * 255).astype(np.uint8))
+    colors = _tile_colors[0]
+
+    values = np.ma.getdata(field)[rows[:, None], columns[None, :]]
+    masked = np.ma.getmaskarray(field)[rows[:, None], columns[None, :]] | np.isnan(values)
+    levels = np.clip((np.nan_to_num(values) - limits[0]) / (limits[1] - limits[0]) * 255, 0, 255).astype(np.uint8)
+    rgba = colors[levels]
+    rgba[masked] = 0
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba).save(buffer, format='png')
+    return buffer.getvalue()
+
+
+def json_number(value, digits=4):
+    return None if value is None or not np.isfinite(value) else round(float(value), digits)
+
+
+class ClimateService:
+
+    """
+    Asyncio HTTP service answering station series, climatology and anomaly map requests. The station archive,
+    registry and caches, and the anomaly file are opened once and shared by every request. Station work, whole maps
+    and tiles each run on their own worker thread, so the event loop keeps answering cached requests while a map is
+    drawn and tiles do not queue behind maps. Neither the station caches nor netCDF4 handles are thread safe, so the
+    station caches are only used by their thread and anomaly slices are read under a lock.
+
+    Responses carry an ETag derived from the request and the version of the data behind it, and the last bodies are
+    kept in memory by ETag. A conditional request for unchanged data is answered with 304 and a repeated request
+    from memory, and identical requests arriving together share a single computation.
+
+    """
+
+    def __init__(self, anomaly_path=None, response_cache_size=1024):
+
+        """
+        Inputs:
+        anomaly_path (string): netCDF anomaly file. Defaults to the GISTEMP file of the working directory.
+
+        response_cache_size (integer): number of response bodies kept in memory.
+
+        """
+
+        self.anomaly_path = anomaly_path
+        self.response_cache_size = response_cache_size
+        self.responses = OrderedDict()
+        self.pending = {}
+        self.counters = {'requests': 0, 'not_modified': 0, 'cached': 0, 'shared': 0, 'computed': 0, 'errors': 0}
+        self.station_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='service-stations')
+        self.map_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='service-maps')
+        self.tile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='service-tiles')
+        self.dataset_lock = threading.Lock()
+        self.registry = None
+        self.dataset = None
+        self.dataset_version = None
+        self.last_month = None
+        self.server = None
+
+    ## Startup
+    def _open_stations(self):
+        from station_registry import load_station_registry
+        return load_station_registry()
+
+    def _open_anomalies(self):
+        dataset = open_anomaly_dataset(self.anomaly_path)
+        stat = os.stat(dataset.path)
+        return dataset, dataset.path + ':' + str(stat.st_mtime_ns) + ':' + str(stat.st_size)
+
+    async def open(self):
+
+        """
+        Opens the station registry and the anomaly file on their worker threads. A missing anomaly file only
+        disables the anomaly endpoints.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.registry = await loop.run_in_executor(self.station_executor, self._open_stations)
+        try:
+            self.dataset, self.dataset_version = await loop.run_in_executor(self.map_executor, self._open_anomalies)
+            self.last_month = max(self.dataset.time_index)
+        except (OSError, FileNotFoundError):
+            self.dataset = None
+        return
+
+    async def start(self, host='127.0.0.1', port=8050):
+
+        """
+        Opens the data and starts listening. Returns the asyncio server, whose sockets give the bound port when
+        port 0 was asked for.
+        """
+
+        await self.open()
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for executor in [self.station_executor, self.map_executor, self.tile_executor]:
+            executor.shutdown(wait=True)
+        return
+
+    ## HTTP
+    async def handle_connection(self, reader, writer):
+
+        """
+        Serves the requests of one connection, keeping it open between requests unless the client asks otherwise.
+        """
+
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(self.format_response(431, {}, b'', close=True))
+                    break
+
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                    headers = {}
+                    for line in lines[1:]:
+                        if line:
+                            name, value = line.split(':', 1)
+                            headers[name.strip().lower()] = value.strip()
+                except ValueError:
+                    writer.write(self.format_response(400, {}, b'Malformed request', close=True))
+                    break
+                if int(headers.get('content-length', 0) or 0):
+                    await reader.readexactly(int(headers['content-length']))
+
+                connection = headers.get('connection', '').lower()
+                close = connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive')
+                status, response_headers, body = await self.respond(method, target, headers)
+                writer.write(self.format_response(status, response_headers, b'' if method == 'HEAD' else body,
+                                                  close, len(body)))
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+        return
+
+    def format_response(self, status, headers, body, close=False, length=None):
+        lines = ['HTTP/1.1 ' + str(status) + ' ' + REASONS.get(status, '')]
+        lines += [name + ': ' + value for name, value in headers.items()]
+        lines.append('Content-Length: ' + str(len(body) if length is None else length))
+        lines.append('Connection: ' + ('close' if close else 'keep-alive'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+    async def respond(self, method, target, headers):
+
+        """
+        Answers one request.
+
+        Returns:
+        status (integer), headers (dictionary), body (bytes) - the response.
+
+        """
+
+        self.counters['requests'] += 1
+        start = time.perf_counter()
+        route = 'invalid'
+        try:
+            if method not in ('GET', 'HEAD'):
+                raise HTTPError(405, 'Only GET and HEAD are supported')
+            url = urllib.parse.urlsplit(target)
+            parts = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/') if part]
+            query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+            route, resource = self.route(parts, query)
+            if resource.content_type is None:
+                body = await resource.compute()
+                return 200, {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}, body
+
+            response_headers = {'Content-Type': resource.content_type, 'ETag': resource.etag,
+                                'Cache-Control': resource.cache_control}
+            if resource.etag in [tag.strip() for tag in headers.get('if-none-match', '').split(',')]:
+                self.counters['not_modified'] += 1
+                return 304, response_headers, b''
+            body = await self.body(resource)
+            return 200, response_headers, body
+        except HTTPError as error:
+            return error.status, {'Content-Type': 'text/plain'}, error.message.encode()
+        except Exception as error:
+            self.counters['errors'] += 1
+            return 500, {'Content-Type': 'text/plain'}, (type(error).__name__ + ': ' + str(error)).encode()
+        finally:
+            metrics.record('service ' + route, time.perf_counter() - start)
+
+    async def body(self, resource):
+
+        """
+        Returns the body of a resource from memory, from a computation of the same resource already running, or by
+        computing it on the resource's worker thread.
+        """
+
+        body = self.responses.get(resource.etag)
+        if body is not None:
+            self.counters['cached'] += 1
+            self.responses.move_to_end(resource.etag)
+            return body
+        future = self.pending.get(resource.etag)
+        if future is not None:
+            self.counters['shared'] += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().run_in_executor(resource.executor, resource.compute)
+        self.pending[resource.etag] = future
+        try:
+            body = await future
+        finally:
+            del self.pending[resource.etag]
+        self.counters['computed'] += 1
+        self.responses[resource.etag] = body
+        if len(self.responses) > self.response_cache_size:
+            self.responses.popitem(last=False)
+        return body
+
+    def etag(self, *parts):
+        return '"' + hashlib.blake2b('\n'.join(str(part) for part in parts).encode(), digest_size=16).hexdigest() + '"'
+
+    ## Routes
+    def route(self, parts, query):
+
+        """
+        Maps a request path to its route name and Resource. Raises an HTTPError for unknown or invalid requests.
+        """
+
+        if parts in ([], ['health']):
+            return 'health', Resource(None, None, None, None, self.health)
+        if parts == ['metrics']:
+            return 'metrics', Resource(None, None, None, None, self.metrics)
+        if len(parts) == 3 and parts[0] == 'stations' and parts[2] in ('series', 'climatology'):
+            return 'station ' + parts[2], self.station_resource(parts[1], parts[2], query)
+        if len(parts) == 3 and parts[0] == 'anomalies' and parts[2].endswith('.png'):
+            return 'anomaly map', self.anomaly_resource(parts[1], parts[2][:-4], None, query)
+        if len(parts) == 6 and parts[0] == 'anomalies' and parts[5].endswith('.png'):
+            return 'anomaly tile', self.anomaly_resource(parts[1], parts[2], (parts[3], parts[4], parts[5][:-4]))
+        raise HTTPError(404, 'Unknown path /' + '/'.join(parts))
+
+    def station_resource(self, location, kind, query):
+
+        from climate_cache import get_city_series
+        from quality_policy import POLICIES
+
+        try:
+            station_id = self.registry.resolve(location)
+            mtime = os.stat(self.registry.filepath(station_id)).st_mtime_ns
+        except (KeyError, OSError):
+            raise HTTPError(404, 'Unknown location ' + location) from None
+        timescale = query.get('timescale', 'Annual')
+        if timescale not in TIMESCALES:
+            raise HTTPError(400, 'Unknown timescale ' + timescale)
+        policy = query.get('policy') or None
+        if policy is not None and policy not in POLICIES:
+            raise HTTPError(400, 'Unknown policy ' + policy + ', use one of ' + ', '.join(POLICIES))
+        try:
+            baseline = tuple(int(year) for year in query.get('baseline', '1981-2010').split('-'))
+            start_year = int(query['start_year']) if query.get('start_year') else None
+            end_year = int(query['end_year']) if query.get('end_year') else None
+        except ValueError:
+            raise HTTPError(400, 'Years must be integers and baselines written as FIRST-LAST') from None
+        if len(baseline) != 2:
+            raise HTTPError(400, 'Baselines are written as FIRST-LAST, e.g. 1981-2010')
+
+        def compute():
+            with span('service ' + kind):
+                years, values, climatology = get_city_series(station_id, timescale, baseline=baseline, policy=policy)
+                document = {'station': station_id, 'timescale': timescale,
+                            'baseline': list(baseline), 'policy': policy}
+                if kind == 'climatology':
+                    in_baseline = (years >= baseline[0]) & (years <= baseline[1])
+                    document.update({'mean': json_number(climatology), 'count': int(in_baseline.sum()),
+                                     'std': json_number(values[in_baseline].std(ddof=1)
+                                                        if in_baseline.sum() > 1 else None)})
+                else:
+                    keep = np.ones(len(years), dtype=bool)
+                    if start_year is not None:
+                        keep &= years >= start_year
+                    if end_year is not None:
+                        keep &= years <= end_year
+                    document.update({'climatology': json_number(climatology), 'years': years[keep].tolist(),
+                                     'values': [json_number(value) for value in values[keep]]})
+                return json.dumps(document).encode()
+
+        etag = self.etag(kind, station_id, mtime, timescale, baseline, policy, start_year, end_year)
+        return Resource(etag, REVALIDATE, 'application/json', self.station_executor, compute)
+
+    def anomaly_resource(self, year, month, tile, query=None):
+
+        if self.dataset is None:
+            raise HTTPError(404, 'No anomaly file is available')
+        try:
+            year = int(year)
+            month = int(month) if month.isdigit() else MONTH_NUMBERS[month.capitalize()]
+            t = self.dataset.index(year, month)
+        except (ValueError, KeyError):
+            raise HTTPError(404, 'No anomalies for ' + str(year) + ' ' + str(month)) from None
+
+        age = (self.last_month[0] - year) * 12 + self.last_month[1] - month
+        cache_control = IMMUTABLE if age >= REVISED_MONTHS else REVALIDATE
+        dataset = self.dataset
+
+        def read_region(region, step=1):
+            with self.dataset_lock:
+                return dataset.read_region(year, month, region, step)
+
+        ## Maps are limited to the named regions, so that clients cannot make the service build a map per bounding box
+        if tile is None:
+            query = query or {}
+            region = query.get('region') or None
+            if region is not None and region not in REGIONS:
+                raise HTTPError(400, 'Unknown region ' + region + ', use one of ' + ', '.join(REGIONS))
+            try:
+                step = int(query.get('step', 1))
+            except ValueError:
+                step = 0
+            if not 1 <= step <= MAX_MAP_STEP:
+                raise HTTPError(400, 'The step must be an integer from 1 to ' + str(MAX_MAP_STEP))
+
+            def compute():
+                from anomaly_map_renderer import MONTH_NAMES, get_anomaly_map_renderer
+                with span('service anomaly map'):
+                    renderer = get_anomaly_map_renderer(dataset, headless=True, region=region, step=step)
+                    renderer.set_field(read_region(region, step), MONTH_NAMES[month] + ' ' + str(year)
+                                       + ' Temperature Anomaly' + renderer.region_label())
+                    return renderer.png_bytes()
+            return Resource(self.etag('map', self.dataset_version, t, region, step), cache_control, 'image/png',
+                            self.map_executor, compute)
+
+        try:
+            z, x, y = (int(value) for value in tile)
+        except ValueError:
+            raise HTTPError(400, 'Tile coordinates must be integers') from None
+        if not 0 <= z <= MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise HTTPError(404, 'No tile ' + '/'.join(tile) + ', zoom levels go up to ' + str(MAX_TILE_ZOOM))
+
+        ## Only the zones under the tile are read
+        def compute():
+            with span('service anomaly tile'):
+                rows, columns = tile_pixel_cells(z, x, y, dataset.lat, dataset.lon)
+                bounds = tile_bounds(z, x, y)
+                lat_slice, lon_slice = dataset.region_slices(bounds)
+                return render_tile(read_region(bounds), rows - lat_slice.start, columns - lon_slice.start)
+        return Resource(self.etag('tile', self.dataset_version, t, z, x, y), cache_control, 'image/png',
+                        self.tile_executor, compute)
+
+    async def health(self):
+        return json.dumps({'status': 'ok', 'stations': len(self.registry.stations),
+                           'anomaly_months': 0 if self.dataset is None else len(self.dataset.time_index)}).encode()
+
+    async def metrics(self):
+        snapshot = {name: {key: value for key, value in stage.items()} for name, stage in metrics.snapshot().items()
+                    if name.startswith('service')}
+        return json.dumps({'counters': self.counters, 'responses_cached': len(self.responses),
+                           'latency': snapshot}).encode()
+
+
+def serve(host='127.0.0.1', port=8050, anomaly_path=None):
+
+    """
+    Runs the service until interrupted.
+    """
+
+    async def main():
+        service = ClimateService(anomaly_path)
+        server = await service.start(host, port)
+        print('Serving on http://' + host + ':' + str(server.sockets[0].getsockname()[1]), flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            service.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    return
+
+
+## Testing functionality
+def test_climate_service(tmp_path):
+
+    from anomaly_dataset import close_anomaly_datasets, write_synthetic_gistemp
+
+    path = write_synthetic_gistemp(str(tmp_path) + '/gistemp_synthetic.nc', 2000, 2003)
+
+    async def request(port, target, headers=''):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('GET ' + target + ' HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n' + headers
+                      + '\r\n').encode())
+        response = await reader.read()
+        writer.close()
+        head, body = response.split(b'\r\n\r\n', 1)
+        lines = head.decode().split('\r\n')
+        return int(lines[0].split()[1]), dict(line.split(': ', 1) for line in lines[1:]), body
+
+    async def run():
+        service = ClimateService(path)
+        server = await service.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            ## Station series agree with get_city_series and are revalidated through their ETag
+            from climate_cache import get_city_series
+            status, headers, body = await request(port, '/stations/Raleigh%2C%20NC/series?timescale=July')
+            document = json.loads(body)
+            years, values, climatology = get_city_series('Raleigh, NC', 'July')
+            assert status == 200 and document['station'] == 'USC00317074' and document['years'] == years.tolist()
+            assert abs(document['climatology'] - climatology) < 1e-4
+            assert headers['Cache-Control'] == REVALIDATE
+            status, _, body = await request(port, '/stations/USC00317074/series?timescale=July',
+                                            'If-None-Match: ' + headers['ETag'] + '\r\n')
+            assert status == 304 and body == b''
+            status, _, _ = await request(port, '/stations/USC00317074/series?timescale=June',
+                                         'If-None-Match: ' + headers['ETag'] + '\r\n')
+            assert status == 200
+
+            status, _, body = await request(port, '/stations/USC00317074/climatology?timescale=Annual')
+            assert status == 200 and json.loads(body)['count'] > 0
+            assert (await request(port, '/stations/Nowhere/series'))[0] == 404
+            assert (await request(port, '/stations/USC00317074/series?timescale=Winter'))[0] == 400
+
+            ## Old months are immutable, the last year of the file is revalidated
+            status, headers, body = await request(port, '/anomalies/2000/November.png')
+            assert status == 200 and body[:4] == b'\x89PNG' and headers['Cache-Control'] == IMMUTABLE
+            assert (await request(port, '/anomalies/2003/6.png'))[1]['Cache-Control'] == REVALIDATE
+            assert (await request(port, '/anomalies/1900/1.png'))[0] == 404
+            status, headers, body = await request(port, '/anomalies/2000/November.png?region=CONUS&step=2')
+            assert status == 200 and body[:4] == b'\x89PNG'
+            assert (await request(port, '/anomalies/2000/November.png?region=Atlantis'))[0] == 400
+            assert (await request(port, '/anomalies/2000/November.png?step=0'))[0] == 400
+
+            ## Concurrent requests for the same tile share one computation, later ones are served from memory
+            computed = service.counters['computed']
+            responses = await asyncio.gather(*[request(port, '/anomalies/2001/1/2/1/1.png') for _ in range(8)])
+            assert all(status == 200 for status, _, _ in responses)
+            assert len({body for _, _, body in responses}) == 1 and service.counters['computed'] == computed + 1
+            from PIL import Image
+            assert Image.open(io.BytesIO(responses[0][2])).size == (TILE_SIZE, TILE_SIZE)
+            rows, columns = tile_pixel_cells(2, 1, 1, service.dataset.lat, service.dataset.lon)
+            assert responses[0][2] == render_tile(service.dataset.read_slice(2001, 1), rows, columns)
+            assert (await request(port, '/anomalies/2001/1/2/4/0.png'))[0] == 404
+
+            status, _, body = await request(port, '/metrics')
+            assert status == 200 and json.loads(body)['counters']['not_modified'] == 1
+        finally:
+            server.close()
+            service.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        close_anomaly_datasets()
+    return
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Local HTTP service for station series and anomaly maps.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--anomalies', help='netCDF anomaly file (default: the GISTEMP file)')
+    arguments = parser.parse_args()
+    serve(arguments.host, arguments.port, arguments.anomalies)
@@ -0,0 +1,261 @@
+import hashlib
+import os
+
+import numpy as np
+
+from climate_records import MISSING_VALUE, TIMESCALES
+from quality_policy import archive_quality_mask, get_policy
+from station_archive import load_station_archive
+
+## Commonly used 30 year baseline periods. GISTEMP anomalies are relative to 1951-1980.
+BASELINES = {'1951-1980': (1951, 1980), '1981-2010': (1981, 2010), '1991-2020': (1991, 2020)}
+
+
+def archive_fingerprint(archive):
+
+    """
+    Digest of the station list and source modification times of an archive, used to tell whether a stored table
+    was computed from the archive as it is now.
+    """
+
+    digest = hashlib.blake2b(archive.station_ids.tobytes(), digest_size=16)
+    digest.update(archive.mtimes.tobytes())
+    return digest.hexdigest()
+
+
+def compute_station_normals(archive, baseline=(1981, 2010), stations=None, policy=None):
+
+    """
+    Computes the climate normals of every station for the annual average and each month in one vectorized pass over
+    the columnar archive. The annual average of a year is only used when all twelve months are present, and monthly
+    normals use every year in which that month is present, matching analyze_city_climate_data.
+
+    Inputs:
+    archive (StationArchive): the opened station archive.
+
+    baseline (tuple): first and last year of the normal period.
+
+    stations (ndarray): archive indexes of the stations to compute. Defaults to every station of the archive.
+
+    policy (QualityPolicy or string): quality policy whose rejected values are treated as missing (see
+    quality_policy.py). Every value is used by default.
+
+    Returns:
+    mean (ndarray): float array of shape (stations, 13) with the normals in degrees C, NaN without valid years.
+
+    std (ndarray): sample standard deviation of the yearly averages over the period.
+
+    count (ndarray): int16 number of valid years contributing to each normal.
+
+    """
+
+    if stations is None:
+        n_stations = len(archive.station_ids)
+        station_of_row = np.repeat(np.arange(n_stations), np.diff(archive.offsets))
+        rows = np.arange(len(station_of_row))
+    else:
+        n_stations = len(stations)
+        rows, station_of_row = archive.station_row_indexes(stations)
+
+    ## Only rows within the baseline period are converted to floats
+    years = np.asarray(archive.years[rows])
+    in_baseline = (years >= baseline[0]) & (years <= baseline[1])
+    rows, station_of_row = rows[in_baseline], station_of_row[in_baseline]
+    raw = np.asarray(archive.values[rows])
+    monthly = raw / 100
+    monthly[raw == MISSING_VALUE] = np.nan
+    mask = archive_quality_mask(archive, policy)
+    if mask is not None:
+        monthly[~mask[rows]] = np.nan
+    annual = monthly.mean(axis=1)
+
+    averages = np.column_stack([annual, monthly])
+
+    mean = np.full((n_stations, len(TIMESCALES)), np.nan)
+    std = np.full((n_stations, len(TIMESCALES)), np.nan)
+    count = np.zeros((n_stations, len(TIMESCALES)), dtype=np.int16)
+    for column in range(len(TIMESCALES)):
+        valid = ~np.isnan(averages[:, column])
+        values, owners = averages[valid, column], station_of_row[valid]
+        n = np.bincount(owners, minlength=n_stations)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean[:, column] = np.bincount(owners, weights=values, minlength=n_stations) / n
+            squares = np.bincount(owners, weights=(values - mean[owners, column]) ** 2, minlength=n_stations)
+            std[:, column] = np.sqrt(squares / (n - 1))
+        count[:, column] = n
+    mean[count == 0] = np.nan
+    std[count < 2] = np.nan
+
+    return mean, std, count
+
+
+class ClimatologyTable:
+
+    """
+    Climate normals of every station for one baseline period and quality policy, indexed by station ID.
+    """
+
+    def __init__(self, station_ids, mean, std, count, baseline, fingerprint='', policy=None):
+
+        self.station_ids = station_ids
+        self.mean = mean
+        self.std = std
+        self.count = count
+        self.baseline = tuple(baseline)
+        self.fingerprint = fingerprint
+        self.policy = policy
+        self.index = {station_id.decode(): i for i, station_id in enumerate(station_ids)}
+
+    def lookup(self, station_id, timescale):
+
+        """
+        Returns the (mean, std, count of valid years) normal of a station for a timescale.
+        """
+
+        i, j = self.index[station_id], TIMESCALES.index(timescale)
+        return self.mean[i, j], self.std[i, j], int(self.count[i, j])
+
+    def save(self, path):
+        np.savez(path, station_ids=self.station_ids, mean=self.mean, std=self.std, count=self.count,
+                 baseline=np.array(self.baseline), fingerprint=np.array(self.fingerprint))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as stored:
+            return cls(stored['station_ids'], stored['mean'], stored['std'], stored['count'], stored['baseline'],
+                       str(stored['fingerprint']))
+
+
+def build_climatology_table(archive, baseline=(1981, 2010)):
+
+    """
+    Computes the normals of all stations of an archive for a baseline and stores them next to the archive as
+    normals_<first>_<last>.npz.
+
+    Returns:
+    (ClimatologyTable) - the computed table.
+
+    """
+
+    mean, std, count = compute_station_normals(archive, baseline)
+    table = ClimatologyTable(archive.station_ids, mean, std, count, baseline, archive_fingerprint(archive))
+    table.save(archive.archive_dir + '/normals_' + str(baseline[0]) + '_' + str(baseline[1]) + '.npz')
+    return table
+
+
+## Tables are kept in memory per archive and baseline
+_tables = {}
+
+def load_climatology_table(baseline=(1981, 2010), archive=None, policy=None):
+
+    """
+    Returns the climatology table of a baseline period. The stored table is reused as long as it was computed from
+    the current archive, otherwise it is recomputed and stored again. Tables of a quality policy are only kept in
+    memory, next to the cached mask of the policy (see quality_policy.archive_quality_mask).
+
+    Inputs:
+    baseline (tuple or string): first and last year of the normal period, or a key of BASELINES.
+
+    archive (StationArchive): archive to use. Defaults to the station archive of the working directory.
+
+    policy (QualityPolicy or string): quality policy whose rejected values are left out of the normals.
+
+    Returns:
+    (ClimatologyTable) - the table, or None if no station archive has been built.
+
+    """
+
+    if isinstance(baseline, str):
+        baseline = BASELINES[baseline]
+    baseline = tuple(baseline)
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            return None
+
+    policy = get_policy(policy)
+    if policy is not None:
+        key = (archive.archive_dir, baseline, policy)
+        table = _tables.get(key)
+        if table is None or table.fingerprint != archive_fingerprint(archive):
+            mean, std, count = compute_station_normals(archive, baseline, policy=policy)
+            table = _tables[key] = ClimatologyTable(archive.station_ids, mean, std, count, baseline,
+                                                    archive_fingerprint(archive), policy)
+        return table
+
+    key = (archive.archive_dir, baseline)
+    if key not in _tables:
+        path = archive.archive_dir + '/normals_' + str(baseline[0]) + '_' + str(baseline[1]) + '.npz'
+        table = ClimatologyTable.load(path) if os.path.exists(path) else None
+        if table is None or table.fingerprint != archive_fingerprint(archive):
+            table = build_climatology_table(archive, baseline)
+        _tables[key] = table
+    return _tables[key]
+
+
+def clear_climatology_tables():
+
+    """
+    Drops the tables held in memory, e.g. after the archive was rebuilt.
+    """
+
+    _tables.clear()
+    return
+
+
+## Testing functionality
+def test_climatology_table(tmp_path):
+
+    import shutil
+    from load_city_climate_files import pull_location_file, parse_climate_data
+    from station_archive import build_station_archive, StationArchive
+
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+    archive = StationArchive(build_station_archive(source_dir, str(tmp_path) + '/archive'))
+
+    ## Normals agree with the dataframe computation of analyze_city_climate_data for every baseline
+    for baseline in BASELINES.values():
+        table = load_climatology_table(baseline, archive)
+        df_city_data = parse_climate_data(source_dir + '/USC00412243.FLs.52j.tavg', use_archive=False)
+        df_city_data['Average'] = df_city_data[TIMESCALES[1:]].mean(axis=1)
+        df_annual = df_city_data.dropna()
+        df_annual = df_annual.loc[(df_annual['Year'] >= baseline[0]) & (df_annual['Year'] <= baseline[1])]
+        df_june = df_city_data.dropna(subset=['June'])
+        df_june = df_june.loc[(df_june['Year'] >= baseline[0]) & (df_june['Year'] <= baseline[1])]
+
+        mean, std, count = table.lookup('USC00412243', 'Annual')
+        assert abs(mean - df_annual['Average'].mean()) < 1e-9 and count == len(df_annual)
+        assert abs(std - df_annual['Average'].std()) < 1e-9
+        mean, std, count = table.lookup('USC00412243', 'June')
+        assert abs(mean - df_june['June'].mean()) < 1e-9 and count == len(df_june)
+
+    ## Each baseline is stored separately and reused
+    assert os.path.exists(str(tmp_path) + '/archive/normals_1951_1980.npz')
+    stored = ClimatologyTable.load(str(tmp_path) + '/archive/normals_1981_2010.npz')
+    assert stored.fingerprint == archive_fingerprint(archive)
+    assert load_climatology_table('1981-2010', archive) is load_climatology_table((1981, 2010), archive)
+
+    ## Normals without the estimated values match the dataframe computation on the masked station
+    measured = load_climatology_table((1981, 2010), archive, policy='measured')
+    assert measured is load_climatology_table((1981, 2010), archive, policy='measured')
+    df_measured = parse_climate_data(source_dir + '/USC00317074.FLs.52j.tavg', use_archive=False, policy='measured')
+    df_measured = df_measured.dropna(subset=['July'])
+    df_measured = df_measured.loc[(df_measured['Year'] >= 1981) & (df_measured['Year'] <= 2010)]
+    mean, std, count = measured.lookup('USC00317074', 'July')
+    assert abs(mean - df_measured['July'].mean()) < 1e-9 and count == len(df_measured)
+    assert count < load_climatology_table((1981, 2010), archive).lookup('USC00317074', 'July')[2]
+
+    return
+
+
+## Running this file precomputes the tables of every baseline: python climatology_table.py
+if __name__ == '__main__':
+    station_archive = load_station_archive()
+    if station_archive is None:
+        raise SystemExit('Build the station archive first: python station_archive.py')
+    for name, period in BASELINES.items():
+        build_climatology_table(station_archive, period)
+        print('Stored ' + name + ' normals for ' + str(len(station_archive.station_ids)) + ' stations')
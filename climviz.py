@@ -0,0 +1,278 @@
+## Headless command line interface of the project: python climviz.py <command> [options]
+#     ingest      build (or incrementally sync) the station archive from the city climate directory
+#     normals     build the climatology tables of the baselines (and optionally the station trend table)
+#     plot-city   render static PNG/HTML time series plots of many stations in parallel
+#     plot-map    render the global anomaly map of every month of a year range, optionally as an animation
+#     export      write the monthly averages of stations to a CSV file or a partitioned Parquet dataset
+#     export-grid write the anomaly cube of a netCDF file as a chunked Zarr group
+#     serve       run the local HTTP service for station series, climatologies and anomaly maps and tiles
+#
+#     Only argparse is imported at startup. NumPy, pandas, plotly, matplotlib and netCDF4 are imported inside the
+#     command that needs them, and nothing from the notebook (ipywidgets, IPython) is ever imported, so the tool starts
+#     quickly and runs without a display or a Jupyter installation.
+import argparse
+import os
+import sys
+
+## Wall clock budget of "python climviz.py --help", checked by benchmarks/bench_startup.py and the test below
+STARTUP_BUDGET_SECONDS = 0.25
+
+## Modules that must not be imported just by starting the tool
+HEAVY_MODULES = ['numpy', 'pandas', 'plotly', 'matplotlib', 'netCDF4', 'ipywidgets', 'IPython', 'pyarrow', 'scipy']
+
+BASELINE_NAMES = ['1951-1980', '1981-2010', '1991-2020']
+TIMESCALE_NAMES = ['Annual', 'January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+                   'October', 'November', 'December']
+
+
+def parse_baseline(text):
+
+    """
+    Converts a "YYYY-YYYY" command line value into a (first year, last year) tuple.
+    """
+
+    try:
+        first, last = (int(year) for year in text.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('baselines are written as FIRST-LAST, e.g. 1981-2010')
+    return (first, last)
+
+
+def run_ingest(args):
+
+    if args.sync:
+        from station_sync import sync_station_archive
+        print(sync_station_archive(args.source, args.archive))
+    else:
+        from station_archive import build_station_archive
+        print(build_station_archive(args.source, args.archive))
+    if args.long:
+        from bulk_ingest import bulk_ingest
+        print(bulk_ingest(args.source, workers=args.workers))
+    return 0
+
+
+def run_normals(args):
+
+    from climatology_table import BASELINES, build_climatology_table
+    from station_archive import load_station_archive
+
+    archive = load_station_archive(args.archive)
+    if archive is None:
+        print('No station archive has been built. Run python climviz.py ingest first.', file=sys.stderr)
+        return 1
+    for baseline in args.baseline or list(BASELINES.values()):
+        print(build_climatology_table(archive, baseline))
+    if args.trends:
+        from trend_analysis import write_station_trends
+        print(write_station_trends(archive=archive, start_year=args.start_year, end_year=args.end_year))
+    return 0
+
+
+def run_plot_city(args):
+
+    from city_report import render_city_reports
+
+    locations = args.locations
+    if args.state or args.network:
+        from station_registry import load_station_registry
+        registry = load_station_registry()
+        locations = list(locations) + (registry.in_state(args.state) if args.state else [])
+        locations += registry.network(args.network) if args.network else []
+    if not locations and not args.all:
+        print('Give station IDs or "City, ST" locations, --state, --network or --all.', file=sys.stderr)
+        return 1
+
+    result = render_city_reports(None if args.all else locations, args.output, tuple(args.format), args.timescale,
+                                 args.start_year, args.end_year, args.baseline, args.workers)
+    print('Rendered %d stations in %.1f s (%.1f stations/s)' % (result['count'], result['seconds'],
+                                                               result['per_second']))
+    return 0
+
+
+def run_plot_map(args):
+
+    from anomaly_animation import render_anomaly_frames
+    from anomaly_dataset import open_anomaly_dataset
+
+    dataset = open_anomaly_dataset(args.dataset) if args.dataset else None
+    end_year = args.end_year if args.end_year is not None else args.start_year
+    try:
+        result = render_anomaly_frames(args.start_year, end_year, args.output, dataset=dataset, workers=args.workers,
+                                       animation=args.animation, background=not args.no_background,
+                                       region=args.region, step=args.step)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 1
+    print('Rendered %d frames in %.1f s (%.1f frames/s)' % (result['count'], result['seconds'], result['fps']))
+    return 0
+
+
+def run_export(args):
+
+    from station_export import export_station_parquet, export_station_table
+    from station_archive import load_station_archive
+
+    archive = load_station_archive(args.archive)
+    if archive is None:
+        print('No station archive has been built. Run python climviz.py ingest first.', file=sys.stderr)
+        return 1
+    file_format = args.format or ('parquet' if args.output.rstrip('/').endswith('.parquet') else 'csv')
+    export = export_station_parquet if file_format == 'parquet' else export_station_table
+    print(export(args.output, archive, args.stations or None, args.start_year, args.end_year))
+    return 0
+
+
+def run_export_grid(args):
+
+    from anomaly_dataset import export_anomaly_zarr, open_anomaly_dataset
+
+    print(export_anomaly_zarr(args.output, open_anomaly_dataset(args.dataset), tuple(args.chunks)))
+    return 0
+
+
+def run_serve(args):
+
+    from climate_service import serve
+
+    serve(args.host, args.port, args.anomalies)
+    return 0
+
+
+def build_parser():
+
+    """
+    Builds the argument parser of every command.
+    """
+
+    parser = argparse.ArgumentParser(prog='climviz', description='Headless climate visualization tools.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help='build or sync the station archive')
+    ingest.add_argument('--source', help='station directory (default: CONUS_city_climate_stats)')
+    ingest.add_argument('--archive', help='archive directory (default: station_archive)')
+    ingest.add_argument('--sync', action='store_true', help='only decode what changed since the last build')
+    ingest.add_argument('--long', action='store_true', help='also write the long format Arrow table')
+    ingest.add_argument('--workers', type=int, help='processes used for the long format table')
+    ingest.set_defaults(run=run_ingest)
+
+    normals = commands.add_parser('normals', help='build climatology tables')
+    normals.add_argument('--archive', help='archive directory (default: station_archive)')
+    normals.add_argument('--baseline', type=parse_baseline, action='append',
+                         help='baseline FIRST-LAST, repeatable (default: ' + ', '.join(BASELINE_NAMES) + ')')
+    normals.add_argument('--trends', action='store_true', help='also write the station trend table')
+    normals.add_argument('--start-year', type=int, help='first year of the trends')
+    normals.add_argument('--end-year', type=int, help='last year of the trends')
+    normals.set_defaults(run=run_normals)
+
+    plot_city = commands.add_parser('plot-city', help='render static station time series plots')
+    plot_city.add_argument('locations', nargs='*', help='station IDs or "City, ST" locations')
+    plot_city.add_argument('--all', action='store_true', help='every station of the directory')
+    plot_city.add_argument('--state', help='every station of a two letter state')
+    plot_city.add_argument('--network', help='every station of a three letter network, e.g. USC')
+    plot_city.add_argument('--timescale', default='Annual', choices=TIMESCALE_NAMES)
+    plot_city.add_argument('--start-year', type=int, default=1890)
+    plot_city.add_argument('--end-year', type=int, default=2021)
+    plot_city.add_argument('--baseline', type=parse_baseline, default=(1981, 2010))
+    plot_city.add_argument('--format', nargs='+', default=['png'], choices=['png', 'html'])
+    plot_city.add_argument('--output', help='output directory (default: city_reports)')
+    plot_city.add_argument('--workers', type=int, help='rendering processes (default: number of CPUs)')
+    plot_city.set_defaults(run=run_plot_city)
+
+    plot_map = commands.add_parser('plot-map', help='render global anomaly maps')
+    plot_map.add_argument('start_year', type=int)
+    plot_map.add_argument('end_year', type=int, nargs='?', help='last year (default: start_year)')
+    plot_map.add_argument('--output', default='anomaly_frames', help='frame directory (default: anomaly_frames)')
+    plot_map.add_argument('--animation', help='.gif or .mp4 file joining the frames')
+    plot_map.add_argument('--dataset', help='netCDF anomaly file (default: the GISTEMP file)')
+    plot_map.add_argument('--no-background', action='store_true', help='skip the bluemarble background')
+    plot_map.add_argument('--workers', type=int, help='encoding processes (default: number of CPUs)')
+    plot_map.add_argument('--region', help='named region, e.g. CONUS, or LON_MIN,LAT_MIN,LON_MAX,LAT_MAX')
+    plot_map.add_argument('--step', type=int, default=1, help='zones averaged per block side (default: 1)')
+    plot_map.set_defaults(run=run_plot_map)
+
+    export = commands.add_parser('export', help='write station monthly averages to CSV or Parquet')
+    export.add_argument('output', help='CSV file or Parquet dataset directory to write')
+    export.add_argument('stations', nargs='*', help='station IDs or "City, ST" locations (default: all)')
+    export.add_argument('--archive', help='archive directory (default: station_archive)')
+    export.add_argument('--start-year', type=int)
+    export.add_argument('--end-year', type=int)
+    export.add_argument('--format', choices=['csv', 'parquet'],
+                        help='output format (default: parquet for outputs ending in .parquet, else csv)')
+    export.set_defaults(run=run_export)
+
+    export_grid = commands.add_parser('export-grid', help='write the anomaly cube as a chunked Zarr group')
+    export_grid.add_argument('output', help='Zarr directory to write')
+    export_grid.add_argument('--dataset', help='netCDF anomaly file (default: the GISTEMP file)')
+    export_grid.add_argument('--chunks', type=int, nargs=3, default=[12, 45, 90], metavar=('TIME', 'LAT', 'LON'),
+                             help='chunk shape (default: 12 45 90)')
+    export_grid.set_defaults(run=run_export_grid)
+
+    service = commands.add_parser('serve', help='run the local HTTP service')
+    service.add_argument('--host', default='127.0.0.1')
+    service.add_argument('--port', type=int, default=8050)
+    service.add_argument('--anomalies', help='netCDF anomaly file (default: the GISTEMP file)')
+    service.set_defaults(run=run_serve)
+
+    return parser
+
+
+def main(argv=None):
+
+    """
+    Runs the command line interface and returns its exit code.
+    """
+
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+## Testing functionality
+def test_climviz_startup():
+
+    import subprocess
+
+    ## Starting the tool imports none of the heavy libraries
+    code = 'import sys, climviz; print(",".join(m for m in climviz.HEAVY_MODULES if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    assert loaded == ''
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--help'], capture_output=True, check=True)
+
+    ## The startup time budget is checked by benchmarks/bench_startup.py rather than here, since wall clock timings
+    #    depend on the machine running the tests
+    return
+
+
+def test_climviz_commands(tmp_path):
+
+    import shutil
+    import pandas as pd
+    from load_city_climate_files import pull_location_file
+
+    ## Export from an archive of a small copy of the station directory
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    shutil.copy(pull_location_file('Raleigh, NC'), source_dir)
+    archive_dir = str(tmp_path) + '/archive'
+    assert main(['ingest', '--source', source_dir, '--archive', archive_dir]) == 0
+
+    assert main(['export', str(tmp_path) + '/raleigh.csv', 'Raleigh, NC', '--archive', archive_dir,
+                 '--start-year', '2000']) == 0
+    df = pd.read_csv(str(tmp_path) + '/raleigh.csv')
+    assert set(df['Station Climate ID']) == {'USC00317074'} and df['Year'].min() == 2000
+    assert main(['export', str(tmp_path) + '/raleigh.parquet', 'Raleigh, NC', '--archive', archive_dir,
+                 '--start-year', '2000']) == 0
+    assert os.path.isdir(str(tmp_path) + '/raleigh.parquet/Network=USC/Decade=2000')
+
+    assert main(['plot-city', 'Raleigh, NC', 'Dallas, TX', '--timescale', 'June', '--output', str(tmp_path),
+                 '--workers', '1', '--format', 'png', 'html']) == 0
+    assert os.path.exists(str(tmp_path) + '/USC00317074_June.png')
+    assert os.path.exists(str(tmp_path) + '/USC00412243_June.html')
+
+    assert parse_baseline('1951-1980') == (1951, 1980)
+    return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
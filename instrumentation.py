@@ -0,0 +1,316 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+## Number of recent durations kept per stage for the percentiles
+RECENT_SAMPLES = 256
+
+
+class MetricsRegistry:
+
+    """
+    In process registry of the timings recorded by the instrumentation spans. Every stage name keeps a count, the
+    total, minimum, maximum and last duration, its recent durations for percentiles and the largest tracemalloc peak
+    seen. The stages finished during the last call of every outermost span are kept as a tree for the latency panel.
+
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.last_calls = {}
+        self.listeners = {}
+
+    def record(self, name, seconds, peak_bytes=None):
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {'count': 0, 'total': 0.0, 'min': seconds, 'max': seconds,
+                                             'last': seconds, 'peak_bytes': None,
+                                             'recent': deque(maxlen=RECENT_SAMPLES)}
+            stage['count'] += 1
+            stage['total'] += seconds
+            stage['min'] = min(stage['min'], seconds)
+            stage['max'] = max(stage['max'], seconds)
+            stage['last'] = seconds
+            stage['recent'].append(seconds)
+            if peak_bytes is not None:
+                stage['peak_bytes'] = max(stage['peak_bytes'] or 0, peak_bytes)
+        return
+
+    def record_call(self, name, tree):
+        with self._lock:
+            self.last_calls[name] = tree
+            listeners = list(self.listeners.get(name, []))
+        for listener in listeners:
+            listener(tree)
+        return
+
+    def add_listener(self, name, listener):
+
+        """
+        Calls listener with the call tree every time an outermost span of the given name finishes, e.g. to refresh a
+        latency panel after every widget update.
+        """
+
+        with self._lock:
+            self.listeners.setdefault(name, []).append(listener)
+        return
+
+    def snapshot(self):
+
+        """
+        Returns the statistics of every stage as a dictionary of plain numbers (seconds and bytes), including the mean
+        and the median and 95th percentile of the recent durations.
+        """
+
+        with self._lock:
+            snapshot = {}
+            for name, stage in self.stages.items():
+                recent = sorted(stage['recent'])
+                snapshot[name] = {'count': stage['count'], 'total': stage['total'],
+                                  'mean': stage['total'] / stage['count'], 'min': stage['min'], 'max': stage['max'],
+                                  'last': stage['last'], 'p50': recent[len(recent) // 2],
+                                  'p95': recent[min(len(recent) - 1, int(0.95 * len(recent)))],
+                                  'peak_bytes': stage['peak_bytes']}
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.last_calls.clear()
+        return
+
+
+## Shared registry and switches. Instrumentation is off unless enabled in code or with the CLIMVIZ_INSTRUMENT or
+#     CLIMVIZ_TRACE environment variables.
+metrics = MetricsRegistry()
+_enabled = False
+_memory = False
+_started_tracemalloc = False
+_trace_file = None
+_trace_lock = threading.Lock()
+_local = threading.local()
+_disabled_span = contextlib.nullcontext()
+
+
+class Span:
+
+    """
+    Times one stage of an analysis call. Spans opened inside another span on the same thread are its children: their
+    name is recorded on its own in the registry, and with their parent in the trace and the call tree.
+
+    """
+
+    __slots__ = ('name', 'start', 'start_bytes', 'outer_peak', 'carried_peak', 'children', 'depth')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.depth = len(stack)
+        self.children = [] if not stack else stack[0].children
+        self.carried_peak = 0
+
+        ## The tracemalloc peak is reset for every span, so the peak reached so far by the enclosing span is saved
+        #     first and handed back to it when this span ends
+        if _memory and tracemalloc.is_tracing():
+            current, self.outer_peak = tracemalloc.get_traced_memory()
+            self.start_bytes = current
+            tracemalloc.reset_peak()
+        else:
+            self.start_bytes = None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+
+        seconds = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+
+        peak_bytes = None
+        if self.start_bytes is not None and tracemalloc.is_tracing():
+            peak = max(tracemalloc.get_traced_memory()[1], self.carried_peak)
+            peak_bytes = max(peak - self.start_bytes, 0)
+            if stack:
+                stack[-1].carried_peak = max(stack[-1].carried_peak, self.outer_peak, peak)
+
+        metrics.record(self.name, seconds, peak_bytes)
+        parent = stack[-1].name if stack else None
+        self.children.append((self.start, self.depth, self.name, seconds, peak_bytes))
+        if not stack:
+            ## Spans are collected as they finish, so the tree is put back in the order they started
+            metrics.record_call(self.name, [child[1:] for child in sorted(self.children)])
+        if _trace_file is not None:
+            line = json.dumps({'name': self.name, 'parent': parent, 'depth': self.depth, 'start': self.start,
+                               'seconds': seconds, 'peak_bytes': peak_bytes, 'error': exc_info[0] is not None,
+                               'thread': threading.current_thread().name})
+            with _trace_lock:
+                if _trace_file is not None:
+                    _trace_file.write(line + '\n')
+        return False
+
+
+def span(name):
+
+    """
+    Returns a context manager timing a stage of an analysis call. While instrumentation is off this is a shared
+    do-nothing context manager, so an instrumented stage only costs a global lookup and an empty with block.
+
+    Inputs:
+    name (string): name of the stage, e.g. "parse_climate_data" or "read_fwf".
+
+    """
+
+    if not _enabled:
+        return _disabled_span
+    return Span(name)
+
+
+def instrumented(name):
+
+    """
+    Decorator wrapping every call of a function in a span of the given name.
+    """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def enable_instrumentation(trace_path=None, memory=False):
+
+    """
+    Turns the spans on.
+
+    Inputs:
+    trace_path (string): JSON lines file every finished span is appended to. No trace is written by default.
+
+    memory (boolean): also record the tracemalloc peak of every span. Tracing allocations slows Python code down
+    noticeably, so it is off by default.
+
+    """
+
+    global _enabled, _memory, _started_tracemalloc, _trace_file
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = open(trace_path, 'a', buffering=1, encoding='utf-8') if trace_path else None
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+    _memory = memory
+    _enabled = True
+    return
+
+
+def disable_instrumentation():
+
+    """
+    Turns the spans off, closes the trace file and stops tracemalloc if it was started by enable_instrumentation.
+    The recorded metrics are kept.
+    """
+
+    global _enabled, _memory, _started_tracemalloc, _trace_file
+    _enabled = False
+    _memory = False
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = None
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    return
+
+
+def instrumentation_enabled():
+    return _enabled
+
+
+def latency_panel_html(name):
+
+    """
+    Formats the stages of the last call of an outermost span as a small HTML table for an ipywidgets HTML panel.
+    """
+
+    tree = metrics.last_calls.get(name)
+    if not tree:
+        return '<small>No timings recorded yet.</small>'
+    rows = []
+    for depth, stage, seconds, peak_bytes in tree:
+        memory = '' if peak_bytes is None else '%.1f MB' % (peak_bytes / 2**20)
+        rows.append('<tr><td style="padding-left:%dem">%s</td><td style="text-align:right">%.1f ms</td>'
+                    '<td style="text-align:right">%s</td></tr>' % (depth, stage, seconds * 1000, memory))
+    return '<table style="font-size:small">' + ''.join(rows) + '</table>'
+
+
+if os.environ.get('CLIMVIZ_INSTRUMENT') or os.environ.get('CLIMVIZ_TRACE'):
+    enable_instrumentation(os.environ.get('CLIMVIZ_TRACE') or None,
+                           memory=os.environ.get('CLIMVIZ_INSTRUMENT') == 'memory')
+
+
+## Testing functionality
+def test_instrumentation(tmp_path):
+
+    trace_path = str(tmp_path) + '/trace.jsonl'
+    metrics.reset()
+    calls = []
+    metrics.add_listener('outer', calls.append)
+    enable_instrumentation(trace_path, memory=True)
+    try:
+        with span('outer'):
+            with span('allocate'):
+                block = bytearray(4 * 2**20)
+            with span('inner'):
+                del block
+    finally:
+        disable_instrumentation()
+
+    snapshot = metrics.snapshot()
+    assert snapshot['outer']['count'] == 1
+    assert snapshot['outer']['total'] >= snapshot['allocate']['total'] + snapshot['inner']['total']
+    assert snapshot['allocate']['peak_bytes'] >= 4 * 2**20
+    assert snapshot['outer']['peak_bytes'] >= 4 * 2**20
+
+    ## The last call of the outermost span is kept as a tree with the outer span first
+    assert [(depth, name) for depth, name, _, _ in metrics.last_calls['outer']] == [(0, 'outer'), (1, 'allocate'),
+                                                                                    (1, 'inner')]
+    assert 'allocate' in latency_panel_html('outer')
+    assert calls == [metrics.last_calls['outer']]
+
+    with open(trace_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['name'] for line in lines] == ['allocate', 'inner', 'outer']
+    assert lines[0]['parent'] == 'outer' and lines[2]['parent'] is None
+
+    ## Nothing is recorded while instrumentation is off, and a disabled span costs well under a microsecond
+    with span('outer'):
+        pass
+    assert metrics.snapshot()['outer']['count'] == 1
+    start = time.perf_counter()
+    for _ in range(100000):
+        with span('off'):
+            pass
+    assert (time.perf_counter() - start) / 100000 < 1e-6
+
+    metrics.reset()
+    return
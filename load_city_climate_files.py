@@ -1,39 +1,29 @@
-import glob
 import os
 
+from instrumentation import instrumented, span
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+@instrumented('pull_location_file')
 def pull_location_file(location):
     
     """
     This function matches an inputted city within CONUS to the associated climate file for that location. 
-    The location is matched via a dictionary to the associated The file
+    The location is matched via the station registry to the associated The file
     pulled corresponds to the parameter input which could either be average temperature or average precipitation.
     The file name is returned.
     
     Inputs:
-    location (string): structured "City, ST" in which the state is the two letter state abbreviation.
+    location (string): structured "City, ST" in which the state is the two letter state abbreviation, or a station ID.
     
     Returns:
     used_filepath (string): filepath corresponding to the location of the city climate file.
     
     """
     
-    ## Load the dictionary with cities and their corresponding Cooperative Observer Identification Numbers.
-    #    This dictionary can be expanded to all cities located in the climate directory.
-    
-    city_dictionary = {'Raleigh, NC': '317074', 'Albany, NY': '300047',
-                      'Seattle, WA': '457478', 'Dallas, TX': '412243',
-                      'Salt Lake City, UT': '427578', 'Bismark, ND': '320818',
-                      'Kansas City, MO': '234379', 'Flagstaff, AZ': '023009',
-                      'Indianapolis, IN': '124260', 'Tallahassee, FL': '088756'}
-    
-    # Pull the city's ID
-    desired_ID = city_dictionary[location]
-    
-    # Find the filepath of the individual station file
-    filepath = glob.glob(os.getcwd() + '/CONUS_city_climate_stats/USC00'+ desired_ID +'.FLs.52j.tavg') 
-    
-    # Originally interpreted as a list, and must me pulled as a string.
-    used_filepath = filepath[0]
+    ## The registry indexes every station of the climate directory once, so matching a "City, ST" name (or a station
+    #    ID) to its file is a dictionary lookup rather than a search of the directory.
+    used_filepath = load_station_registry().filepath(location)
     
     return used_filepath
 
@@ -44,8 +34,6 @@ def test_pull_location_file():
     assert pull_location_file('Tallahassee, FL') == os.getcwd() + '/CONUS_city_climate_stats/USC00088756.FLs.52j.tavg'
     return
 
-test_pull_location_file()
-
 ## Passes all tests.
 
 
@@ -54,20 +42,97 @@ test_pull_location_file()
 
 import glob
 import os
+import numpy as np
 import pandas as pd
 
-def parse_climate_data(used_filename):
+from climate_records import (MISSING_VALUE, decode_station_records, encode_flags, flags_to_frame, read_record_bytes,
+                             records_to_frame, scale_values)
+from quality_policy import get_policy
+
+def parse_climate_records(used_filename):
+    
+    """
+    Vectorized parser for a city climate data file. The whole file is read as a single bytes buffer and the fixed
+    11/5/9x12 character layout is split into values and flag characters in one NumPy pass, so no intermediate
+    strings or regex replacements are needed.
+    
+    Parameters:
+        used_filename (String) - The filename of the city climate file to be parsed.
+    Returns:
+        station_id (String) - The station ID of the file.
+        years (ndarray) - The year of every row.
+        values (ndarray) - Monthly averages in degrees Celsius of shape (rows, 12), missing values are NaN.
+        flags (ndarray) - uint8 flag characters of shape (rows, 12, 3) belonging to each monthly value.
+    """
+    
+    station_ids, years, raw_values, flags = decode_station_records(read_record_bytes(used_filename))
+    station_id = station_ids[0].decode() if len(station_ids) else os.path.basename(used_filename).split('.')[0]
+    
+    return station_id, years, scale_values(raw_values), flags
+
+@instrumented('parse_climate_data')
+def parse_climate_data(used_filename, use_archive=True, engine='numpy', policy=None, return_flags=False):
     
     """
     Processes a city climate data file that includes and format into a Pandas dataframe.
     Values of -9999 are interpreted as missing values. Each datapoint is scaled accordingly.
+    If the station archive has been built (see station_archive.py) and the file has not changed since, the
+    dataframe is read from the memory mapped archive instead of parsing the text file.
     
     Parameters:
         used_filename (String) - The filename of the city climate file to be parsed.
+        use_archive (Boolean) - Whether the station archive may be used in place of the text file.
+        engine (String) - "numpy" for the vectorized fixed width parser, "fwf" for the original pandas read_fwf parser.
+        policy (QualityPolicy or String) - Quality policy whose rejected values are set to missing (see
+            quality_policy.py). Every value is kept by default.
+        return_flags (Boolean) - Whether the flags are returned as well.
     Returns:
         (df) - A DataFrame containing all of the parsed and adjusted data.
+        (df_flags) - Only with return_flags: a DataFrame with the year and the flags of every monthly value as
+            categoricals (see climate_records.flags_to_frame).
     """
     
+    policy = get_policy(policy)
+    if engine == 'fwf' and (policy is not None or return_flags):
+        raise ValueError('The fwf engine discards the flags, use the numpy engine for quality policies')
+    
+    ## Read from the archive when it holds an up to date copy of this station
+    archived = None
+    if use_archive:
+        with span('archive lookup'):
+            archive = load_station_archive()
+            station_id = os.path.basename(used_filename).split('.')[0]
+            fresh = archive is not None and archive.is_fresh(station_id, used_filename)
+        if fresh:
+            with span('archive read'):
+                if policy is None and not return_flags:
+                    return archive.station_frame(station_id)
+                archived = (station_id,) + archive.station_rows(station_id)
+    
+    if engine == 'numpy':
+        if archived is None:
+            with span('read file'):
+                buffer = read_record_bytes(used_filename)
+            with span('decode records'):
+                station_ids, years, raw_values, flags = decode_station_records(buffer)
+            station_id = station_ids[0].decode() if len(station_ids) else os.path.basename(used_filename).split('.')[0]
+        else:
+            station_id, years, raw_values, flags = archived
+        
+        ## The flags come out of the same decoding pass as the values, and a policy is applied as a mask on them
+        if policy is not None or return_flags:
+            with span('quality mask'):
+                flag_codes, flag_table = encode_flags(flags)
+                if policy is not None:
+                    raw_values = np.where(policy.mask(flag_codes, flag_table, years), raw_values, MISSING_VALUE)
+        with span('build frame'):
+            df = records_to_frame(station_id, years, raw_values)
+            if return_flags:
+                return df, flags_to_frame(years, flag_codes, flag_table)
+            return df
+    elif engine != 'fwf':
+        raise ValueError('Unknown parsing engine: ' + str(engine))
+    
     ## Specify column names to hold the station average temperatures for each month for a range of years
     headings = ['Station Climate ID', 'Year', 'January', 'February', 'March', 'April',
                                  'May', 'June', 'July', 'August', 'September',
@@ -77,21 +142,24 @@ def parse_climate_data(used_filename):
     widths = [11, 5, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9]
     
     ## Generate a dataframe based upon file organization and widths provided. Encoded nan values are taken into account.
-    df = pd.read_fwf(used_filename, names=headings, header=None, widths=widths, na_values=[-9999])
+    with span('read_fwf'):
+        df = pd.read_fwf(used_filename, names=headings, header=None, widths=widths, na_values=[-9999])
     
     ## These lines handle special characters which pertain to "flags" applied to the downloaded dataset. These flags can
     #     be ignored for the purposes of this project as many are informational and do not indicate insufficient data quality.
     #     "regex" specifies the letters that become replaced. This is the easiest way to maintain negative values.
-    df[['January','February','March','April','May','June','July','August',
-       'September','October','November','December']]= df[['January','February','March','April','May','June','July','August',
-       'September','October','November','December']].replace(regex=['a','b','c','d','e','f','g','h','i','E','X',
-                                                                   'D','I','L','M','O','S','W','A','M','Q'], value="")
+    with span('flag cleanup'):
+        df[['January','February','March','April','May','June','July','August',
+           'September','October','November','December']]= df[['January','February','March','April','May','June','July','August',
+           'September','October','November','December']].replace(regex=['a','b','c','d','e','f','g','h','i','E','X',
+                                                                       'D','I','L','M','O','S','W','A','M','Q'], value="")
     
     ## Further data adjustment. Measurements must be divided by 100 as the data is encoded as integers but represent
     #     measurements in degrees Celsius to the hundreths place
-    df[['January','February','March','April','May','June','July','August',
-       'September','October','November','December']]= df[['January','February','March','April','May','June','July','August',
-       'September','October','November','December']].astype(float)/100
+    with span('scale values'):
+        df[['January','February','March','April','May','June','July','August',
+           'September','October','November','December']]= df[['January','February','March','April','May','June','July','August',
+           'September','October','November','December']].astype(float)/100
 
     return df
 
@@ -110,6 +178,32 @@ def test_parse_climate_data():
     
     return
 
-test_parse_climate_data()
+def test_parse_climate_records():
+    
+    used_filepath = pull_location_file('Raleigh, NC')
+    station_id, years, values, flags = parse_climate_records(used_filepath)
+    
+    ## The vectorized parser must agree with the original read_fwf parser
+    df_expected = parse_climate_data(used_filepath, use_archive=False, engine='fwf')
+    pd.testing.assert_frame_equal(parse_climate_data(used_filepath, use_archive=False), df_expected)
+    
+    assert station_id == 'USC00317074'
+    assert values.shape == (131, 12)
+    assert values[128, 0] == 8.30
+    assert bytes(flags[1, 0]) == b'E  ' #Flags are kept instead of being discarded
+    
+    ## Estimated values can be told apart from measured ones and masked out by a quality policy, from the text file
+    #     and from the archive alike
+    for use_archive in [False, True]:
+        df, df_flags = parse_climate_data(used_filepath, use_archive=use_archive, return_flags=True)
+        pd.testing.assert_frame_equal(df, df_expected)
+        assert df_flags.loc[1, 'January'] == 'E  ' and df_flags['January'].dtype == 'category'
+        df_measured = parse_climate_data(used_filepath, use_archive=use_archive, policy='measured')
+        months = df_expected.columns[2:]
+        estimated = np.char.startswith(df_flags[months].to_numpy().astype(str), 'E')
+        assert np.isnan(df_measured.loc[1, 'January'])
+        assert np.array_equal(df_measured[months].isna().to_numpy(), estimated | df_expected[months].isna().to_numpy())
+    
+    return
 
 ## Passes all tests.
\ No newline at end of file
@@ -0,0 +1,209 @@
+import numpy as np
+
+from climate_records import encode_flags
+
+## The first flag of every monthly value is the measurement flag: "E" marks a value estimated from neighbouring
+#     stations and "a" to "i" a monthly average computed with 1 to 9 days missing. The second flag is the quality
+#     control flag, blank unless the value failed a check, and the third flag names the source of the value.
+ESTIMATED_FLAG = ord('E')
+DAYS_MISSING_FLAGS = np.frombuffer(b'abcdefghi', dtype=np.uint8)
+BLANK_FLAG = ord(' ')
+DAYS_IN_MONTH = np.array([[31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31],
+                          [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]], dtype=np.int16)
+
+
+class QualityPolicy:
+
+    """
+    Rule deciding which monthly values are used, based on their flags. Values rejected by a policy are treated as
+    missing. Policies compare and hash by their settings, so the masks derived from them can be cached per policy.
+
+    Inputs:
+    exclude_estimated (boolean): reject values estimated from neighbouring stations ("E" measurement flag).
+
+    exclude_failed_qc (boolean): reject values with any quality control flag.
+
+    min_observed_days (integer): reject monthly averages computed from fewer observed days (days of the month minus
+    the days missing given by the "a" to "i" measurement flags).
+
+    sources (string): source flags accepted, e.g. "3" or " 3". Every source is accepted by default.
+
+    """
+
+    __slots__ = ('exclude_estimated', 'exclude_failed_qc', 'min_observed_days', 'sources')
+
+    def __init__(self, exclude_estimated=False, exclude_failed_qc=False, min_observed_days=None, sources=None):
+        self.exclude_estimated = bool(exclude_estimated)
+        self.exclude_failed_qc = bool(exclude_failed_qc)
+        self.min_observed_days = None if min_observed_days is None else int(min_observed_days)
+        self.sources = None if sources is None else ''.join(sorted(set(sources)))
+
+    def key(self):
+        return (self.exclude_estimated, self.exclude_failed_qc, self.min_observed_days, self.sources)
+
+    def __eq__(self, other):
+        return isinstance(other, QualityPolicy) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return ('QualityPolicy(exclude_estimated=' + str(self.exclude_estimated) + ', exclude_failed_qc='
+                + str(self.exclude_failed_qc) + ', min_observed_days=' + str(self.min_observed_days) + ', sources='
+                + repr(self.sources) + ')')
+
+    @property
+    def accepts_everything(self):
+        return self.key() == (False, False, None, None)
+
+    def code_rules(self, flag_table):
+
+        """
+        Evaluates the policy once per flag combination of a flag table.
+
+        Returns:
+        allowed (ndarray): boolean of shape (combinations,), False for combinations rejected whatever the month.
+
+        days_missing (ndarray): int16 number of days missing of every combination.
+
+        """
+
+        measurement, quality, source = flag_table[:, 0], flag_table[:, 1], flag_table[:, 2]
+        allowed = np.ones(len(flag_table), dtype=bool)
+        if self.exclude_estimated:
+            allowed &= measurement != ESTIMATED_FLAG
+        if self.exclude_failed_qc:
+            allowed &= quality == BLANK_FLAG
+        if self.sources is not None:
+            allowed &= np.isin(source, np.frombuffer(self.sources.encode('ascii'), dtype=np.uint8))
+        days_missing = np.where(np.isin(measurement, DAYS_MISSING_FLAGS), measurement.astype(np.int16) - ord('a') + 1,
+                                0).astype(np.int16)
+        return allowed, days_missing
+
+    def mask(self, flag_codes, flag_table, years):
+
+        """
+        Computes which values pass the policy. The policy is evaluated once per flag combination of the table and the
+        result is looked up for every value through its code, so a mask costs one pass over the codes.
+
+        Inputs:
+        flag_codes (ndarray): uint8 flag codes of shape (records, 12), see climate_records.encode_flags.
+
+        flag_table (ndarray): the flag table of the codes.
+
+        years (ndarray): year of every record, for the length of February.
+
+        Returns:
+        (ndarray) - boolean array of shape (records, 12), True where the value is kept.
+
+        """
+
+        allowed, days_missing = self.code_rules(flag_table)
+        keep = allowed[flag_codes]
+        if self.min_observed_days is not None:
+            years = np.asarray(years)
+            leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+            observed = DAYS_IN_MONTH[leap.astype(np.int8)] - days_missing[flag_codes]
+            keep &= observed >= self.min_observed_days
+        return keep
+
+    def flags_mask(self, flags, years):
+
+        """
+        Version of mask for the flag characters of shape (records, 12, 3) returned by decode_station_records.
+        """
+
+        flag_codes, flag_table = encode_flags(flags)
+        return self.mask(flag_codes, flag_table, years)
+
+
+## Commonly used policies
+POLICIES = {'all': QualityPolicy(),
+            'measured': QualityPolicy(exclude_estimated=True),
+            'qc passed': QualityPolicy(exclude_failed_qc=True),
+            'strict': QualityPolicy(exclude_estimated=True, exclude_failed_qc=True, min_observed_days=25)}
+
+
+def get_policy(policy):
+
+    """
+    Returns the QualityPolicy for a policy or a key of POLICIES, and None when every value is accepted so that
+    callers can skip masking altogether.
+    """
+
+    if isinstance(policy, str):
+        policy = POLICIES[policy]
+    if policy is None or policy.accepts_everything:
+        return None
+    return policy
+
+
+## Masks of whole archives, kept per archive and policy
+_archive_masks = {}
+
+def archive_quality_mask(archive, policy):
+
+    """
+    Returns the mask of every archived record under a policy. Masks are computed from the archive's flag codes (see
+    station_series.archive_flag_codes) and cached per policy, so the normals and trends of several policies can be
+    computed and compared without decoding the flags again.
+
+    Inputs:
+    archive (StationArchive): the opened station archive.
+
+    policy (QualityPolicy or string): the policy or a key of POLICIES.
+
+    Returns:
+    (ndarray) - boolean array of shape (records, 12), True where the value is kept, or None when the policy accepts
+    every value.
+
+    """
+
+    from station_series import archive_flag_codes
+
+    policy = get_policy(policy)
+    if policy is None:
+        return None
+    key = (archive.archive_dir, policy)
+    stored = _archive_masks.get(key)
+    if stored is None or stored[0] is not archive:
+        flag_codes, flag_table = archive_flag_codes(archive)
+        stored = _archive_masks[key] = (archive, policy.mask(flag_codes, flag_table, archive.years))
+    return stored[1]
+
+
+def clear_quality_masks():
+
+    """
+    Drops the cached archive masks, e.g. to free their memory.
+    """
+
+    _archive_masks.clear()
+    return
+
+
+## Testing functionality
+def test_quality_policy():
+
+    from climate_records import decode_station_records, read_record_bytes
+    from load_city_climate_files import pull_location_file
+
+    _, years, values, flags = decode_station_records(read_record_bytes(pull_location_file('Raleigh, NC')))
+    flag_codes, flag_table = encode_flags(flags)
+
+    ## Raleigh's first record is estimated from July to November
+    measured = POLICIES['measured'].mask(flag_codes, flag_table, years)
+    assert measured[0, :6].all() and not measured[0, 6:11].any()
+    assert np.array_equal(measured, flags[:, :, 0] != ord('E'))
+    assert np.array_equal(POLICIES['measured'].flags_mask(flags, years), measured)
+    assert get_policy('all') is None and get_policy(QualityPolicy()) is None
+
+    ## Days missing: "c" means 3 days missing, so a 31 day month has 28 observed days and February 25 or 26
+    table = np.frombuffer(b'   c  ', dtype=np.uint8).reshape(2, 3)
+    codes = np.array([[1] * 12, [1] * 12, [0] * 12], dtype=np.uint8)
+    keep = QualityPolicy(min_observed_days=26).mask(codes, table, np.array([1999, 2000, 1999]))
+    assert not keep[0, 1] and keep[1, 1] and keep[0, 0] and keep[2].all()
+    assert QualityPolicy(min_observed_days=26) == QualityPolicy(min_observed_days=26.0)
+    assert len({QualityPolicy(sources='3 '), QualityPolicy(sources=' 3')}) == 1
+
+    return
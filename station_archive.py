@@ -0,0 +1,323 @@
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from climate_records import (RECORD_LENGTH, decode_station_records, read_record_bytes, record_hashes,
+                             records_to_frame)
+
+ARCHIVE_FILES = ['station_ids.npy', 'offsets.npy', 'mtimes.npy', 'file_hashes.npy', 'years.npy', 'values.npy',
+                 'flags.npy', 'line_hashes.npy']
+
+
+def file_digest(content):
+
+    """
+    Returns the 16 byte blake2b digest of the contents of a station file.
+    """
+
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def build_station_archive(source_dir=None, archive_dir=None, chunk_size=512):
+
+    """
+    Converts every .FLs.52j.tavg file of the city climate directory into a columnar archive of NumPy arrays that can
+    be memory mapped. This is a one time conversion, the archive only needs to be rebuilt when the source files change.
+
+    Inputs:
+    source_dir (string): directory holding the station files. Defaults to CONUS_city_climate_stats in the working
+    directory.
+
+    archive_dir (string): directory the archive is written to. Defaults to station_archive in the working directory.
+
+    chunk_size (integer): number of station files decoded together in one NumPy pass.
+
+    Returns:
+    archive_dir (string): the directory holding the archive.
+
+    """
+
+    if source_dir is None:
+        source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+    if archive_dir is None:
+        archive_dir = os.getcwd() + '/station_archive'
+
+    filepaths = sorted(glob.glob(source_dir + '/*.FLs.52j.tavg'))
+    if not filepaths:
+        raise FileNotFoundError('No station files found in ' + source_dir)
+
+    station_ids = []
+    mtimes = []
+    digests = []
+    counts = []
+    years, values, flags, hashes = [], [], [], []
+
+    ## Station files are decoded in chunks so that a single buffer never holds the whole directory
+    for start in range(0, len(filepaths), chunk_size):
+        contents = []
+        for filepath in filepaths[start:start + chunk_size]:
+            content = read_record_bytes(filepath)
+            contents.append(content)
+            station_ids.append(os.path.basename(filepath).split('.')[0])
+            mtimes.append(os.stat(filepath).st_mtime_ns)
+            digests.append(file_digest(content))
+            counts.append(len(content) // RECORD_LENGTH)
+
+        buffer = b''.join(contents)
+        _, chunk_years, chunk_values, chunk_flags = decode_station_records(buffer)
+        years.append(chunk_years)
+        values.append(chunk_values)
+        flags.append(chunk_flags)
+        hashes.append(record_hashes(buffer))
+
+    arrays = {'station_ids': np.array(station_ids, dtype='S11'),
+              'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+              'mtimes': np.array(mtimes, dtype=np.int64),
+              'file_hashes': np.frombuffer(b''.join(digests), dtype=np.uint8).reshape(-1, 16),
+              'years': np.concatenate(years),
+              'values': np.concatenate(values),
+              'flags': np.concatenate(flags),
+              'line_hashes': np.concatenate(hashes)}
+    write_archive_arrays(archive_dir, arrays, source_dir)
+
+    return archive_dir
+
+
+def write_archive_arrays(archive_dir, arrays, source_dir):
+
+    """
+    Writes the arrays of an archive and its manifest. Every file is written under a temporary name and then moved in
+    place, so no file is ever seen half written and archives opened before keep their memory maps of the old files.
+    The files are replaced one after the other though, so an archive opened while they are being replaced may mix
+    arrays of the old and the new build. The directory is not swapped as a whole since it also holds the tables
+    derived from the archive (normals, trends, widget state).
+
+    Inputs:
+    archive_dir (string): directory the archive is written to.
+
+    arrays (dict): archive array name (see ARCHIVE_FILES) mapped to its array.
+
+    source_dir (string): directory holding the station files the archive was made from.
+
+    """
+
+    os.makedirs(archive_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(archive_dir + '/' + name + '.tmp.npy', array)
+    for name in arrays:
+        os.replace(archive_dir + '/' + name + '.tmp.npy', archive_dir + '/' + name + '.npy')
+
+    with open(archive_dir + '/manifest.json.tmp', 'w') as f:
+        json.dump({'source_dir': os.path.realpath(source_dir), 'stations': len(arrays['station_ids']),
+                   'records': int(arrays['offsets'][-1])}, f)
+    os.replace(archive_dir + '/manifest.json.tmp', archive_dir + '/manifest.json')
+    return
+
+
+class StationArchive:
+
+    """
+    Memory mapped view of an archive written by build_station_archive. Station rows are located through an in memory
+    dictionary so reading a station does not touch the source directory beyond a single staleness check.
+
+    """
+
+    def __init__(self, archive_dir):
+
+        self.archive_dir = archive_dir
+        with open(archive_dir + '/manifest.json') as f:
+            self.manifest = json.load(f)
+        self.source_dir = self.manifest['source_dir']
+
+        self.station_ids = np.load(archive_dir + '/station_ids.npy')
+        self.offsets = np.load(archive_dir + '/offsets.npy')
+        self.mtimes = np.load(archive_dir + '/mtimes.npy')
+        self.years = np.load(archive_dir + '/years.npy', mmap_mode='r')
+        self.values = np.load(archive_dir + '/values.npy', mmap_mode='r')
+        self.flags = np.load(archive_dir + '/flags.npy', mmap_mode='r')
+
+        ## Content hashes used by station_sync.py, missing from archives built before they were added
+        self.file_hashes, self.line_hashes = None, None
+        if os.path.exists(archive_dir + '/line_hashes.npy'):
+            self.file_hashes = np.load(archive_dir + '/file_hashes.npy')
+            self.line_hashes = np.load(archive_dir + '/line_hashes.npy', mmap_mode='r')
+
+        self.index = {station_id.decode(): i for i, station_id in enumerate(self.station_ids)}
+
+    def __contains__(self, station_id):
+        return station_id in self.index
+
+    def source_path(self, station_id):
+        return self.source_dir + '/' + station_id + '.FLs.52j.tavg'
+
+    def is_fresh(self, station_id, filepath=None):
+
+        """
+        Checks whether the archived rows of a station still match its source file by comparing modification times.
+
+        Inputs:
+        station_id (string): 11 character station ID.
+
+        filepath (string): path of the station file. Defaults to the file in the archived source directory.
+
+        Returns:
+        (boolean) - True if the station is archived and its source file has not been modified since.
+
+        """
+
+        if station_id not in self.index:
+            return False
+        if filepath is None:
+            filepath = self.source_path(station_id)
+        elif os.path.realpath(os.path.dirname(filepath)) != self.source_dir:
+            return False
+        try:
+            mtime = os.stat(filepath).st_mtime_ns
+        except OSError:
+            return False
+        return mtime == self.mtimes[self.index[station_id]]
+
+    def stale_stations(self):
+
+        """
+        Compares the archive against its whole source directory.
+
+        Returns:
+        (list) - station IDs that were added, removed or modified since the archive was built.
+
+        """
+
+        current = {os.path.basename(filepath).split('.')[0]: os.stat(filepath).st_mtime_ns
+                   for filepath in glob.glob(self.source_dir + '/*.FLs.52j.tavg')}
+        stale = [station_id for station_id in self.index if station_id not in current]
+        stale += [station_id for station_id, mtime in current.items()
+                  if station_id not in self.index or self.mtimes[self.index[station_id]] != mtime]
+        return sorted(stale)
+
+    def station_rows(self, station_id):
+
+        """
+        Returns the archived years, raw values and flags of one station as views into the memory mapped arrays.
+        """
+
+        i = self.index[station_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.years[start:end], self.values[start:end], self.flags[start:end]
+
+    def station_row_indexes(self, stations):
+
+        """
+        Returns the archive rows of several stations at once.
+
+        Inputs:
+        stations (ndarray): archive indexes of the stations.
+
+        Returns:
+        rows (ndarray): index of every archived row of those stations, station after station.
+
+        owners (ndarray): position in stations of the station each row belongs to.
+
+        """
+
+        stations = np.asarray(stations, dtype=np.int64)
+        starts = self.offsets[stations]
+        counts = self.offsets[stations + 1] - starts
+        owners = np.repeat(np.arange(len(stations)), counts)
+        rows = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        return rows, owners
+
+    def station_frame(self, station_id):
+
+        """
+        Builds the same DataFrame parse_climate_data produces for a station, straight from the archived arrays.
+
+        Inputs:
+        station_id (string): 11 character station ID.
+
+        Returns:
+        (df) - A DataFrame containing the station ID, year and the twelve monthly averages in degrees C.
+
+        """
+
+        years, values, _ = self.station_rows(station_id)
+        return records_to_frame(station_id, years, values)
+
+
+## Archives are opened once per directory and reused across calls
+_open_archives = {}
+
+def load_station_archive(archive_dir=None):
+
+    """
+    Opens the station archive, reusing an already opened archive for the same directory.
+
+    Inputs:
+    archive_dir (string): directory holding the archive. Defaults to station_archive in the working directory.
+
+    Returns:
+    (StationArchive) - the opened archive, or None if no archive has been built.
+
+    """
+
+    if archive_dir is None:
+        archive_dir = os.getcwd() + '/station_archive'
+    if archive_dir not in _open_archives:
+        if not os.path.exists(archive_dir + '/manifest.json'):
+            return None
+        _open_archives[archive_dir] = StationArchive(archive_dir)
+    return _open_archives[archive_dir]
+
+
+def close_station_archive(archive_dir=None):
+
+    """
+    Drops an opened archive so that the next load_station_archive call maps the files again, e.g. after a rebuild.
+    """
+
+    if archive_dir is None:
+        _open_archives.clear()
+    else:
+        _open_archives.pop(archive_dir, None)
+    return
+
+
+## Testing functionality
+def test_build_station_archive(tmp_path):
+
+    import shutil
+    from load_city_climate_files import pull_location_file, parse_climate_data
+
+    ## Archive a small copy of the station directory and compare against the text parser
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+    archive_dir = build_station_archive(source_dir, str(tmp_path) + '/archive', chunk_size=2)
+    archive = StationArchive(archive_dir)
+
+    assert len(archive.station_ids) == 3
+    for station_id in archive.index:
+        expected = parse_climate_data(source_dir + '/' + station_id + '.FLs.52j.tavg', use_archive=False)
+        pd.testing.assert_frame_equal(archive.station_frame(station_id), expected)
+        assert archive.is_fresh(station_id)
+
+    ## Raleigh's first record is flagged "E" from July onwards
+    _, _, flags = archive.station_rows('USC00317074')
+    assert bytes(flags[0, 6]) == b'E  '
+
+    ## Touching a source file marks only that station as stale
+    os.utime(source_dir + '/USC00317074.FLs.52j.tavg', ns=(0, 0))
+    assert not archive.is_fresh('USC00317074')
+    assert archive.stale_stations() == ['USC00317074']
+
+    return
+
+
+## Running this file performs the one time conversion: python station_archive.py [source_dir] [archive_dir]
+if __name__ == '__main__':
+    import sys
+    print(build_station_archive(*sys.argv[1:3]))
@@ -0,0 +1,204 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import plotly.graph_objects as go
+
+from climate_cache import compute_timescale_series
+from load_city_climate_files import parse_climate_data
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+## Result of analyze_stations. anomalies has one row per station and one column per year, NaN where a station has no
+#     average for that year.
+StationComparison = namedtuple('StationComparison', ['station_ids', 'years', 'anomalies', 'climatology',
+                                                     'mean', 'spread', 'count', 'traces'])
+
+
+def load_station_frames(station_ids, workers=None):
+
+    """
+    Parses the files of several stations in parallel into the dataframes produced by parse_climate_data.
+
+    Inputs:
+    station_ids (list): 11 character station IDs.
+
+    workers (integer): number of threads. Defaults to the number of CPUs, at most 8.
+
+    Returns:
+    (list) - one dataframe per station, in the order of station_ids.
+
+    """
+
+    registry = load_station_registry()
+    filepaths = [registry.filepath(station_id) for station_id in station_ids]
+
+    ## The archive is opened before the threads start, so they all share the same memory mapped copy
+    load_station_archive()
+    if workers is None:
+        workers = min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(parse_climate_data, filepaths))
+
+
+def align_station_series(frames, timescale, baseline=(1981, 2010)):
+
+    """
+    Computes the averages of a timescale for every station and places them on a shared year index.
+
+    Inputs:
+    frames (list): dataframes produced by parse_climate_data.
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    baseline (tuple): first and last year of the climatology each station is compared to.
+
+    Returns:
+    years (ndarray): every year from the first to the last year with an average at any station.
+
+    values (ndarray): averages of shape (stations, years), NaN where a station has no average for a year.
+
+    climatology (ndarray): mean of each station's averages over the baseline period.
+
+    """
+
+    series = [compute_timescale_series(frame, timescale, baseline) for frame in frames]
+    climatology = np.array([station_climatology for _, _, station_climatology in series])
+
+    all_years = [station_years for station_years, _, _ in series if len(station_years)]
+    if not all_years:
+        return np.array([], dtype=int), np.full((len(frames), 0), np.nan), climatology
+    first = min(station_years[0] for station_years in all_years)
+    last = max(station_years[-1] for station_years in all_years)
+    years = np.arange(first, last + 1)
+
+    ## Every station's averages are scattered into its row of the matrix at the column of their year
+    values = np.full((len(frames), len(years)), np.nan)
+    rows = np.repeat(np.arange(len(series)), [len(station_years) for station_years, _, _ in series])
+    columns = np.concatenate([station_years for station_years, _, _ in series]).astype(int) - first
+    values[rows, columns] = np.concatenate([station_values for _, station_values, _ in series])
+    return years, values, climatology
+
+
+def ensemble_statistics(anomalies):
+
+    """
+    Returns the mean, the standard deviation and the number of stations with data for every year (column) of a
+    station by year matrix, ignoring NaN. Years without any data have a NaN mean and spread.
+    """
+
+    present = ~np.isnan(anomalies)
+    count = present.sum(axis=0)
+    filled = np.where(present, anomalies, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=0) / count
+        spread = np.sqrt(np.where(present, (filled - mean) ** 2, 0).sum(axis=0) / count)
+    return mean, spread, count
+
+
+def station_traces(station_ids, years, anomalies, mean, spread):
+
+    """
+    Builds the WebGL plotly traces of a comparison: one thin line per station, the ensemble spread as a band of one
+    standard deviation around the mean, and the ensemble mean. Scattergl keeps hundreds of lines interactive.
+    """
+
+    traces = [go.Scattergl(x=years, y=row, mode='lines', name=station_id, line=dict(width=1), opacity=0.4,
+                           connectgaps=False, showlegend=False)
+              for station_id, row in zip(station_ids, anomalies)]
+    traces.append(go.Scattergl(x=years, y=mean + spread, mode='lines', line=dict(width=0),
+                               name='Mean + 1 SD', showlegend=False, hoverinfo='skip'))
+    traces.append(go.Scattergl(x=years, y=mean - spread, mode='lines', line=dict(width=0), fill='tonexty',
+                               fillcolor='rgba(255, 0, 0, 0.2)', name='Spread (1 SD)'))
+    traces.append(go.Scattergl(x=years, y=mean, mode='lines', line=dict(color='red', width=3), name='Ensemble Mean'))
+    return traces
+
+
+def analyze_stations(ids, timescale, start_year, end_year, baseline=(1981, 2010), workers=None):
+
+    """
+    Compares the average temperature of many stations in one call. The stations are loaded in parallel, their
+    averages for the timescale are aligned on a shared year index, and every station is turned into anomalies against
+    its own climatology, so stations of different climates can be overlaid. The ensemble mean and spread are computed
+    for every year.
+
+    Inputs:
+    ids (list): station IDs or "City, ST" locations.
+
+    timescale (string): Either "Annual" or one of the months of the year.
+
+    start_year (integer), end_year (integer): the years that mark the start and the end of the comparison
+
+    baseline (tuple): first and last year of the climatology each station is compared to.
+
+    workers (integer): number of threads loading the stations.
+
+    Returns:
+    (StationComparison) - station IDs, years, anomalies (stations, years), each station's climatology, the ensemble
+    mean, spread (standard deviation) and station count of every year, and the Scattergl traces of the comparison.
+
+    """
+
+    registry = load_station_registry()
+    station_ids = [registry.resolve(location) for location in ids]
+    frames = load_station_frames(station_ids, workers)
+
+    ## Anomalies are computed on the full record, so the baseline can lie outside the requested years
+    years, values, climatology = align_station_series(frames, timescale, baseline)
+    anomalies = values - climatology[:, None]
+    in_range = (years >= start_year) & (years <= end_year)
+    years, anomalies = years[in_range], anomalies[:, in_range]
+
+    mean, spread, count = ensemble_statistics(anomalies)
+    traces = station_traces(station_ids, years, anomalies, mean, spread)
+    return StationComparison(station_ids, years, anomalies, climatology, mean, spread, count, traces)
+
+
+def build_station_comparison_figure(comparison, timescale, baseline=(1981, 2010)):
+
+    """
+    Builds the plot of a comparison returned by analyze_stations, styled like the city time series plot.
+
+    Returns:
+    fig (go.Figure): the station anomalies overlaid with the ensemble mean and spread.
+
+    """
+
+    fig = go.Figure(data=comparison.traces)
+    fig.add_hline(y=0, line_color='gray')
+    fig.update_layout(xaxis_title="Year",
+        yaxis_title='Anomaly vs ' + str(baseline[0]) + '-' + str(baseline[1]) + ' (°C)',
+        title=str(len(comparison.station_ids)) + ' Station ' + timescale + ' Temperature Anomalies',
+        title_x=0.5,
+        font=dict(size=14))
+    fig.update_xaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
+    fig.update_yaxes(showgrid=True, gridwidth=1, gridcolor='gray',mirror=True,ticks='outside',showline=True)
+    return fig
+
+
+## Testing functionality
+def test_analyze_stations():
+
+    from climate_cache import get_city_series
+
+    locations = ['Dallas, TX', 'Raleigh, NC', 'Albany, NY']
+    comparison = analyze_stations(locations, 'January', 1950, 2000)
+    assert comparison.anomalies.shape == (3, 51)
+    assert list(comparison.years) == list(range(1950, 2001))
+
+    ## Each row matches the single station series minus its own climatology
+    for row, location in zip(comparison.anomalies, locations):
+        years, values, climatology = get_city_series(location, 'January')
+        in_range = (years >= 1950) & (years <= 2000)
+        np.testing.assert_allclose(row[~np.isnan(row)], values[in_range] - climatology)
+
+    ## The ensemble statistics ignore missing stations
+    mean, spread, count = ensemble_statistics(np.array([[1.0, np.nan], [3.0, 2.0]]))
+    np.testing.assert_allclose(mean, [2.0, 2.0])
+    np.testing.assert_allclose(spread, [1.0, 0.0])
+    assert list(count) == [2, 1]
+
+    assert len(comparison.traces) == 3 + 3
+    assert all(isinstance(trace, go.Scattergl) for trace in comparison.traces)
+    return
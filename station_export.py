@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from climate_records import MONTHS, scale_values
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+
+## Parquet datasets are partitioned by network (the first three characters of the station ID, e.g. USW) and decade
+STATION_PARTITIONING = [('Network', 3), ('Decade', 10)]
+
+
+def select_station_rows(archive=None, stations=None, start_year=None, end_year=None):
+
+    """
+    Finds the archive rows of the stations and years exported, see station_table.
+
+    Returns:
+    archive (StationArchive): the opened archive.
+
+    station_ids (ndarray): IDs of the selected stations.
+
+    rows (ndarray): archive rows kept, station after station and year after year.
+
+    owners (ndarray): position in station_ids of the station of every row.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            raise ValueError('No station archive has been built. Run python station_archive.py first.')
+
+    station_ids = np.array([station_id.decode() for station_id in archive.station_ids])
+    if stations is None:
+        selected = np.arange(len(station_ids))
+    else:
+        registry = load_station_registry(archive.source_dir)
+        selected = np.array([archive.index[registry.resolve(location)] for location in stations], dtype=np.int64)
+
+    rows, owners = archive.station_row_indexes(selected)
+    years = np.asarray(archive.years[rows])
+    keep = np.ones(len(rows), dtype=bool)
+    if start_year is not None:
+        keep &= years >= start_year
+    if end_year is not None:
+        keep &= years <= end_year
+    return archive, station_ids[selected], rows[keep], owners[keep]
+
+
+def station_table(archive=None, stations=None, start_year=None, end_year=None):
+
+    """
+    Builds one long dataframe of the monthly averages of many stations straight from the station archive, in the
+    column layout of parse_climate_data (Station Climate ID, Year, January ... December in degrees C, NaN where
+    missing). The rows of all the selected stations are gathered at once instead of station by station.
+
+    Inputs:
+    archive (StationArchive): the opened station archive. Defaults to the station archive of the working directory.
+
+    stations (list): station IDs or "City, ST" locations. Defaults to every archived station.
+
+    start_year (integer), end_year (integer): first and last year kept. Default to the whole record.
+
+    Returns:
+    (df) - the monthly averages ordered by station and year.
+
+    """
+
+    archive, station_ids, rows, owners = select_station_rows(archive, stations, start_year, end_year)
+
+    ## Station IDs are stored once as categories rather than once per row
+    data = {'Station Climate ID': pd.Categorical.from_codes(owners, station_ids),
+            'Year': np.asarray(archive.years[rows]).astype(np.int64)}
+    data.update(zip(MONTHS, scale_values(np.asarray(archive.values[rows]).T.copy())))
+    return pd.DataFrame(data, copy=False)
+
+
+def export_station_table(path, archive=None, stations=None, start_year=None, end_year=None):
+
+    """
+    Writes the monthly averages of many stations (see station_table) to a CSV file.
+
+    Inputs:
+    path (string): the CSV file to write.
+
+    archive, stations, start_year, end_year: see station_table.
+
+    Returns:
+    path (string): the written file.
+
+    """
+
+    df = station_table(archive, stations, start_year, end_year)
+    df.to_csv(path + '.tmp', index=False, float_format='%.2f')
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def export_station_parquet(path, archive=None, stations=None, start_year=None, end_year=None, row_group_rows=50000):
+
+    """
+    Writes the monthly averages of many stations (see station_table) as a Parquet dataset partitioned by network and
+    decade (path/Network=USW/Decade=1950/part-0.parquet), for queries that only read what they need (see
+    read_station_parquet). Rows are sorted by station and year within every file, so the minimum and maximum
+    station IDs and years kept in the statistics of every row group let readers skip the row groups of other
+    stations. Partitions are converted and written one at a time, so the whole archive is never held in memory.
+
+    Inputs:
+    path (string): directory of the dataset. An existing dataset at that path is replaced.
+
+    archive, stations, start_year, end_year: see station_table.
+
+    row_group_rows (integer): largest number of rows of a row group.
+
+    Returns:
+    path (string): the written directory.
+
+    """
+
+    import shutil
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    archive, station_ids, rows, owners = select_station_rows(archive, stations, start_year, end_year)
+    schema = pa.schema([('Station Climate ID', pa.string()), ('Year', pa.int64())]
+                       + [(month, pa.float64()) for month in MONTHS])
+
+    ## Rows come station after station and year after year, and a stable sort on the partition keeps that order
+    #     within every partition
+    networks, network_codes = np.unique(np.array([station_id[:3] for station_id in station_ids]),
+                                        return_inverse=True)
+    decades = np.asarray(archive.years[rows]).astype(np.int64) // 10 * 10
+    order = np.lexsort((decades, network_codes[owners]))
+    rows, owners, decades = rows[order], owners[order], decades[order]
+    keys = network_codes[owners] * 10000 + decades
+    bounds = np.concatenate([[0], np.nonzero(np.diff(keys))[0] + 1, [len(keys)]]).astype(np.int64)
+
+    ## The dataset is written next to the old one and swapped in when complete
+    if os.path.exists(path + '.tmp'):
+        shutil.rmtree(path + '.tmp')
+    os.makedirs(path + '.tmp')
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        block = rows[start:stop]
+        directory = path + '.tmp/Network=' + networks[network_codes[owners[start]]] + '/Decade=' + str(decades[start])
+        os.makedirs(directory)
+        columns = [pa.array(station_ids[owners[start:stop]], pa.string()),
+                   pa.array(np.asarray(archive.years[block]).astype(np.int64))]
+        columns += [pa.array(values) for values in scale_values(np.asarray(archive.values[block]).T.copy())]
+        pq.write_table(pa.Table.from_arrays(columns, schema=schema), directory + '/part-0.parquet',
+                       row_group_size=row_group_rows, compression='zstd')
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def read_station_parquet(path, stations=None, networks=None, start_year=None, end_year=None, months=None):
+
+    """
+    Queries a Parquet dataset written by export_station_parquet. The filters are pushed down to the files: the
+    network and decade directories outside the filters are never opened, row groups whose station and year
+    statistics rule them out are skipped, and only the month columns asked for are read.
+
+    Inputs:
+    path (string): directory of the dataset.
+
+    stations (list): station IDs kept. Defaults to every station.
+
+    networks (list): station ID prefixes kept, e.g. ["USW"]. Defaults to every network.
+
+    start_year (integer), end_year (integer): first and last year kept. Default to the whole record.
+
+    months (list): month names or numbers kept. Defaults to all twelve.
+
+    Returns:
+    (df) - the monthly averages in the column layout of parse_climate_data, ordered by station and year.
+
+    """
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([('Network', pa.string()), ('Decade', pa.int64())]), flavor='hive')
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+
+    ## Conditions on the partition columns prune directories, the others row groups through their statistics
+    conditions = []
+    if stations is not None:
+        stations = [str(station_id) for station_id in stations]
+        conditions.append(ds.field('Station Climate ID').isin(stations))
+        conditions.append(ds.field('Network').isin(sorted({station_id[:3] for station_id in stations})))
+    if networks is not None:
+        conditions.append(ds.field('Network').isin(list(networks)))
+    if start_year is not None:
+        conditions += [ds.field('Year') >= start_year, ds.field('Decade') >= start_year // 10 * 10]
+    if end_year is not None:
+        conditions += [ds.field('Year') <= end_year, ds.field('Decade') <= end_year // 10 * 10]
+    condition = None
+    for term in conditions:
+        condition = term if condition is None else condition & term
+
+    if months is None:
+        months = MONTHS
+    months = [MONTHS[month - 1] if isinstance(month, (int, np.integer)) else month for month in months]
+    table = dataset.to_table(columns=['Station Climate ID', 'Year'] + months, filter=condition)
+    return table.to_pandas().sort_values(['Station Climate ID', 'Year'], ignore_index=True)
+
+
+## Testing functionality
+def test_station_table(tmp_path):
+
+    import shutil
+    from load_city_climate_files import parse_climate_data, pull_location_file
+    from station_archive import StationArchive, build_station_archive
+
+    ## Archive a small copy of the station directory
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Dallas, TX', 'USW00013722']:
+        shutil.copy(pull_location_file(location), source_dir)
+    archive = StationArchive(build_station_archive(source_dir, str(tmp_path) + '/archive'))
+
+    locations = ['Raleigh, NC', 'Dallas, TX']
+    df = station_table(archive, stations=locations, start_year=1950, end_year=2000)
+    assert list(df['Station Climate ID'].unique()) == ['USC00317074', 'USC00412243']
+
+    ## Every station matches its parsed file over the same years
+    for location in locations:
+        expected = parse_climate_data(pull_location_file(location), use_archive=False)
+        expected = expected.loc[(expected['Year'] >= 1950) & (expected['Year'] <= 2000)].reset_index(drop=True)
+        actual = df.loc[df['Station Climate ID'] == expected['Station Climate ID'].iloc[0]].reset_index(drop=True)
+        np.testing.assert_array_equal(actual['Year'], expected['Year'])
+        np.testing.assert_allclose(actual[MONTHS].to_numpy(), expected[MONTHS].to_numpy())
+
+    path = export_station_table(str(tmp_path) + '/stations.csv', archive, stations=locations)
+    assert len(pd.read_csv(path)) == len(station_table(archive, stations=locations))
+
+    ## The Parquet dataset gives back the same rows, and queries only open the partitions they need
+    import pyarrow.dataset as ds
+    locations.append('USW00013722')
+    path = export_station_parquet(str(tmp_path) + '/stations.parquet', archive, locations, row_group_rows=10)
+    assert sorted(os.listdir(path)) == ['Network=USC', 'Network=USW']
+    full = read_station_parquet(path)
+    expected = station_table(archive, stations=locations)
+    np.testing.assert_array_equal(full['Station Climate ID'], expected['Station Climate ID'].astype(str))
+    np.testing.assert_allclose(full[MONTHS].to_numpy(), expected[MONTHS].to_numpy())
+
+    july = read_station_parquet(path, networks=['USW'], start_year=1950, end_year=2021, months=[7])
+    assert list(july.columns) == ['Station Climate ID', 'Year', 'July']
+    assert set(july['Station Climate ID']) == {'USW00013722'} and july['Year'].between(1950, 2021).all()
+    dallas = read_station_parquet(path, stations=['USC00412243'], start_year=1995, end_year=2004)
+    assert dallas['Year'].tolist() == list(range(1995, 2005))
+    np.testing.assert_allclose(dallas[MONTHS].to_numpy(),
+                               station_table(archive, ['USC00412243'], 1995, 2004)[MONTHS])
+
+    ## Row group statistics rule out the row groups of other stations
+    dataset = ds.dataset(path + '/Network=USC/Decade=1990', format='parquet')
+    fragment = next(iter(dataset.get_fragments()))
+    assert len(fragment.row_groups) > 1
+    kept = fragment.subset(ds.field('Station Climate ID') == 'USC00412243').row_groups
+    assert 0 < len(kept) < len(fragment.row_groups)
+
+    return
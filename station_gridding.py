@@ -0,0 +1,291 @@
+import os
+from datetime import datetime
+
+import numpy as np
+from netCDF4 import Dataset, date2num
+
+from climate_records import MISSING_VALUE
+from climatology_table import load_climatology_table
+from station_archive import load_station_archive
+from station_registry import load_station_registry
+
+## GISTEMP anomalies are relative to 1951-1980, so the station anomalies use the same baseline by default
+GISTEMP_BASELINE = (1951, 1980)
+
+## The 2x2 degree zone centres of gistemp1200_GHCNv4_ERSSTv5.nc, used when that file is not available
+DEFAULT_LAT = np.arange(-89, 90, 2, dtype=np.float32)
+DEFAULT_LON = np.arange(-179, 180, 2, dtype=np.float32)
+
+
+def cell_edges(centers):
+
+    """
+    Returns the edges of grid cells from their centres, halfway between neighbouring centres.
+    """
+
+    centers = np.asarray(centers, dtype=float)
+    middle = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - middle[0]], middle, [2 * centers[-1] - middle[-1]]])
+
+
+def station_cells(registry, station_ids, lat, lon):
+
+    """
+    Finds the grid cell of every station.
+
+    Inputs:
+    registry (StationRegistry): registry holding the station coordinates.
+
+    station_ids (list): station IDs to place.
+
+    lat (ndarray), lon (ndarray): cell centres of the grid.
+
+    Returns:
+    (ndarray) - flat cell index (lat index * len(lon) + lon index) of each station, -1 for stations without
+    coordinates or outside the grid.
+
+    """
+
+    latitudes = np.array([registry.stations[station_id].latitude if station_id in registry.stations else np.nan
+                          for station_id in station_ids])
+    longitudes = np.array([registry.stations[station_id].longitude if station_id in registry.stations else np.nan
+                           for station_id in station_ids])
+
+    lat_index = np.searchsorted(cell_edges(lat), latitudes, side='right') - 1
+    lon_index = np.searchsorted(cell_edges(lon), longitudes, side='right') - 1
+    inside = (~np.isnan(latitudes) & ~np.isnan(longitudes) & (lat_index >= 0) & (lat_index < len(lat))
+              & (lon_index >= 0) & (lon_index < len(lon)))
+    return np.where(inside, lat_index * len(lon) + lon_index, -1)
+
+
+def accumulate_station_anomalies(archive, cells, normals, chunk_rows=250000):
+
+    """
+    Bins the monthly anomaly of every archived station value into its grid cell and month. The sums and counts are
+    accumulated with np.bincount over a compact index of the occupied cells only, one chunk of archive rows at a
+    time, so no Python loop runs over stations or values.
+
+    Inputs:
+    archive (StationArchive): the opened station archive.
+
+    cells (ndarray): flat grid cell of each archive station, -1 to leave a station out (see station_cells).
+
+    normals (ndarray): monthly normals of each archive station of shape (stations, 12), NaN to leave a station's
+    month out.
+
+    chunk_rows (integer): number of archive rows converted at once.
+
+    Returns:
+    first_year (integer): year of the first month of the time axis.
+
+    occupied (ndarray): flat grid cells holding at least one station.
+
+    sums (ndarray), counts (ndarray): anomaly sums and number of station values of shape (months, occupied cells).
+
+    """
+
+    years = np.asarray(archive.years)
+    first_year, last_year = int(years.min()), int(years.max())
+    n_months = (last_year - first_year + 1) * 12
+
+    occupied, compact = np.unique(cells, return_inverse=True)
+    if len(occupied) and occupied[0] == -1:
+        occupied, compact = occupied[1:], compact - 1
+    n_keys = n_months * len(occupied)
+
+    station_of_row = np.repeat(np.arange(len(archive.station_ids)), np.diff(archive.offsets))
+    sums = np.zeros(n_keys)
+    counts = np.zeros(n_keys, dtype=np.int64)
+    for start in range(0, len(years), chunk_rows):
+        stop = min(start + chunk_rows, len(years))
+        stations = station_of_row[start:stop]
+        raw = np.asarray(archive.values[start:stop])
+
+        ## Anomaly of every value against its station's normal for that month
+        anomalies = raw / 100 - normals[stations]
+        valid = (raw != MISSING_VALUE) & ~np.isnan(anomalies) & (compact[stations] >= 0)[:, None]
+
+        ## Key of every value: month of the time axis times the number of occupied cells plus its compact cell
+        months = (years[start:stop, None].astype(np.int64) - first_year) * 12 + np.arange(12)
+        keys = months * len(occupied) + compact[stations][:, None]
+        sums += np.bincount(keys[valid], weights=anomalies[valid], minlength=n_keys)
+        counts += np.bincount(keys[valid], minlength=n_keys)
+
+    return first_year, occupied, sums.reshape(n_months, -1), counts.reshape(n_months, -1)
+
+
+def write_station_grid(path=None, archive=None, registry=None, grid_path=None, baseline=GISTEMP_BASELINE,
+                       block_months=120):
+
+    """
+    Grids the monthly anomalies of every station onto the 2x2 degree zones of the GISTEMP file and writes them as a
+    netCDF cube with the same layout (lat, lon, monthly time steps on the 15th in days since 1800-01-01, int16
+    tempanomaly scaled by 0.01). The cube can therefore be opened with open_anomaly_dataset and shown by the anomaly
+    map renderer, alone or as the difference from GISTEMP, without reading the station files again. Each zone holds
+    the mean anomaly of its stations against their own baseline normals, and nstations holds how many stations
+    contributed.
+
+    Inputs:
+    path (string): where the cube is written. Defaults to station_archive/station_anomalies_grid.nc in the working
+    directory.
+
+    archive (StationArchive): station archive to grid. Defaults to the station archive of the working directory.
+
+    registry (StationRegistry): registry holding the station coordinates, which needs a station inventory. Defaults
+    to the registry of the archive's source directory.
+
+    grid_path (string): netCDF file whose lat/lon variables define the grid. Defaults to
+    gistemp1200_GHCNv4_ERSSTv5.nc in the working directory, or the GISTEMP 2x2 degree zones when that file does not
+    exist.
+
+    baseline (tuple): first and last year of the station normals the anomalies are taken against.
+
+    block_months (integer): number of months written at once.
+
+    Returns:
+    path (string): the written cube.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            raise ValueError('No station archive has been built. Run python station_archive.py first.')
+    if registry is None:
+        registry = load_station_registry(archive.source_dir)
+    registry._require_coordinates()
+    if path is None:
+        path = archive.archive_dir + '/station_anomalies_grid.nc'
+    if grid_path is None:
+        grid_path = os.getcwd() + '/gistemp1200_GHCNv4_ERSSTv5.nc'
+
+    if os.path.exists(grid_path):
+        with Dataset(grid_path) as grid:
+            lat, lon = grid.variables['lat'][:], grid.variables['lon'][:]
+    else:
+        lat, lon = DEFAULT_LAT, DEFAULT_LON
+
+    station_ids = [station_id.decode() for station_id in archive.station_ids]
+    cells = station_cells(registry, station_ids, lat, lon)
+    normals = load_climatology_table(baseline, archive).mean[:, 1:]
+    first_year, occupied, sums, counts = accumulate_station_anomalies(archive, cells, normals)
+    n_months = len(sums)
+
+    dates = [datetime(first_year + t // 12, t % 12 + 1, 15) for t in range(n_months)]
+    with Dataset(path + '.tmp', 'w') as nc:
+        nc.title = 'Station anomalies gridded onto 2x2 degree zones'
+        nc.baseline = str(baseline[0]) + '-' + str(baseline[1])
+        nc.createDimension('lat', len(lat))
+        nc.createDimension('lon', len(lon))
+        nc.createDimension('time', None)
+
+        nc.createVariable('lat', 'f4', ('lat',))[:] = lat
+        nc.createVariable('lon', 'f4', ('lon',))[:] = lon
+        nc.variables['lat'].units = 'degrees_north'
+        nc.variables['lon'].units = 'degrees_east'
+
+        time = nc.createVariable('time', 'i4', ('time',))
+        time.units = 'days since 1800-01-01 00:00:00'
+        time.calendar = 'standard'
+        time[:] = date2num(dates, time.units, time.calendar)
+
+        tempanomaly = nc.createVariable('tempanomaly', 'i2', ('time', 'lat', 'lon'), fill_value=32767, zlib=True,
+                                        chunksizes=(1, len(lat), len(lon)))
+        tempanomaly.scale_factor = 0.01
+        tempanomaly.units = 'K'
+        tempanomaly.long_name = 'Surface temperature anomaly from stations'
+        nstations = nc.createVariable('nstations', 'i2', ('time', 'lat', 'lon'), zlib=True,
+                                      chunksizes=(1, len(lat), len(lon)))
+        nstations.long_name = 'Number of stations averaged in the zone'
+
+        ## Blocks of months are expanded from the occupied cells to the full grid just before they are written
+        for t0 in range(0, n_months, block_months):
+            t1 = min(t0 + block_months, n_months)
+            block_sums, block_counts = sums[t0:t1], counts[t0:t1]
+            field = np.zeros((t1 - t0, len(lat) * len(lon)))
+            number = np.zeros((t1 - t0, len(lat) * len(lon)), dtype=np.int16)
+            field[:, occupied] = np.divide(block_sums, block_counts, out=np.zeros_like(block_sums),
+                                           where=block_counts > 0)
+            number[:, occupied] = block_counts
+            tempanomaly[t0:t1] = np.ma.masked_array(np.round(field, 2), mask=number == 0).reshape(t1 - t0,
+                                                                                                 len(lat), len(lon))
+            nstations[t0:t1] = number.reshape(t1 - t0, len(lat), len(lon))
+
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def station_grid_series(location, dataset=None, registry=None):
+
+    """
+    Reads the gridded anomalies of the zone holding a station for every month, e.g. to compare a city's station
+    series with GISTEMP at its location. The series lines up with parse_climate_data's Year and month columns.
+
+    Inputs:
+    location (string): "City, ST" name or station ID.
+
+    dataset (AnomalyDataset): gridded anomalies. Defaults to the shared GISTEMP file.
+
+    registry (StationRegistry): registry holding the station coordinates. Defaults to the shared registry.
+
+    Returns:
+    (df) - A DataFrame with the year and the anomaly (degrees C) of every month, NaN where there is no data.
+
+    """
+
+    from anomaly_dataset import open_anomaly_dataset
+
+    if dataset is None:
+        dataset = open_anomaly_dataset()
+    if registry is None:
+        registry = load_station_registry()
+    station = registry.stations[registry.resolve(location)]
+    if np.isnan(station.latitude) or np.isnan(station.longitude):
+        raise ValueError('No coordinates for station ' + station.station_id + ', a station inventory is needed')
+    return dataset.point_series(station.latitude, station.longitude)
+
+
+## Testing functionality
+def test_write_station_grid(tmp_path):
+
+    import shutil
+    from anomaly_dataset import AnomalyDataset
+    from load_city_climate_files import pull_location_file, parse_climate_data
+    from station_archive import build_station_archive, StationArchive
+    from station_registry import StationRegistry
+
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+    archive = StationArchive(build_station_archive(source_dir, str(tmp_path) + '/archive'))
+
+    ## Raleigh and Dallas are placed in the same zone on purpose, Albany has no coordinates
+    inventory = {'USC00317074': ('Raleigh', 'NC', 35.8, -78.6, 120.0),
+                 'USC00412243': ('Dallas', 'TX', 34.9, -79.9, 150.0)}
+    registry = StationRegistry(list(archive.index), source_dir, inventory)
+    path = write_station_grid(str(tmp_path) + '/grid.nc', archive, registry, grid_path='', baseline=(1981, 2010))
+
+    expected = []
+    for station_id in ['USC00317074', 'USC00412243']:
+        df_city_data = parse_climate_data(source_dir + '/' + station_id + '.FLs.52j.tavg', use_archive=False)
+        normal = df_city_data.loc[(df_city_data['Year'] >= 1981) & (df_city_data['Year'] <= 2010), 'July'].mean()
+        expected.append(df_city_data.loc[df_city_data['Year'] == 1995, 'July'].iloc[0] - normal)
+
+    with AnomalyDataset(path) as dataset:
+        field = dataset.read_slice(1995, 'July')
+        assert field.count() == 1
+        assert abs(field[62, 50] - np.mean(expected)) < 0.006
+        assert dataset.dataset.variables['nstations'][dataset.index(1995, 7), 62, 50] == 2
+
+        ## The zone's series at a station lines up with the station's own years and months
+        series = station_grid_series('USC00317074', dataset, registry)
+        assert abs(series.loc[series['Year'] == 1995, 'July'].iloc[0] - np.mean(expected)) < 0.006
+
+    return
+
+
+## Running this file grids the station archive: python station_gridding.py [output path]
+if __name__ == '__main__':
+    import sys
+    print(write_station_grid(*sys.argv[1:2]))
@@ -0,0 +1,293 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from instrumentation import span
+from station_archive import load_station_archive
+
+## Cities that can be called by name without a station inventory, matched to their Cooperative Observer stations
+DEFAULT_CITY_STATIONS = {'Raleigh, NC': 'USC00317074', 'Albany, NY': 'USC00300047',
+                         'Seattle, WA': 'USC00457478', 'Dallas, TX': 'USC00412243',
+                         'Salt Lake City, UT': 'USC00427578', 'Bismark, ND': 'USC00320818',
+                         'Kansas City, MO': 'USC00234379', 'Flagstaff, AZ': 'USC00023009',
+                         'Indianapolis, IN': 'USC00124260', 'Tallahassee, FL': 'USC00088756'}
+
+## Mean radius of the Earth in km, used to turn chord distances of the spatial index back into great circle distances
+EARTH_RADIUS_KM = 6371.0
+
+Station = namedtuple('Station', ['station_id', 'network', 'name', 'state', 'latitude', 'longitude', 'elevation'])
+
+
+def read_station_inventory(inventory_path):
+
+    """
+    Reads a station inventory in the fixed width ghcnd-stations.txt layout (ID, latitude, longitude, elevation,
+    state and name in columns 1-11, 13-20, 22-30, 32-37, 39-40 and 42-71).
+
+    Inputs:
+    inventory_path (string): path of the inventory file.
+
+    Returns:
+    (dict) - station ID mapped to a (name, state, latitude, longitude, elevation) tuple.
+
+    """
+
+    inventory = {}
+    with open(inventory_path) as f:
+        for line in f:
+            if len(line) < 37:
+                continue
+            inventory[line[0:11]] = (line[41:71].strip().title(), line[38:40].strip(),
+                                     float(line[12:20]), float(line[21:30]), float(line[31:37]))
+    return inventory
+
+
+class StationRegistry:
+
+    """
+    In memory index of every station in the city climate directory. Stations are looked up by ID or "City, ST" name
+    through dictionaries, and nearest station and bounding box queries are answered from a KD-tree and a latitude
+    sorted index over the station coordinates, so no lookup touches the filesystem.
+
+    """
+
+    def __init__(self, station_ids, source_dir, inventory=None, city_stations=DEFAULT_CITY_STATIONS):
+
+        self.source_dir = source_dir
+        inventory = inventory or {}
+        self.stations = {}
+        for station_id in station_ids:
+            name, state, latitude, longitude, elevation = inventory.get(station_id, ('', '', np.nan, np.nan, np.nan))
+            self.stations[station_id] = Station(station_id, station_id[:3], name, state, latitude, longitude,
+                                                elevation)
+
+        ## "City, ST" names come from the inventory, with the default cities taking precedence for their names
+        self.locations = {}
+        for station in self.stations.values():
+            if station.name and station.state:
+                self.locations.setdefault(station.name + ', ' + station.state, station.station_id)
+        for location, station_id in city_stations.items():
+            if station_id in self.stations:
+                self.locations[location] = station_id
+
+        self.states = {}
+        self.networks = {}
+        for station in self.stations.values():
+            self.networks.setdefault(station.network, []).append(station.station_id)
+            if station.state:
+                self.states.setdefault(station.state, []).append(station.station_id)
+
+        ## The spatial index is only built over stations with known coordinates
+        self.located_ids = np.array([station.station_id for station in self.stations.values()
+                                     if not np.isnan(station.latitude)])
+        self.latitudes = np.array([self.stations[station_id].latitude for station_id in self.located_ids])
+        self.longitudes = np.array([self.stations[station_id].longitude for station_id in self.located_ids])
+        self._tree = None
+        self._latitude_order = np.argsort(self.latitudes)
+
+    @classmethod
+    def build(cls, source_dir=None, inventory_path=None, manifest_path=None):
+
+        """
+        Builds the registry, taking the station list from the station archive when it exists. Otherwise the directory
+        is scanned once and the station list is cached in a manifest that is reused until the directory changes.
+
+        Inputs:
+        source_dir (string): directory holding the station files. Defaults to CONUS_city_climate_stats in the working
+        directory.
+
+        inventory_path (string): station inventory with names and coordinates. Defaults to ghcnd-stations.txt in the
+        working directory when that file exists.
+
+        manifest_path (string): where the cached station list is kept. Defaults to the station_archive directory.
+
+        Returns:
+        (StationRegistry) - the registry over all stations of the directory.
+
+        """
+
+        if source_dir is None:
+            source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+        if inventory_path is None and os.path.exists(os.getcwd() + '/ghcnd-stations.txt'):
+            inventory_path = os.getcwd() + '/ghcnd-stations.txt'
+        if manifest_path is None:
+            manifest_path = os.getcwd() + '/station_archive/station_registry.json'
+
+        station_ids = None
+        archive = load_station_archive()
+        if archive is not None and archive.source_dir == os.path.realpath(source_dir):
+            station_ids = list(archive.index)
+
+        ## The directory modification time changes whenever a station file is added or removed
+        if station_ids is None:
+            directory_mtime = os.stat(source_dir).st_mtime_ns
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                if manifest['source_dir'] == os.path.realpath(source_dir) and manifest['mtime'] == directory_mtime:
+                    station_ids = manifest['stations']
+
+        if station_ids is None:
+            station_ids = sorted(entry.name.split('.')[0] for entry in os.scandir(source_dir)
+                                 if entry.name.endswith('.FLs.52j.tavg'))
+            if os.path.isdir(os.path.dirname(manifest_path)):
+                with open(manifest_path, 'w') as f:
+                    json.dump({'source_dir': os.path.realpath(source_dir), 'mtime': directory_mtime,
+                               'stations': station_ids}, f)
+
+        inventory = read_station_inventory(inventory_path) if inventory_path else None
+        return cls(station_ids, source_dir, inventory)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __contains__(self, station_id):
+        return station_id in self.stations
+
+    def station(self, station_id):
+        return self.stations[station_id]
+
+    def resolve(self, location):
+
+        """
+        Resolves a "City, ST" name or a station ID to a station ID. Raises a KeyError for unknown locations.
+        """
+
+        if location in self.locations:
+            return self.locations[location]
+        if location in self.stations:
+            return location
+        raise KeyError(location)
+
+    def filepath(self, location):
+
+        """
+        Returns the path of the station file for a "City, ST" name or station ID without touching the filesystem.
+        """
+
+        return self.source_dir + '/' + self.resolve(location) + '.FLs.52j.tavg'
+
+    def location_names(self):
+        return sorted(self.locations)
+
+    def network(self, network):
+
+        """
+        Returns the IDs of all stations of a network prefix (USC, USW, USR, USS, CA0, MXN, RQC, VQC...).
+        """
+
+        return sorted(self.networks.get(network, []))
+
+    def in_state(self, state):
+        return sorted(self.states.get(state, []))
+
+    def _require_coordinates(self):
+        if len(self.located_ids) == 0:
+            raise ValueError('No station coordinates are known. Build the registry with a station inventory.')
+
+    def nearest(self, latitude, longitude, k=1):
+
+        """
+        Finds the k stations closest to a point, using a KD-tree over the stations' positions on the unit sphere.
+
+        Inputs:
+        latitude (float): latitude of the point in degrees.
+
+        longitude (float): longitude of the point in degrees.
+
+        k (integer): number of stations to return.
+
+        Returns:
+        (list) - (station ID, great circle distance in km) tuples ordered from nearest to farthest.
+
+        """
+
+        self._require_coordinates()
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(_unit_vectors(self.latitudes, self.longitudes))
+
+        k = min(k, len(self.located_ids))
+        chords, indices = self._tree.query(_unit_vectors(np.array([latitude]), np.array([longitude]))[0], k=k)
+        chords, indices = np.atleast_1d(chords), np.atleast_1d(indices)
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chords / 2, 0, 1))
+        return [(self.located_ids[i], float(distance)) for i, distance in zip(indices, distances)]
+
+    def within_bbox(self, south, west, north, east):
+
+        """
+        Finds all stations inside a latitude/longitude bounding box. The latitude range is located with a binary
+        search over the latitude sorted stations, and only those are checked against the longitude range. A west
+        edge greater than the east edge describes a box crossing the antimeridian.
+
+        Returns:
+        (list) - IDs of the stations in the box.
+
+        """
+
+        self._require_coordinates()
+        sorted_latitudes = self.latitudes[self._latitude_order]
+        first = np.searchsorted(sorted_latitudes, south, side='left')
+        last = np.searchsorted(sorted_latitudes, north, side='right')
+        candidates = self._latitude_order[first:last]
+        longitudes = self.longitudes[candidates]
+        if west <= east:
+            inside = (longitudes >= west) & (longitudes <= east)
+        else:
+            inside = (longitudes >= west) | (longitudes <= east)
+        return sorted(self.located_ids[candidates[inside]])
+
+
+def _unit_vectors(latitudes, longitudes):
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    return np.column_stack([np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes),
+                            np.sin(latitudes)])
+
+
+## Registries are built once per station directory and reused by every lookup
+_registries = {}
+
+def load_station_registry(source_dir=None):
+
+    """
+    Returns the registry of a station directory, building it on first use.
+    """
+
+    if source_dir is None:
+        source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+    if source_dir not in _registries:
+        with span('build station registry'):
+            _registries[source_dir] = StationRegistry.build(source_dir)
+    return _registries[source_dir]
+
+
+## Testing functionality
+def test_station_registry(tmp_path):
+
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for station_id in ['USC00317074', 'USW00013722', 'CA001012010', 'MXN00001001']:
+        open(source_dir + '/' + station_id + '.FLs.52j.tavg', 'w').close()
+    with open(str(tmp_path) + '/ghcnd-stations.txt', 'w') as f:
+        f.write('USC00317074  35.7944  -78.6989  121.9 NC RALEIGH STATE UNIV\n')
+        f.write('USW00013722  35.8923  -78.7819  131.1 NC RALEIGH DURHAM INTL AP\n')
+        f.write('CA001012010  48.6500 -123.4333   61.0 BC SIDNEY\n')
+
+    registry = StationRegistry.build(source_dir, str(tmp_path) + '/ghcnd-stations.txt',
+                                     str(tmp_path) + '/station_registry.json')
+    assert len(registry) == 4
+    assert registry.network('CA0') == ['CA001012010']
+    assert registry.in_state('NC') == ['USC00317074', 'USW00013722']
+    assert registry.filepath('Raleigh, NC') == source_dir + '/USC00317074.FLs.52j.tavg'
+    assert registry.resolve('Raleigh Durham Intl Ap, NC') == 'USW00013722'
+
+    ## The airport is about 13 km from the State University station, and the station without coordinates is skipped
+    nearest = registry.nearest(35.80, -78.70, k=5)
+    assert [station_id for station_id, _ in nearest] == ['USC00317074', 'USW00013722', 'CA001012010']
+    assert 10 < nearest[1][1] < 15
+    assert registry.within_bbox(30, -80, 40, -75) == ['USC00317074', 'USW00013722']
+    assert registry.within_bbox(40, 170, 50, -120) == ['CA001012010']
+
+    return
@@ -0,0 +1,317 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from climate_records import (MISSING_VALUE, MONTHS, decode_flags, decode_station_records, encode_flags,
+                             read_record_bytes, records_to_frame, scale_values)
+from station_archive import load_station_archive
+
+
+class StationSeries:
+
+    """
+    Compact container for the monthly records of one station. Values are kept as the raw int16 hundredths of a degree
+    C of the station files, with -9999 (MISSING_VALUE) as the missing value sentinel, and the three flag characters of
+    every value as a single uint8 code into a flag table shared between stations (see climate_records.encode_flags).
+    A record takes 38 bytes (2 year, 24 value and 12 flag bytes) against about 123 bytes for a row of the
+    parse_climate_data DataFrame (twelve float64 months, an int64 year and the station ID string).
+
+    Degrees C are only computed when asked for and are not kept, and the raw values can be handed to NumPy and pandas
+    without copying them.
+
+    """
+
+    __slots__ = ('station_id', 'years', 'values', 'flag_codes', 'flag_table')
+
+    def __init__(self, station_id, years, values, flag_codes, flag_table):
+        self.station_id = station_id
+        self.years = years
+        self.values = values
+        self.flag_codes = flag_codes
+        self.flag_table = flag_table
+
+    @classmethod
+    def from_records(cls, station_id, years, values, flags, flag_table=None):
+
+        """
+        Builds a series from decoded station records (see climate_records.decode_station_records).
+
+        Inputs:
+        station_id (string): 11 character station ID.
+
+        years (ndarray): year of every record.
+
+        values (ndarray): raw monthly values of shape (records, 12) in hundredths of a degree C.
+
+        flags (ndarray): uint8 flag characters of shape (records, 12, 3).
+
+        flag_table (ndarray): flag table to share with other series. A new table is made by default.
+
+        Returns:
+        (StationSeries) - the series, holding its own copy of the records.
+
+        """
+
+        flag_codes, flag_table = encode_flags(flags, flag_table)
+        return cls(station_id, np.array(years, dtype=np.int16), np.array(values, dtype=np.int16), flag_codes,
+                   flag_table)
+
+    @classmethod
+    def from_file(cls, filepath, flag_table=None):
+
+        """
+        Reads a series straight from a .FLs.52j.tavg station file.
+        """
+
+        _, years, values, flags = decode_station_records(read_record_bytes(filepath))
+        station_id = os.path.basename(filepath).split('.')[0]
+        return cls.from_records(station_id, years, values, flags, flag_table)
+
+    def __len__(self):
+        return len(self.years)
+
+    def __repr__(self):
+        return 'StationSeries(' + self.station_id + ', ' + str(len(self)) + ' years)'
+
+    @property
+    def nbytes(self):
+        return self.years.nbytes + self.values.nbytes + self.flag_codes.nbytes
+
+    @property
+    def missing(self):
+        return self.values == MISSING_VALUE
+
+    @property
+    def celsius(self):
+
+        """
+        Monthly values in degrees C as a new float64 array of shape (records, 12), missing values as NaN.
+        """
+
+        return scale_values(self.values)
+
+    @property
+    def flags(self):
+
+        """
+        Flag characters of every value as a uint8 array of shape (records, 12, 3), expanded from the codes.
+        """
+
+        return decode_flags(self.flag_codes, self.flag_table)
+
+    def masked(self):
+
+        """
+        Raw values as a NumPy masked array hiding the missing values. The data is a view of the stored values.
+        """
+
+        return np.ma.MaskedArray(self.values, mask=self.missing, copy=False)
+
+    def raw_frame(self):
+
+        """
+        Raw values as an int16 DataFrame indexed by year with a column per month. The frame is a view of the stored
+        values, so building it costs no copy, and writing to it writes to the series.
+        """
+
+        return pd.DataFrame(self.values, index=pd.Index(self.years, name='Year'), columns=MONTHS, copy=False)
+
+    def to_frame(self):
+
+        """
+        Builds the DataFrame layout produced by parse_climate_data, with the station ID, year and the twelve monthly
+        averages in degrees C.
+        """
+
+        return records_to_frame(self.station_id, self.years, self.values)
+
+
+class StationSeriesTable:
+
+    """
+    Every station of an archive held in memory in the compact layout of StationSeries: one int16 array of years, one
+    int16 array of values and one uint8 array of flag codes for all records, with the records of a station stored
+    together. Indexing the table by station ID returns a StationSeries of views into those arrays.
+
+    """
+
+    __slots__ = ('station_ids', 'offsets', 'years', 'values', 'flag_codes', 'flag_table', 'index')
+
+    def __init__(self, station_ids, offsets, years, values, flag_codes, flag_table):
+        self.station_ids = station_ids
+        self.offsets = offsets
+        self.years = years
+        self.values = values
+        self.flag_codes = flag_codes
+        self.flag_table = flag_table
+        self.index = {station_id: i for i, station_id in enumerate(station_ids)}
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def __contains__(self, station_id):
+        return station_id in self.index
+
+    def __iter__(self):
+        return iter(self.station_ids)
+
+    def __getitem__(self, station_id):
+        i = self.index[station_id]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return StationSeries(station_id, self.years[start:end], self.values[start:end], self.flag_codes[start:end],
+                             self.flag_table)
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.years.nbytes + self.values.nbytes + self.flag_codes.nbytes
+
+
+## Flag codes are encoded once per opened archive and shared by the in memory table and the quality masks
+_flag_codes = {}
+
+def archive_flag_codes(archive, chunk_size=65536):
+
+    """
+    Encodes the flags of every record of an archive into uint8 codes (see climate_records.encode_flags). The codes
+    are kept until the archive is closed and opened again, e.g. after a sync.
+
+    Inputs:
+    archive (StationArchive): the opened station archive.
+
+    chunk_size (integer): number of records whose flags are encoded together.
+
+    Returns:
+    flag_codes (ndarray): uint8 codes of shape (records, 12).
+
+    flag_table (ndarray): the flag table of the codes.
+
+    """
+
+    stored = _flag_codes.get(archive.archive_dir)
+    if stored is not None and stored[0] is archive:
+        return stored[1], stored[2]
+
+    ## Flags are encoded a block of records at a time, so that the temporaries of the encoding stay small next to
+    #     the codes themselves
+    flag_codes = np.empty(archive.flags.shape[:2], dtype=np.uint8)
+    flag_table = None
+    for start in range(0, len(flag_codes), chunk_size):
+        flag_codes[start:start + chunk_size], flag_table = encode_flags(archive.flags[start:start + chunk_size],
+                                                                        flag_table)
+    if flag_table is None:
+        flag_table = np.zeros((0, 3), dtype=np.uint8)
+    _flag_codes[archive.archive_dir] = (archive, flag_codes, flag_table)
+    return flag_codes, flag_table
+
+
+def load_station_series(archive=None, chunk_size=65536):
+
+    """
+    Reads every station of the archive into memory as a StationSeriesTable. The archive arrays are memory mapped, so
+    this is the step that makes the whole archive resident: about 94 MB for the 2.5 million records of the CONUS
+    directory, against roughly 305 MB for the same records as parse_climate_data DataFrames (see memory_report).
+
+    Inputs:
+    archive (StationArchive): opened station archive. Defaults to the archive of the working directory.
+
+    chunk_size (integer): number of records whose flags are encoded together.
+
+    Returns:
+    (StationSeriesTable) - every archived station.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            raise FileNotFoundError('No station archive found, run python station_archive.py first')
+
+    flag_codes, flag_table = archive_flag_codes(archive, chunk_size)
+    station_ids = [station_id.decode() for station_id in archive.station_ids]
+    return StationSeriesTable(station_ids, np.array(archive.offsets), np.array(archive.years, dtype=np.int16),
+                              np.array(archive.values, dtype=np.int16), flag_codes, flag_table)
+
+
+def memory_report(table=None, stations=None):
+
+    """
+    Compares the memory used by stations in the compact layout against the parse_climate_data DataFrame layout. The
+    DataFrame of all the stations is built as one frame (the deep memory usage of per station frames is the same
+    apart from their indexes), which takes about 300 MB for the whole archive, so pass stations to measure a
+    sample.
+
+    Inputs:
+    table (StationSeriesTable): stations held in memory. Defaults to load_station_series().
+
+    stations (list): station IDs to compare. Defaults to every station of the table.
+
+    Returns:
+    (df) - A DataFrame with the records and bytes of both layouts, the bytes per record and the ratio between them.
+
+    """
+
+    if table is None:
+        table = load_station_series()
+    if stations is None:
+        stations = table.station_ids
+
+    series = [table[station_id] for station_id in stations]
+    records = sum(len(station) for station in series)
+    compact_bytes = sum(station.nbytes for station in series) + 8 * (len(series) + 1)
+
+    ## The frame is built the way records_to_frame builds it, station IDs as Python strings in an object column
+    years = np.concatenate([station.years for station in series])
+    values = np.concatenate([station.values for station in series])
+    data = {'Station Climate ID': np.repeat(np.array(list(stations), dtype=object),
+                                            [len(station) for station in series]),
+            'Year': years.astype(np.int64)}
+    data.update(zip(MONTHS, scale_values(np.ascontiguousarray(values.T))))
+    frame_bytes = int(pd.DataFrame(data, copy=False).memory_usage(deep=True).sum())
+
+    report = pd.DataFrame({'records': [records, records], 'bytes': [frame_bytes, compact_bytes]},
+                          index=pd.Index(['DataFrame', 'StationSeries'], name='layout'))
+    report['bytes per record'] = report['bytes'] / max(records, 1)
+    report['ratio'] = frame_bytes / report['bytes']
+    return report
+
+
+## Testing functionality
+def test_station_series(tmp_path):
+
+    import shutil
+    from load_city_climate_files import parse_climate_data, pull_location_file
+    from station_archive import StationArchive, build_station_archive
+
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+    table = load_station_series(StationArchive(build_station_archive(source_dir, str(tmp_path) + '/archive')),
+                                chunk_size=100)
+    assert len(table) == 3
+
+    for station_id in table:
+        filepath = source_dir + '/' + station_id + '.FLs.52j.tavg'
+        series = table[station_id]
+        pd.testing.assert_frame_equal(series.to_frame(), parse_climate_data(filepath, use_archive=False))
+
+        ## Values and flags survive the round trip through the compact layout
+        _, years, values, flags = decode_station_records(read_record_bytes(filepath))
+        assert np.array_equal(series.years, years) and np.array_equal(series.values, values)
+        assert np.array_equal(series.flags, flags)
+        assert np.array_equal(StationSeries.from_file(filepath, table.flag_table).flag_codes, series.flag_codes)
+
+        ## Float conversion is lazy and the NumPy and pandas views share the stored values
+        assert np.array_equal(np.isnan(series.celsius), series.values == MISSING_VALUE)
+        assert np.shares_memory(series.raw_frame().to_numpy(), table.values)
+        assert np.shares_memory(series.masked().data, table.values)
+
+    ## Raleigh's first record is flagged "E" from July onwards
+    assert bytes(table['USC00317074'].flags[0, 6]) == b'E  '
+
+    report = memory_report(table)
+    assert report.loc['DataFrame', 'records'] == sum(len(table[station_id]) for station_id in table)
+    assert report.loc['StationSeries', 'ratio'] > 3
+
+    return
@@ -0,0 +1,284 @@
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from climate_records import RECORD_LENGTH, decode_station_records, read_record_bytes, record_hashes
+from climatology_table import (ClimatologyTable, archive_fingerprint, clear_climatology_tables,
+                               compute_station_normals)
+from station_archive import (StationArchive, build_station_archive, close_station_archive, file_digest,
+                             write_archive_arrays)
+from trend_analysis import compute_station_trends
+
+
+def sync_station_archive(source_dir=None, archive_dir=None, update_tables=True):
+
+    """
+    Brings the station archive up to date with a new copy of the city climate directory, e.g. after NCEI republished
+    the files with new months appended and past values revised. Files are compared with the archive by content hash,
+    and the records of changed files by line hash, so only new or revised lines are decoded; every other row is
+    carried over from the archive. The climatology and trend tables stored next to the archive are then updated for
+    the changed stations only.
+
+    Inputs:
+    source_dir (string): the new copy of the station directory. Defaults to CONUS_city_climate_stats in the working
+    directory.
+
+    archive_dir (string): the archive to update. Defaults to station_archive in the working directory.
+
+    update_tables (boolean): whether the stored climatology and trend tables are updated too.
+
+    Returns:
+    (dict) - number of unchanged, changed, added and removed stations, of decoded lines, and the seconds taken.
+
+    """
+
+    start_time = time.perf_counter()
+    if source_dir is None:
+        source_dir = os.getcwd() + '/CONUS_city_climate_stats'
+    if archive_dir is None:
+        archive_dir = os.getcwd() + '/station_archive'
+
+    ## Archives without content hashes (or no archive at all) can only be rebuilt
+    archive = StationArchive(archive_dir) if os.path.exists(archive_dir + '/manifest.json') else None
+    if archive is None or archive.line_hashes is None:
+        build_station_archive(source_dir, archive_dir)
+        close_station_archive()
+        clear_climatology_tables()
+        return {'rebuilt': True, 'seconds': time.perf_counter() - start_time}
+
+    filepaths = sorted(glob.glob(source_dir + '/*.FLs.52j.tavg'))
+    if not filepaths:
+        raise FileNotFoundError('No station files found in ' + source_dir)
+    station_ids = [os.path.basename(filepath).split('.')[0] for filepath in filepaths]
+    mtimes = np.array([os.stat(filepath).st_mtime_ns for filepath in filepaths], dtype=np.int64)
+
+    ## Files whose content hash matches the archive are carried over without looking at their lines
+    digests, changed, contents = [], [], []
+    for i, (station_id, filepath) in enumerate(zip(station_ids, filepaths)):
+        content = read_record_bytes(filepath)
+        digest = file_digest(content)
+        digests.append(digest)
+        old = archive.index.get(station_id)
+        if old is None or archive.file_hashes[old].tobytes() != digest:
+            changed.append(i)
+            contents.append(content)
+    changed = np.array(changed, dtype=np.int64)
+    removed = sorted(set(archive.index) - set(station_ids))
+
+    ## Lines of the changed files, with the new index of their station
+    buffer = b''.join(contents)
+    new_owners = np.repeat(changed, [len(content) // RECORD_LENGTH for content in contents])
+    new_hashes = record_hashes(buffer)
+
+    ## Archived rows of the changed stations that still appear unchanged in the new files are kept, the other lines
+    #     of the new files are decoded. Line hashes include the station ID and year, so they are unique per station.
+    old_index = np.array([archive.index.get(station_ids[i], -1) for i in changed], dtype=np.int64)
+    previous = old_index >= 0
+    old_rows, old_owners = archive.station_row_indexes(old_index[previous])
+    old_owners = changed[previous][old_owners]
+    old_hashes = np.asarray(archive.line_hashes[old_rows])
+    kept = np.isin(old_hashes, new_hashes)
+    fresh = ~np.isin(new_hashes, old_hashes)
+
+    records = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, RECORD_LENGTH)
+    _, fresh_years, fresh_values, fresh_flags = decode_station_records(records[fresh].tobytes())
+
+    ## Rows of unchanged stations are carried over as they are
+    unchanged = np.setdiff1d(np.arange(len(station_ids)), changed)
+    carried_rows, carried_owners = archive.station_row_indexes(
+        np.array([archive.index[station_ids[i]] for i in unchanged], dtype=np.int64))
+    carried_owners = unchanged[carried_owners]
+
+    ## Assemble the new archive ordered by station and year
+    source_rows = np.concatenate([carried_rows, old_rows[kept]])
+    owners = np.concatenate([carried_owners, old_owners[kept], new_owners[fresh]])
+    years = np.concatenate([np.asarray(archive.years[source_rows]), fresh_years])
+    order = np.lexsort((years, owners))
+    arrays = {'station_ids': np.array(station_ids, dtype='S11'),
+              'offsets': np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=len(station_ids)))]),
+              'mtimes': mtimes,
+              'file_hashes': np.frombuffer(b''.join(digests), dtype=np.uint8).reshape(-1, 16),
+              'years': years[order],
+              'values': np.concatenate([np.asarray(archive.values[source_rows]), fresh_values])[order],
+              'flags': np.concatenate([np.asarray(archive.flags[source_rows]), fresh_flags])[order],
+              'line_hashes': np.concatenate([np.asarray(archive.line_hashes[source_rows]),
+                                             new_hashes[fresh]])[order]}
+    arrays['offsets'] = arrays['offsets'].astype(np.int64)
+
+    ## Years touched in every changed station: decoded lines and archived lines that are gone
+    changed_years = {}
+    for owner, year in zip(new_owners[fresh], fresh_years):
+        changed_years.setdefault(station_ids[owner], set()).add(int(year))
+    for owner, year in zip(old_owners[~kept], np.asarray(archive.years[old_rows[~kept]])):
+        changed_years.setdefault(station_ids[owner], set()).add(int(year))
+    added = [station_ids[i] for i in changed[~previous]]
+
+    ## The old archive is released before its files are replaced
+    del archive, old_hashes
+    close_station_archive()
+    write_archive_arrays(archive_dir, arrays, source_dir)
+    clear_climatology_tables()
+
+    if update_tables:
+        archive = StationArchive(archive_dir)
+        update_climatology_tables(archive, changed_years, added)
+        update_trend_tables(archive, changed_years, added, removed)
+
+    return {'unchanged': len(unchanged), 'changed': len(changed) - len(added), 'added': len(added),
+            'removed': len(removed), 'decoded_lines': int(fresh.sum()), 'seconds': time.perf_counter() - start_time}
+
+
+def _stations_to_update(archive, changed_years, added, first_year, last_year):
+
+    """
+    Returns the archive indexes of the stations that were added or had a year between first_year and last_year
+    changed.
+    """
+
+    station_ids = set(added)
+    for station_id, years in changed_years.items():
+        if any(first_year <= year <= last_year for year in years):
+            station_ids.add(station_id)
+    return np.array(sorted(archive.index[station_id] for station_id in station_ids), dtype=np.int64)
+
+
+def update_climatology_tables(archive, changed_years, added):
+
+    """
+    Updates every climatology table stored next to an archive after a sync. Normals of stations without a change in
+    the baseline period are carried over, the others are recomputed.
+
+    Inputs:
+    archive (StationArchive): the synced archive.
+
+    changed_years (dict): station ID mapped to the set of years that were added, revised or removed.
+
+    added (list): IDs of the stations that are new to the archive.
+
+    Returns:
+    (list) - paths of the updated tables.
+
+    """
+
+    paths = sorted(glob.glob(archive.archive_dir + '/normals_*.npz'))
+    for path in paths:
+        table = ClimatologyTable.load(path)
+        n_stations = len(archive.station_ids)
+        mean = np.full((n_stations,) + table.mean.shape[1:], np.nan)
+        std = np.full((n_stations,) + table.std.shape[1:], np.nan)
+        count = np.zeros((n_stations,) + table.count.shape[1:], dtype=table.count.dtype)
+
+        ## Stations still in the archive keep their normals, removed stations drop out
+        new_rows = [i for i, station_id in enumerate(archive.station_ids) if station_id.decode() in table.index]
+        old_rows = [table.index[archive.station_ids[i].decode()] for i in new_rows]
+        mean[new_rows], std[new_rows], count[new_rows] = table.mean[old_rows], table.std[old_rows], table.count[old_rows]
+
+        stations = _stations_to_update(archive, changed_years, added, *table.baseline)
+        if len(stations):
+            mean[stations], std[stations], count[stations] = compute_station_normals(archive, table.baseline,
+                                                                                     stations)
+        ClimatologyTable(archive.station_ids, mean, std, count, table.baseline,
+                         archive_fingerprint(archive)).save(path)
+    return paths
+
+
+def update_trend_tables(archive, changed_years, added, removed):
+
+    """
+    Updates every trend table stored next to an archive after a sync (trends.csv and trends_<start>_<end>.csv).
+    Only stations that were added or changed within the years of a table are fitted again.
+
+    Inputs:
+    archive (StationArchive): the synced archive.
+
+    changed_years (dict): station ID mapped to the set of years that were added, revised or removed.
+
+    added (list), removed (list): IDs of the stations that are new to or gone from the archive.
+
+    Returns:
+    (list) - paths of the updated tables.
+
+    """
+
+    paths = sorted(glob.glob(archive.archive_dir + '/trends*.csv'))
+    for path in paths:
+        ## Tables of a one sided year range are named e.g. trends_1950_None.csv
+        bounds = os.path.basename(path)[:-len('.csv')].split('_')[1:] or ['None', 'None']
+        start_year, end_year = [None if bound == 'None' else int(bound) for bound in bounds]
+        first_year = -np.inf if start_year is None else start_year
+        last_year = np.inf if end_year is None else end_year
+
+        stations = _stations_to_update(archive, changed_years, added, first_year, last_year)
+        dropped = set(removed) | set(archive.station_ids[stations].astype(str))
+        trends = pd.read_csv(path)
+        trends = trends[~trends['Station Climate ID'].isin(dropped)]
+        if len(stations):
+            trends = pd.concat([trends, compute_station_trends(archive, start_year, end_year, stations=stations)])
+        trends = trends.sort_values('OLS Trend (°C/decade)', ascending=False, ignore_index=True)
+        trends.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    return paths
+
+
+## Testing functionality
+def test_sync_station_archive(tmp_path):
+
+    import shutil
+    from load_city_climate_files import pull_location_file
+    from climatology_table import build_climatology_table
+    from trend_analysis import write_station_trends
+
+    ## Archive a small station directory together with its dependent tables
+    source_dir = str(tmp_path) + '/stations'
+    os.makedirs(source_dir)
+    for location in ['Raleigh, NC', 'Albany, NY', 'Dallas, TX']:
+        shutil.copy(pull_location_file(location), source_dir)
+    archive_dir = build_station_archive(source_dir, str(tmp_path) + '/archive')
+    build_climatology_table(StationArchive(archive_dir), (1981, 2010))
+    write_station_trends(archive=StationArchive(archive_dir))
+    write_station_trends(archive=StationArchive(archive_dir), start_year=1950)
+
+    ## Republished copy: Raleigh gains a year and has a 1995 value revised, Albany is gone and Seattle is new
+    new_dir = str(tmp_path) + '/republished'
+    shutil.copytree(source_dir, new_dir)
+    os.remove(new_dir + '/USC00300047.FLs.52j.tavg')
+    shutil.copy(pull_location_file('Seattle, WA'), new_dir)
+    with open(new_dir + '/USC00317074.FLs.52j.tavg') as f:
+        lines = f.read().splitlines(keepends=True)
+    lines = [line[:16] + '  9999' + line[22:] if line[12:16] == '1995' else line for line in lines]
+    lines.append(lines[-1][:12] + '2023' + lines[-1][16:])
+    with open(new_dir + '/USC00317074.FLs.52j.tavg', 'w') as f:
+        f.write(''.join(lines))
+
+    report = sync_station_archive(new_dir, archive_dir)
+    assert (report['unchanged'], report['changed'], report['added'], report['removed']) == (1, 1, 1, 1)
+    assert report['decoded_lines'] == 2 + len(read_record_bytes(new_dir + '/USC00457478.FLs.52j.tavg')) // 125
+
+    ## The synced archive and tables match a full rebuild from the new copy
+    synced = StationArchive(archive_dir)
+    rebuilt = StationArchive(build_station_archive(new_dir, str(tmp_path) + '/rebuilt'))
+    for name in ['station_ids', 'offsets', 'file_hashes', 'years', 'values', 'flags', 'line_hashes']:
+        np.testing.assert_array_equal(getattr(synced, name), getattr(rebuilt, name))
+
+    synced_table = ClimatologyTable.load(archive_dir + '/normals_1981_2010.npz')
+    rebuilt_table = build_climatology_table(rebuilt, (1981, 2010))
+    np.testing.assert_array_equal(synced_table.mean, rebuilt_table.mean)
+    assert synced_table.fingerprint == archive_fingerprint(synced)
+
+    synced_trends = pd.read_csv(archive_dir + '/trends.csv')
+    rebuilt_trends = pd.read_csv(write_station_trends(archive=rebuilt))
+    pd.testing.assert_frame_equal(synced_trends, rebuilt_trends)
+    synced_trends = pd.read_csv(archive_dir + '/trends_1950_None.csv')
+    rebuilt_trends = pd.read_csv(write_station_trends(archive=rebuilt, start_year=1950))
+    pd.testing.assert_frame_equal(synced_trends, rebuilt_trends)
+
+    return
+
+
+## Running this file syncs the station archive with a new copy of the directory: python station_sync.py [source_dir]
+if __name__ == '__main__':
+    import sys
+    print(sync_station_archive(*sys.argv[1:2]))
@@ -0,0 +1,334 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from climate_records import MISSING_VALUE, TIMESCALES
+from quality_policy import archive_quality_mask
+from station_archive import load_station_archive
+
+## Series with fewer valid years than this get no trend
+MIN_YEARS = 10
+
+
+def station_year_cube(archive, stations, first_year, n_years, policy=None):
+
+    """
+    Expands the archived records of a block of stations into a dense cube of yearly averages.
+
+    Inputs:
+    archive (StationArchive): the opened station archive.
+
+    stations (ndarray): archive indexes of the stations of the block.
+
+    first_year (integer), n_years (integer): the shared year axis of the cube.
+
+    policy (QualityPolicy or string): quality policy whose rejected values are treated as missing.
+
+    Returns:
+    (ndarray) - float32 averages of shape (stations, 13 timescales, years) in the order of TIMESCALES, NaN where a
+    station has no average. Annual averages are only set for years with all twelve months present.
+
+    """
+
+    rows, owners = archive.station_row_indexes(stations)
+    columns = np.asarray(archive.years[rows]).astype(np.int64) - first_year
+    inside = (columns >= 0) & (columns < n_years)
+    rows, owners, columns = rows[inside], owners[inside], columns[inside]
+
+    raw = np.asarray(archive.values[rows])
+    monthly = raw / 100
+    monthly[raw == MISSING_VALUE] = np.nan
+    mask = archive_quality_mask(archive, policy)
+    if mask is not None:
+        monthly[~mask[rows]] = np.nan
+
+    cube = np.full((len(stations), n_years, len(TIMESCALES)), np.nan, dtype=np.float32)
+    cube[owners, columns, 1:] = monthly
+    cube[owners, columns, 0] = monthly.mean(axis=1)
+    return cube.transpose(0, 2, 1)
+
+
+def ols_trends(years, cube):
+
+    """
+    Fits a least squares line through every series of a cube at once, ignoring missing years.
+
+    Inputs:
+    years (ndarray): the year axis of the cube.
+
+    cube (ndarray): averages with the years along the last axis, NaN where missing.
+
+    Returns:
+    slope (ndarray): slope in degrees C per decade.
+
+    stderr (ndarray): standard error of the slope in degrees C per decade.
+
+    n_years (ndarray): number of valid years of each series.
+
+    """
+
+    ## Sums over the valid years only, as matrix products of the series with the centred years
+    valid = ~np.isnan(cube)
+    weights = valid.astype(np.float64)
+    y = np.where(valid, cube, 0).astype(np.float64)
+    x = (years - years.mean()).astype(np.float64)
+    n = valid.sum(axis=-1)
+    sx, sxx = weights @ x, weights @ (x * x)
+    sy, sxy, syy = y.sum(axis=-1), y @ x, (y * y).sum(axis=-1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean, y_mean = sx / n, sy / n
+        sxx_centred = sxx - n * x_mean ** 2
+        slope = (sxy - n * x_mean * y_mean) / sxx_centred
+        residuals = np.maximum(syy - n * y_mean ** 2 - slope * (sxy - n * x_mean * y_mean), 0)
+        stderr = np.sqrt(residuals / (n - 2) / sxx_centred)
+
+    too_short = n < MIN_YEARS
+    slope[too_short] = np.nan
+    stderr[too_short] = np.nan
+    return slope * 10, stderr * 10, n
+
+
+def nan_median(values, axis=-1):
+
+    """
+    Median ignoring NaN, computed by sorting once (NaN sorts last) and picking the middle valid elements.
+    """
+
+    ordered = np.sort(values, axis=axis)
+    count = (~np.isnan(ordered)).sum(axis=axis, keepdims=True)
+    low = np.take_along_axis(ordered, np.maximum((count - 1) // 2, 0), axis=axis)
+    high = np.take_along_axis(ordered, np.maximum(count // 2, 0), axis=axis)
+    median = ((low + high) / 2).squeeze(axis)
+    median[count.squeeze(axis) == 0] = np.nan
+    return median
+
+
+def theil_sen_trends(years, cube, max_pairs=1024, seed=0):
+
+    """
+    Theil-Sen slope (median of the slopes between pairs of years) of every series of a cube at once.
+
+    With max_pairs set, every series uses the same max_pairs pairs of positions, drawn once as fractions of its own
+    span from first to last valid year, instead of all pairs, which keeps the cost fixed per series. Without it
+    all pairs of years are used.
+
+    Inputs:
+    years (ndarray): the evenly spaced year axis of the cube.
+
+    cube (ndarray): averages with the years along the last axis, NaN where missing.
+
+    max_pairs (integer): number of year pairs per series, None for all pairs.
+
+    seed (integer): seed of the drawn pairs.
+
+    Returns:
+    (ndarray) - slope in degrees C per decade.
+
+    """
+
+    n_years = cube.shape[-1]
+    series = cube.reshape(-1, n_years).astype(np.float32)
+    valid = ~np.isnan(series)
+    if max_pairs is None:
+        first, second = np.triu_indices(n_years, k=1)
+        first, second = first[None, :], second[None, :]
+        start = np.zeros((len(series), 1), dtype=np.int32)
+    else:
+        start = np.argmax(valid, axis=1).astype(np.int32)[:, None]
+        span = ((n_years - np.argmax(valid[:, ::-1], axis=1))[:, None] - start).astype(np.float32)
+        fractions = np.sort(np.random.default_rng(seed).random((2, max_pairs)), axis=0).astype(np.float32)
+        first = (fractions[0] * span).astype(np.int32)
+        second = (fractions[1] * span).astype(np.int32)
+
+    ## Values are gathered from the flattened series, and the years between a pair follow from their positions on
+    #     the evenly spaced axis. A pair drawn twice on the same year gives 0 / 0 and drops out as NaN.
+    offsets = np.arange(len(series), dtype=np.int32)[:, None] * n_years + start
+    flat = series.ravel()
+    lag = (second - first).astype(np.float32) * np.float32(years[1] - years[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (flat[offsets + second] - flat[offsets + first]) / lag
+
+    slope = nan_median(slopes).astype(np.float64).reshape(cube.shape[:-1])
+    slope[valid.sum(axis=1).reshape(cube.shape[:-1]) < MIN_YEARS] = np.nan
+    return slope * 10
+
+
+def pettitt_change_points(years, cube):
+
+    """
+    Pettitt test for a single shift in the level of every series of a cube at once, using the rank form of its
+    statistic U_t = 2 * (sum of the ranks up to t) - t * (n + 1) over the valid years.
+
+    Inputs:
+    years (ndarray): the year axis of the cube.
+
+    cube (ndarray): averages with the years along the last axis, NaN where missing.
+
+    Returns:
+    change_year (ndarray): last year before the most likely shift, NaN for series that are too short.
+
+    p_value (ndarray): approximate significance of the shift.
+
+    """
+
+    valid = ~np.isnan(cube)
+    n = valid.sum(axis=-1)
+
+    ## Ranks 1..n of the valid values, NaN sorts last so it never takes a valid rank. Ties are ranked in time order, so
+    #     the result does not depend on the length of the year axis.
+    ranks = np.empty(cube.shape, dtype=np.int32)
+    positions = np.broadcast_to(np.arange(1, cube.shape[-1] + 1, dtype=np.int32), cube.shape)
+    np.put_along_axis(ranks, np.argsort(cube, axis=-1, kind='stable'), positions, axis=-1)
+    ranks = np.where(valid, ranks, 0)
+    t = np.cumsum(valid, axis=-1)
+    u = np.abs(2 * np.cumsum(ranks, axis=-1) - t * (n[..., None] + 1))
+    u = np.where(valid, u, -1)
+
+    position = np.argmax(u, axis=-1)
+    k = np.take_along_axis(u, position[..., None], axis=-1).squeeze(-1).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        p_value = np.minimum(2 * np.exp(-6 * k ** 2 / (n.astype(np.float64) ** 3 + n.astype(np.float64) ** 2)), 1)
+    change_year = years[position].astype(np.float64)
+
+    too_short = n < MIN_YEARS
+    change_year[too_short] = np.nan
+    p_value[too_short] = np.nan
+    return change_year, p_value
+
+
+def compute_station_trends(archive=None, start_year=None, end_year=None, block_stations=256, max_pairs=1024,
+                           stations=None, policy=None):
+
+    """
+    Fits the warming rate of every station and timescale of the archive: least squares and Theil-Sen slopes in
+    degrees C per decade, and the most likely change point. The stations are processed in blocks, and every block
+    is fitted for all of its stations and all 13 timescales at once.
+
+    Inputs:
+    archive (StationArchive): station archive to fit. Defaults to the station archive of the working directory.
+
+    start_year (integer), end_year (integer): only years in this range are fitted. Defaults to the whole record.
+
+    block_stations (integer): number of stations expanded into a dense cube at once.
+
+    max_pairs (integer): number of year pairs per Theil-Sen slope, None for all pairs (see theil_sen_trends).
+
+    stations (ndarray): archive indexes of the stations to fit. Defaults to every station of the archive.
+
+    policy (QualityPolicy or string): quality policy whose rejected values are left out of the fits (see
+    quality_policy.py). The mask of a policy is cached, so fitting the same stations under several policies only
+    decodes the flags once.
+
+    Returns:
+    (df) - one row per station and timescale with the station, timescale, number of valid years, OLS slope and
+    its standard error, Theil-Sen slope, change point year and its p value, ranked from the fastest warming.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            raise ValueError('No station archive has been built. Run python station_archive.py first.')
+    all_years = np.asarray(archive.years)
+    first_year = int(all_years.min()) if start_year is None else start_year
+    last_year = int(all_years.max()) if end_year is None else end_year
+    years = np.arange(first_year, last_year + 1)
+
+    if stations is None:
+        stations = np.arange(len(archive.station_ids))
+    columns = {'slope': [], 'stderr': [], 'n_years': [], 'theil_sen': [], 'change_year': [], 'change_p': []}
+    for first in range(0, len(stations), block_stations):
+        cube = station_year_cube(archive, stations[first:first + block_stations], first_year, len(years), policy)
+
+        slope, stderr, n = ols_trends(years, cube)
+        columns['slope'].append(slope)
+        columns['stderr'].append(stderr)
+        columns['n_years'].append(n)
+        columns['theil_sen'].append(theil_sen_trends(years, cube, max_pairs))
+        change_year, change_p = pettitt_change_points(years, cube)
+        columns['change_year'].append(change_year)
+        columns['change_p'].append(change_p)
+
+    trends = pd.DataFrame({
+        'Station Climate ID': np.repeat(archive.station_ids[stations].astype(str), len(TIMESCALES)),
+        'Timescale': np.tile(TIMESCALES, len(stations)),
+        'Years': np.concatenate(columns['n_years']).ravel(),
+        'OLS Trend (°C/decade)': np.concatenate(columns['slope']).ravel(),
+        'OLS Std Error (°C/decade)': np.concatenate(columns['stderr']).ravel(),
+        'Theil-Sen Trend (°C/decade)': np.concatenate(columns['theil_sen']).ravel(),
+        'Change Point Year': np.concatenate(columns['change_year']).ravel(),
+        'Change Point p': np.concatenate(columns['change_p']).ravel()})
+
+    trends = trends.dropna(subset=['OLS Trend (°C/decade)'])
+    return trends.sort_values('OLS Trend (°C/decade)', ascending=False, ignore_index=True)
+
+
+def write_station_trends(path=None, archive=None, start_year=None, end_year=None, **kwargs):
+
+    """
+    Computes the ranked trend table of every station and timescale (see compute_station_trends) and stores it as
+    CSV.
+
+    Inputs:
+    path (string): where the table is written. Defaults to station_archive/trends.csv in the working directory, or
+    trends_<start>_<end>.csv for a year range.
+
+    Returns:
+    path (string): the written table.
+
+    """
+
+    if archive is None:
+        archive = load_station_archive()
+        if archive is None:
+            raise ValueError('No station archive has been built. Run python station_archive.py first.')
+    if path is None:
+        path = archive.archive_dir + '/trends.csv'
+        if start_year is not None or end_year is not None:
+            path = archive.archive_dir + '/trends_' + str(start_year) + '_' + str(end_year) + '.csv'
+
+    trends = compute_station_trends(archive, start_year, end_year, **kwargs)
+    trends.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+## Testing functionality
+def test_trend_analysis():
+
+    from scipy import stats
+
+    rng = np.random.default_rng(1)
+    years = np.arange(1900, 2000)
+    series = 0.02 * (years - 1900) + rng.normal(0, 0.3, len(years))
+    series[[3, 10, 50]] = np.nan
+    cube = np.stack([series, series[::-1]])[:, None, :]
+    valid = ~np.isnan(series)
+
+    ## Least squares and Theil-Sen slopes agree with scipy on the valid years
+    slope, stderr, n = ols_trends(years, cube)
+    expected = stats.linregress(years[valid], series[valid])
+    assert abs(slope[0, 0] - expected.slope * 10) < 1e-9 and abs(stderr[0, 0] - expected.stderr * 10) < 1e-9
+    assert n[0, 0] == 97 and slope[1, 0] < 0
+    exact = theil_sen_trends(years, cube, max_pairs=None)
+    assert abs(exact[0, 0] - stats.theilslopes(series[valid], years[valid]).slope * 10) < 1e-5
+    assert abs(theil_sen_trends(years, cube)[0, 0] - exact[0, 0]) < 0.02
+
+    ## A step in the level is found at its year
+    step = np.where(years < 1960, 0.0, 2.0) + rng.normal(0, 0.3, len(years))
+    change_year, p_value = pettitt_change_points(years, step[None, :])
+    assert change_year[0] == 1959 and p_value[0] < 0.001
+
+    return
+
+
+## Running this file writes the ranked trend table: python trend_analysis.py [start_year end_year]
+if __name__ == '__main__':
+    import sys
+    start = time.perf_counter()
+    bounds = [int(year) for year in sys.argv[1:3]] or [None, None]
+    print(write_station_trends(start_year=bounds[0], end_year=bounds[1]))
+    print('%.1f s' % (time.perf_counter() - start))
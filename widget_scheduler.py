@@ -0,0 +1,198 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import span
+
+
+class DebouncedScheduler:
+
+    """
+    Runs widget callbacks off the kernel's main thread. Every change of the dropdown menus is submitted with the
+    current selection; a computation only starts once the selection has stopped changing for `delay` seconds, runs
+    on a single worker thread, and its result is only applied if no newer selection was submitted in the meantime.
+    Scrolling through years therefore runs one computation for the final selection instead of one per step.
+
+    """
+
+    def __init__(self, compute, apply, on_error=None, delay=0.25, name='widget callback'):
+
+        """
+        Inputs:
+        compute (function): called with the submitted arguments on the worker thread, returns the result to apply.
+
+        apply (function): called with the result of compute when it is still the latest selection.
+
+        on_error (function): called with the exception and its formatted traceback when compute or apply fails.
+
+        delay (float): seconds the selection has to stay unchanged before the computation starts.
+
+        name (string): name of the instrumentation span around every computation, see instrumentation.py.
+
+        """
+
+        self.compute = compute
+        self.apply = apply
+        self.on_error = on_error
+        self.delay = delay
+        self.name = name
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='widget-callback')
+        self._lock = threading.Lock()
+        self._timer = None
+        self._waiting = False
+        self.generation = 0
+        self.counters = {'submitted': 0, 'started': 0, 'applied': 0, 'dropped': 0, 'errors': 0, 'warmed': 0,
+                         'warm_up_failed': 0}
+
+    def submit(self, *args):
+
+        """
+        Submits a new selection. Any selection that has not started computing yet is replaced, and any computation
+        already running will have its result dropped.
+        """
+
+        with self._lock:
+            self.generation += 1
+            self.counters['submitted'] += 1
+            if self._timer is not None:
+                self._timer.cancel()
+
+            ## A selection still waiting out its delay is replaced without ever being computed
+            if self._waiting:
+                self.counters['dropped'] += 1
+            self._waiting = True
+            self._timer = threading.Timer(self.delay, self._start, args=(self.generation, args))
+            self._timer.daemon = True
+            self._timer.start()
+        return
+
+    def warm_up(self, function, *args):
+
+        """
+        Runs a function on the worker thread ahead of any computation, e.g. to import the plotting libraries and load
+        data while the user is still choosing. Computations submitted in the meantime wait for it. Failures are only
+        counted: the computation that needs what failed reports it when it runs.
+
+        Returns:
+        (Future) - completed once the warm up has run.
+
+        """
+
+        def run():
+            try:
+                with span(self.name + ' warm up'):
+                    function(*args)
+                self.counters['warmed'] += 1
+            except Exception:
+                self.counters['warm_up_failed'] += 1
+            return
+
+        return self._executor.submit(run)
+
+    def _is_current(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                self.counters['dropped'] += 1
+                return False
+            return True
+
+    def _start(self, generation, args):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._waiting = False
+        self._executor.submit(self._run, generation, args)
+
+    def _run(self, generation, args):
+
+        ## A newer selection may have arrived while this one was queued behind a running computation
+        if not self._is_current(generation):
+            return
+        self.counters['started'] += 1
+        try:
+            with span(self.name):
+                with span('compute'):
+                    result = self.compute(*args)
+                if self._is_current(generation):
+                    with span('apply'):
+                        self.apply(result)
+                    self.counters['applied'] += 1
+        except Exception as error:
+            self.counters['errors'] += 1
+            if self.on_error is not None:
+                self.on_error(error, traceback.format_exc())
+            else:
+                raise
+        return
+
+    def wait(self, timeout=None):
+
+        """
+        Blocks until the latest submitted selection has been computed, mainly for tests and batch use.
+        """
+
+        with self._lock:
+            timer = self._timer
+        if timer is not None:
+            timer.join(timeout)
+        self._executor.submit(lambda: None).result(timeout)
+        return
+
+    def shutdown(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self._executor.shutdown(wait=False)
+        return
+
+
+## Testing functionality
+def test_debounced_scheduler():
+
+    import time
+
+    computed, applied = [], []
+
+    def compute(year):
+        computed.append(year)
+        time.sleep(0.02)
+        return year
+
+    scheduler = DebouncedScheduler(compute, applied.append, delay=0.05)
+
+    ## A burst of changes only computes the last selection
+    for year in range(1990, 2000):
+        scheduler.submit(year)
+    scheduler.wait()
+    assert computed == [1999] and applied == [1999]
+
+    ## A selection superseded while computing is computed but not applied
+    scheduler.delay = 0
+    scheduler.submit(2000)
+    time.sleep(0.01)
+    scheduler.submit(2001)
+    scheduler.wait()
+    assert applied[-1] == 2001 and 2000 not in applied
+    assert scheduler.counters['dropped'] >= 9
+
+    ## Failures are reported instead of being hidden
+    errors = []
+    failing = DebouncedScheduler(lambda: 1 / 0, applied.append, lambda error, text: errors.append(error), delay=0)
+    failing.submit()
+    failing.wait()
+    assert isinstance(errors[0], ZeroDivisionError)
+
+    ## Warm ups run before the computations submitted after them, and their failures stay quiet
+    order = []
+    warming = DebouncedScheduler(order.append, applied.append, delay=0)
+    warming.warm_up(lambda: (time.sleep(0.05), order.append('warm up')))
+    warming.warm_up(lambda: 1 / 0).result()
+    warming.submit('selection')
+    warming.wait()
+    assert order == ['warm up', 'selection'] and warming.counters['warm_up_failed'] == 1
+
+    scheduler.shutdown()
+    failing.shutdown()
+    warming.shutdown()
+    return